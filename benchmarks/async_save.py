@@ -0,0 +1,120 @@
+"""
+Compare concurrent save throughput of `UniqueMixin.asave()` with
+`sync_to_async(storage.save)` under an event loop.
+
+Usage:
+
+    python benchmarks/async_save.py [--files N] [--size BYTES]
+        [--concurrency N] [--repeat N] [--latency SECONDS]
+
+Runs against a temporary `MEDIA_ROOT` and SQLite database. Each repeat saves
+new content, so every save hashes, writes and records a new file.
+
+On local disk both are about as fast, because hashing and writing are bound
+by CPU and disk. Use `--latency` to add a delay to each write, like a remote
+storage class. `sync_to_async(storage.save)` runs every save in the single
+thread shared with the ORM, while `asave()` only records `UniqueFile`
+objects there.
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def setup(root):
+    import django
+    from django.conf import settings
+    settings.configure(
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': os.path.join(root, 'db.sqlite3'),
+            },
+        },
+        INSTALLED_APPS=['ixc_whitenoise'],
+        MEDIA_ROOT=os.path.join(root, 'media'),
+        USE_TZ=True,
+    )
+    django.setup()
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+
+async def run(save, files, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def save_one(name, content):
+        async with semaphore:
+            await save(name, content)
+
+    await asyncio.gather(*[save_one(name, content) for name, content in files])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--size', type=int, default=2 ** 20)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        setup(root)
+        from asgiref.sync import sync_to_async
+        from django.core.files.base import ContentFile
+        from django.core.files.storage import FileSystemStorage
+        from ixc_whitenoise.storage import UniqueMixin
+
+        # Delay writes below `UniqueMixin`, like a remote storage class.
+        class LatencyFileSystemStorage(FileSystemStorage):
+            def _save(self, name, content):
+                time.sleep(args.latency)
+                return super(LatencyFileSystemStorage, self)._save(
+                    name, content)
+
+        class LatencyStorage(UniqueMixin, LatencyFileSystemStorage):
+            pass
+
+        storage = LatencyStorage()
+        total_size = args.files * args.size
+        print('%d files, %.1f MB, concurrency %d, latency %.3fs' % (
+            args.files, total_size / 2 ** 20, args.concurrency, args.latency))
+
+        for label, save in (
+                ('sync_to_async', sync_to_async(storage.save)),
+                ('asave', storage.asave)):
+            best = None
+            for repeat in range(args.repeat):
+                files = [
+                    (
+                        '%s/%d/%d.bin' % (label, repeat, i),
+                        ContentFile(os.urandom(args.size)),
+                    )
+                    for i in range(args.files)
+                ]
+                start = time.time()
+                asyncio.run(run(save, files, args.concurrency))
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            print('%-14s %8.1f files/s %8.1f MB/s' % (
+                label,
+                args.files / best,
+                total_size / 2 ** 20 / best,
+            ))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Compare `post_process()` throughput of per-pattern URL rewriting (Django's
+patterns, skipping the same URLs as `RegexURLConverterMixin`) with the single
+pass rewriter in `RegexURLConverterMixin`, with and without
+`GraphPostProcessMixin`, on a generated CSS corpus.
+
+Usage:
+
+    python benchmarks/css_rewrite.py [--files N] [--rules N] [--repeat N]
+
+Each CSS file has `url()` references to images and other CSS files, an
+`@import`, and references that are not rewritten (`data:`, `//`, `http://`
+and `#`). All storage classes must save the same manifest.
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def setup(root):
+    import django
+    from django.conf import settings
+    settings.configure(
+        INSTALLED_APPS=['django.contrib.staticfiles'],
+        STATIC_ROOT=os.path.join(root, 'static'),
+        STATIC_URL='/static/',
+    )
+    django.setup()
+
+
+def write_corpus(source, files, rules):
+    os.makedirs(os.path.join(source, 'css', 'lib'))
+    os.makedirs(os.path.join(source, 'img'))
+    for i in range(files):
+        with open(os.path.join(source, 'img', '%d.png' % i), 'wb') as f:
+            f.write(b'PNG%d' % i)
+    for i in range(files):
+        lines = ['@import "lib/%d.css";' % i]
+        for j in range(rules):
+            lines.append(
+                '.r%d-%d { background: url("../img/%d.png"); '
+                'cursor: url(data:image/png;base64,AAAA); }' % (
+                    i, j, (i + j) % files))
+            if j % 10 == 0:
+                lines.append(
+                    '.e%d-%d { background: url(//cdn.example.com/a.png), '
+                    'url(http://example.com/b.png), url(#mask); }' % (i, j))
+        with open(os.path.join(source, 'css', '%d.css' % i), 'w') as f:
+            f.write('\n'.join(lines))
+        with open(os.path.join(source, 'css', 'lib', '%d.css' % i), 'w') as f:
+            f.write('.lib%d { background: url("../../img/%d.png"); }' % (
+                i, i))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--rules', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        setup(root)
+        from django.contrib.staticfiles.storage import \
+            ManifestStaticFilesStorage
+        from django.core.files.storage import FileSystemStorage
+        from ixc_whitenoise.storage import \
+            GraphPostProcessMixin, RegexURLConverterMixin, SKIP_URL_RE
+
+        class PerPatternStorage(ManifestStaticFilesStorage):
+
+            def url_converter(self, name, hashed_files, template=None):
+                converter = super(PerPatternStorage, self).url_converter(
+                    name, hashed_files, template)
+
+                def custom_converter(matchobj):
+                    matched, url = matchobj.groups()
+                    if SKIP_URL_RE.match(url):
+                        return matched
+                    return converter(matchobj)
+
+                return custom_converter
+
+        class SinglePassStorage(
+                RegexURLConverterMixin, ManifestStaticFilesStorage):
+            pass
+
+        class GraphStorage(
+                RegexURLConverterMixin, GraphPostProcessMixin,
+                ManifestStaticFilesStorage):
+            graph_post_process = True
+
+        source = os.path.join(root, 'source')
+        write_corpus(source, args.files, args.rules)
+        source_storage = FileSystemStorage(location=source)
+        paths = {}
+        for dirpath, dirnames, filenames in os.walk(source):
+            for filename in filenames:
+                path = os.path.relpath(
+                    os.path.join(dirpath, filename), source).replace(
+                        os.sep, '/')
+                paths[path] = (source_storage, path)
+        css_size = sum(
+            os.path.getsize(os.path.join(source, path))
+            for path in paths if path.endswith('.css'))
+        print('%d files, %.1f MB of CSS' % (len(paths), css_size / 2 ** 20))
+
+        manifests = {}
+        for label, storage_class in (
+                ('per-pattern', PerPatternStorage),
+                ('single pass', SinglePassStorage),
+                ('graph', GraphStorage)):
+            best = None
+            for repeat in range(args.repeat):
+                location = os.path.join(root, 'static', label, str(repeat))
+                shutil.copytree(source, location)
+                storage = storage_class(location=location)
+                start = time.time()
+                for name, hashed_name, processed in storage.post_process(
+                        dict(paths)):
+                    if isinstance(processed, Exception):
+                        raise processed
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+                manifests[label] = storage.hashed_files
+            print('%-12s %8.2f s %8.1f MB/s of CSS' % (
+                label, best, css_size / 2 ** 20 / best))
+
+        for label in ('single pass', 'graph'):
+            if manifests[label] != manifests['per-pattern']:
+                print('Manifests differ!')
+                sys.exit(1)
+        print('Manifests match.')
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Measure content hash throughput for each available algorithm on local files.
+
+Usage:
+
+    python benchmarks/hash_algorithms.py [--chunk-size BYTES] [--repeat N]
+        [--algorithm NAME ...] PATH [PATH ...]
+
+Directories are walked recursively. Files are read once per algorithm and
+repeat, so the first algorithm may include cold cache reads. Use `--repeat` to
+warm the page cache.
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ixc_whitenoise.hashes import HASH_ALGORITHMS, new_hash  # noqa: E402
+
+
+def iter_paths(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                for filename in filenames:
+                    yield os.path.join(dirpath, filename)
+        else:
+            yield path
+
+
+def hash_file(path, algorithm, chunk_size):
+    content_hash = new_hash(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('paths', nargs='+', metavar='PATH')
+    parser.add_argument(
+        '--algorithm', action='append', dest='algorithms',
+        choices=sorted(HASH_ALGORITHMS),
+        help='Algorithm to benchmark. Default: all available algorithms.')
+    parser.add_argument('--chunk-size', type=int, default=64 * 2 ** 10)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    paths = [path for path in iter_paths(args.paths) if os.path.isfile(path)]
+    total_size = sum(os.path.getsize(path) for path in paths)
+    print('%d files, %.1f MB, chunk size %d bytes' % (
+        len(paths), total_size / 2 ** 20, args.chunk_size))
+
+    for algorithm in args.algorithms or sorted(HASH_ALGORITHMS):
+        best = None
+        for _ in range(args.repeat):
+            start = time.time()
+            for path in paths:
+                hash_file(path, algorithm, args.chunk_size)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print('%-10s %10.1f MB/s %12d bytes/s' % (
+            algorithm,
+            total_size / 2 ** 20 / best if best else 0,
+            total_size / best if best else 0,
+        ))
+
+
+if __name__ == '__main__':
+    main()
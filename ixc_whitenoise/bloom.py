@@ -0,0 +1,170 @@
+"""
+A Bloom filter of strings that can be saved to and loaded from a file.
+
+The file has a header and the filter's bits:
+
+    header: magic (8 bytes), generation (uint64), capacity (uint64),
+            error rate (double), count (uint64)
+    bits:   ceil(bit count / 8) bytes
+
+The bit count and number of hash functions are derived from the capacity and
+error rate. The generation is incremented when the filter is reset, so
+processes can tell a reset filter from one that has only had names added. The
+count is the number of distinct values added, so a filter that is past its
+capacity, and has a higher false positive rate than its error rate, can be
+detected. Files without a count (`IXWNBLM1`) are loaded with a count
+estimated from their bits.
+"""
+
+import hashlib
+import math
+import os
+import struct
+import sys
+import uuid
+
+MAGIC = b'IXWNBLM2'
+HEADER = struct.Struct('<8sQQdQ')
+
+# Without a count.
+MAGIC_V1 = b'IXWNBLM1'
+HEADER_V1 = struct.Struct('<8sQQd')
+
+
+def count_set_bits(value):
+    """
+    Return the number of set bits in an integer.
+    """
+    if hasattr(value, 'bit_count'):
+        return value.bit_count()
+    return bin(value).count('1')  # Python < 3.10
+
+
+class BloomFilter(object):
+
+    def __init__(self, capacity, error_rate, generation=0, bits=None,
+                 count=0):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.generation = generation
+        self.count = count
+        self.bit_count = max(1, int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hash_count = max(1, int(round(
+            self.bit_count / float(capacity) * math.log(2))))
+        size = (self.bit_count + 7) // 8
+        if bits is None:
+            bits = bytearray(size)
+        elif len(bits) != size:
+            raise ValueError('Expected %s bytes, got %s.' % (size, len(bits)))
+        self.bits = bits
+
+    def get_positions(self, value):
+        # Derive all positions from two 64 bit hashes, with enhanced double
+        # hashing. Plain double hashing has a much higher false positive rate
+        # than expected for small filters.
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = struct.unpack('<QQ', digest)
+        position = h1 % self.bit_count
+        step = h2 % self.bit_count
+        for i in range(self.hash_count):
+            yield position
+            position = (position + step) % self.bit_count
+            step = (step + i + 1) % self.bit_count
+
+    def add(self, value):
+        # Only count values that set at least one new bit, so values added
+        # again are not counted.
+        added = False
+        for position in self.get_positions(value):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+
+    def is_full(self):
+        """
+        Return `True` if more values than the capacity have been added, so
+        the false positive rate is higher than the error rate.
+        """
+        return self.count > self.capacity
+
+    def estimate_count(self, set_bits):
+        """
+        Estimate the number of distinct values added from the number of set
+        bits.
+        """
+        if set_bits >= self.bit_count:
+            return sys.maxsize
+        return int(round(
+            -self.bit_count / float(self.hash_count) *
+            math.log(1 - set_bits / float(self.bit_count))))
+
+    def __contains__(self, value):
+        for position in self.get_positions(value):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def update(self, other):
+        """
+        Add all values from another filter with the same parameters.
+        """
+        if (other.capacity, other.error_rate) != \
+                (self.capacity, self.error_rate):
+            raise ValueError('Cannot merge filters with different parameters.')
+        merged = int.from_bytes(bytes(self.bits), 'little') | \
+            int.from_bytes(bytes(other.bits), 'little')
+        self.bits = bytearray(merged.to_bytes(len(self.bits), 'little'))
+        # Values in both filters are only counted once.
+        self.count = max(
+            self.count, other.count,
+            self.estimate_count(count_set_bits(merged)))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            magic = f.read(len(MAGIC))
+            if magic == MAGIC:
+                header = magic + f.read(HEADER.size - len(magic))
+                if len(header) != HEADER.size:
+                    raise ValueError('Not a Bloom filter: %s' % path)
+                magic, generation, capacity, error_rate, count = \
+                    HEADER.unpack(header)
+                return cls(
+                    capacity, error_rate, generation, bytearray(f.read()),
+                    count)
+            if magic == MAGIC_V1:
+                header = magic + f.read(HEADER_V1.size - len(magic))
+                if len(header) != HEADER_V1.size:
+                    raise ValueError('Not a Bloom filter: %s' % path)
+                magic, generation, capacity, error_rate = \
+                    HEADER_V1.unpack(header)
+                bloom = cls(
+                    capacity, error_rate, generation, bytearray(f.read()))
+                bloom.count = bloom.estimate_count(count_set_bits(
+                    int.from_bytes(bytes(bloom.bits), 'little')))
+                return bloom
+            raise ValueError('Not a Bloom filter: %s' % path)
+
+    def save(self, path):
+        """
+        Atomically write the filter to a file.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp_path = os.path.join(directory, '.%s.%s' % (
+            os.path.basename(path), uuid.uuid4().hex))
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(HEADER.pack(
+                    MAGIC, self.generation, self.capacity, self.error_rate,
+                    self.count))
+                f.write(self.bits)
+            os.rename(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
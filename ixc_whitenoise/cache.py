@@ -0,0 +1,361 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from ixc_whitenoise.bloom import BloomFilter
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of resolved original names to keep in each process.
+RESOLUTION_CACHE_SIZE = getattr(
+    settings, 'IXC_WHITENOISE_RESOLUTION_CACHE_SIZE', 10000)
+
+# Seconds to cache resolved original names (and misses) for. `None` to cache
+# forever.
+RESOLUTION_CACHE_TTL = getattr(
+    settings, 'IXC_WHITENOISE_RESOLUTION_CACHE_TTL', 300)
+
+# Alias of a Django cache to share resolved original names between processes.
+RESOLUTION_CACHE_ALIAS = getattr(
+    settings, 'IXC_WHITENOISE_RESOLUTION_CACHE', None)
+
+# Maximum number of unique names known to exist to keep in each process. `0`
+# to disable. Files deleted by another process (e.g. `gc_unique_storage`) are
+# not saved again while their names are remembered.
+EXISTS_CACHE_SIZE = getattr(
+    settings, 'IXC_WHITENOISE_EXISTS_CACHE_SIZE', 0)
+
+# Seconds to remember unique names known to exist for in each process. `None`
+# to remember them until the shared Bloom filter is reset.
+EXISTS_CACHE_TTL = getattr(settings, 'IXC_WHITENOISE_EXISTS_CACHE_TTL', 60)
+
+# File to persist a Bloom filter of unique names known to exist to, shared by
+# all processes. `None` to disable.
+EXISTS_FILTER_PATH = getattr(
+    settings, 'IXC_WHITENOISE_EXISTS_FILTER_PATH', None)
+
+# Number of names the Bloom filter is sized for, and its false positive rate at
+# that number of names. A false positive skips writing a new file, so keep it
+# very low.
+EXISTS_FILTER_CAPACITY = getattr(
+    settings, 'IXC_WHITENOISE_EXISTS_FILTER_CAPACITY', 1000000)
+EXISTS_FILTER_ERROR_RATE = getattr(
+    settings, 'IXC_WHITENOISE_EXISTS_FILTER_ERROR_RATE', 1e-9)
+
+# Seconds between checks for a changed filter file, and between saves of names
+# added in this process. Names are also saved after every
+# `EXISTS_FILTER_SAVE_COUNT` names added.
+EXISTS_FILTER_CHECK_INTERVAL = 10
+EXISTS_FILTER_SAVE_INTERVAL = 60
+EXISTS_FILTER_SAVE_COUNT = 1000
+
+
+class LRUCache(object):
+    """
+    A thread-safe, size-bounded, least recently used cache, with optional
+    expiry.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, expires = self.data[key]
+            except KeyError:
+                return default
+            if expires is not None and expires < time.time():
+                del self.data[key]
+                return default
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.data[key] = (value, expires)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+class ResolutionCache(object):
+    """
+    Resolve original names to unique names via the `UniqueFile` index, caching
+    both hits and misses in process and, optionally, in a Django cache.
+    """
+
+    # Cached value for original names without a unique name.
+    MISSING = ''
+
+    def __init__(self, maxsize=RESOLUTION_CACHE_SIZE, ttl=RESOLUTION_CACHE_TTL,
+                 alias=RESOLUTION_CACHE_ALIAS):
+        self.local = LRUCache(maxsize, ttl)
+        self.ttl = ttl
+        self.alias = alias
+
+    @property
+    def shared(self):
+        if self.alias:
+            from django.core.cache import caches
+            return caches[self.alias]
+
+    @staticmethod
+    def make_key(original_name):
+        # Hash names to get keys that are safe for all cache backends.
+        return 'ixc_whitenoise.resolve.%s' % hashlib.md5(
+            original_name.encode('utf-8')).hexdigest()
+
+    def get(self, original_name):
+        """
+        Return the unique name for an original name, or `None`.
+        """
+        unique_name = self.local.get(original_name)
+        if unique_name is None and self.shared is not None:
+            unique_name = self.shared.get(self.make_key(original_name))
+            if unique_name is not None:
+                self.local.set(original_name, unique_name)
+        if unique_name is None:
+            unique_name = self.resolve(original_name) or self.MISSING
+            self.local.set(original_name, unique_name)
+            if self.shared is not None:
+                self.shared.set(
+                    self.make_key(original_name), unique_name, self.ttl)
+        return unique_name or None
+
+    def resolve(self, original_name):
+        from ixc_whitenoise.models import UniqueFile  # Avoid circular import
+        # There could be more than one `UniqueFile` object for a given
+        # name. Redirect to the most recently deduplicated one.
+        return UniqueFile.objects \
+            .filter(original_name=original_name) \
+            .values_list('name', flat=True) \
+            .last()
+
+    def invalidate(self, original_name):
+        self.local.delete(original_name)
+        if self.shared is not None:
+            self.shared.delete(self.make_key(original_name))
+
+
+class ExistsCache(object):
+    """
+    Remember unique names that are known to exist, which is permanent, so
+    storage is not asked again. Only positive results are remembered.
+
+    Names are kept in an LRU cache in each process and, optionally, in a Bloom
+    filter that is periodically merged with a file shared by all processes.
+    When the file is reset (e.g. after files are deleted), each process starts
+    over with an empty LRU cache and filter. The file is also reset when more
+    names than its capacity have been added, and names found in a filter that
+    is past its capacity are not trusted.
+    """
+
+    def __init__(self, maxsize=EXISTS_CACHE_SIZE, filter_path=EXISTS_FILTER_PATH,
+                 capacity=EXISTS_FILTER_CAPACITY,
+                 error_rate=EXISTS_FILTER_ERROR_RATE, ttl=EXISTS_CACHE_TTL):
+        self.local = LRUCache(maxsize, ttl)
+        self.filter_path = filter_path
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.bloom = None
+        self.stat_key = None
+        self.checked = 0
+        self.saved = time.time()
+        self.added_count = 0
+
+    def __contains__(self, name):
+        if name in self.local:
+            return True
+        if self.filter_path:
+            with self.lock:
+                self.check()
+                # A false positive skips saving a new file. Past its capacity,
+                # the filter has more of them than its error rate.
+                return not self.bloom.is_full() and name in self.bloom
+        return False
+
+    def add(self, name):
+        self.local.set(name, True)
+        if self.filter_path:
+            with self.lock:
+                self.check()
+                self.bloom.add(name)
+                self.added_count += 1
+                if self.added_count >= EXISTS_FILTER_SAVE_COUNT or \
+                        time.time() - self.saved >= EXISTS_FILTER_SAVE_INTERVAL:
+                    self.save()
+
+    def discard(self, name):
+        # Names cannot be removed from a Bloom filter. Reset it instead.
+        self.local.delete(name)
+
+    def clear(self):
+        """
+        Forget all names in this process, and load the filter file again on
+        next use.
+        """
+        with self.lock:
+            self.local.clear()
+            self.bloom = None
+            self.added_count = 0
+
+    def get_stat_key(self):
+        try:
+            stat_result = os.stat(self.filter_path)
+        except OSError:
+            return None
+        return (stat_result.st_ino, stat_result.st_mtime)
+
+    def load(self):
+        """
+        Return the filter saved to the file, or `None`.
+        """
+        try:
+            return BloomFilter.load(self.filter_path)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def check(self):
+        """
+        Load the filter file on first use, and merge it again when it has
+        changed, at most every `EXISTS_FILTER_CHECK_INTERVAL` seconds. Start
+        over when it has been reset. Call with the lock held.
+        """
+        if self.bloom is not None and \
+                time.time() - self.checked < EXISTS_FILTER_CHECK_INTERVAL:
+            return
+        self.checked = time.time()
+        stat_key = self.get_stat_key()
+        if self.bloom is not None and stat_key == self.stat_key:
+            return
+        self.stat_key = stat_key
+        saved = self.load()
+        if saved is None or \
+                (saved.capacity, saved.error_rate) != \
+                (self.capacity, self.error_rate):
+            if self.bloom is None:
+                self.bloom = BloomFilter(self.capacity, self.error_rate)
+        elif self.bloom is None or saved.generation != self.bloom.generation:
+            self.bloom = saved
+            self.local.clear()
+            self.added_count = 0
+        else:
+            self.bloom.update(saved)
+
+    def save(self):
+        """
+        Merge names added in this process into the filter file. Call with the
+        lock held. The file is locked while it is merged, so a reset by
+        another process is never overwritten with an older generation.
+        """
+        self.saved = time.time()
+        if not self.added_count:
+            return
+        with lock_filter(self.filter_path):
+            saved = self.load()
+            if saved is not None and \
+                    (saved.capacity, saved.error_rate) == \
+                    (self.capacity, self.error_rate):
+                if saved.generation != self.bloom.generation:
+                    # Reset since it was loaded. Drop names added in this
+                    # process.
+                    self.bloom = saved
+                    self.local.clear()
+                    self.added_count = 0
+                    self.stat_key = self.get_stat_key()
+                    return
+                self.bloom.update(saved)
+            if self.bloom.is_full():
+                # Start over with an empty filter of the next generation.
+                # Other processes do the same on their next check.
+                logger.warning(
+                    'Resetting Bloom filter with %s of %s names: %s' % (
+                        self.bloom.count, self.capacity, self.filter_path))
+                self.bloom = BloomFilter(
+                    self.capacity, self.error_rate, self.bloom.generation + 1)
+            self.bloom.save(self.filter_path)
+        self.added_count = 0
+        self.stat_key = self.get_stat_key()
+
+    def flush(self):
+        """
+        Save names added in this process to the filter file now.
+        """
+        if self.filter_path and self.bloom is not None:
+            with self.lock:
+                self.save()
+
+
+@contextmanager
+def lock_filter(filter_path):
+    """
+    Hold an exclusive lock on a lock file next to a Bloom filter file, shared
+    by all processes. Does nothing where `fcntl` is not available.
+    """
+    if fcntl is None:
+        yield
+        return
+    directory = os.path.dirname(os.path.abspath(filter_path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+    with open(filter_path + '.lock', 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def reset_exists_filter(filter_path=EXISTS_FILTER_PATH,
+                        capacity=EXISTS_FILTER_CAPACITY,
+                        error_rate=EXISTS_FILTER_ERROR_RATE):
+    """
+    Replace the shared Bloom filter of unique names known to exist with an
+    empty one of the next generation. Call after deleting files with unique
+    names. Each process clears its own cache on its next check.
+    """
+    if not filter_path:
+        return
+    with lock_filter(filter_path):
+        generation = 0
+        try:
+            generation = BloomFilter.load(filter_path).generation + 1
+        except (IOError, OSError, ValueError):
+            pass
+        BloomFilter(capacity, error_rate, generation).save(filter_path)
+
+
+resolution_cache = ResolutionCache()
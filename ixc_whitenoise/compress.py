@@ -0,0 +1,188 @@
+"""
+Compress static files in worker processes, with an optional cache of
+compressed variants keyed by content hash, shared across deploys.
+
+Functions here are called in a process pool, so they only use whitenoise and
+the standard library, and do not need Django to be set up.
+
+Cache entries are directories named after the SHA-256 of a file's content and
+the compressor settings. Each contains the `.br` and `.gz` variants that were
+effective, or nothing if neither was. Outputs are hard linked from the cache
+when possible, so existing variants are always unlinked before they are
+written, never truncated. Entries are touched when used and the least recently
+used are evicted by `evict_compression_cache()`.
+"""
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+import whitenoise
+from whitenoise.compress import Compressor
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Temporary entries are written to this directory inside the cache directory,
+# so they are on the same filesystem as their target.
+CACHE_TEMP_DIR = '.tmp'
+
+# Variant suffixes, in the order `Compressor` writes them.
+SUFFIXES = ('.br', '.gz')
+
+
+def compress_path(path, extensions=None, cache_dir=None, use_gzip=True,
+                  use_brotli=True):
+    """
+    Write compressed variants of a file next to it, like `Compressor`, reusing
+    variants from the cache in `cache_dir` for identical content. Return the
+    paths of the variants that were written.
+    """
+    compressor = Compressor(
+        extensions=extensions, use_gzip=use_gzip, use_brotli=use_brotli,
+        quiet=True)
+    # `Compressor` opens existing variants for writing, which would truncate
+    # a cache entry they are linked to. Variants of previous content that are
+    # not written again must not be served either.
+    remove_variants(path)
+    if not cache_dir:
+        return list(compressor.compress(path))
+
+    entry_path = get_entry_path(cache_dir, path, compressor)
+    try:
+        os.utime(entry_path, None)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    else:
+        return copy_from_cache(entry_path, path)
+
+    compressed_paths = list(compressor.compress(path))
+    add_to_cache(cache_dir, entry_path, compressed_paths)
+    return compressed_paths
+
+
+def remove_variants(path):
+    for suffix in SUFFIXES:
+        try:
+            os.unlink(path + suffix)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def get_cache_key(path, compressor):
+    """
+    Return a key for the content of a file and the settings that determine
+    its compressed variants.
+    """
+    content_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            content_hash.update(chunk)
+    settings_hash = hashlib.sha256(json.dumps([
+        getattr(whitenoise, '__version__', None),
+        compressor.use_gzip,
+        compressor.use_brotli and getattr(brotli, '__version__', True),
+    ]).encode('utf-8'))
+    return '%s-%s' % (
+        content_hash.hexdigest(), settings_hash.hexdigest()[:16])
+
+
+def get_entry_path(cache_dir, path, compressor):
+    key = get_cache_key(path, compressor)
+    return os.path.join(cache_dir, key[:2], key)
+
+
+def copy_from_cache(entry_path, path):
+    """
+    Hard link (or copy) cached variants next to a file, with its access and
+    modification times. Return their paths.
+    """
+    stat_result = os.stat(path)
+    compressed_paths = []
+    for suffix in SUFFIXES:
+        cached_path = os.path.join(entry_path, suffix)
+        if not os.path.exists(cached_path):
+            continue
+        compressed_path = path + suffix
+        link_or_copy(cached_path, compressed_path)
+        os.utime(compressed_path, (stat_result.st_atime, stat_result.st_mtime))
+        compressed_paths.append(compressed_path)
+    return compressed_paths
+
+
+def add_to_cache(cache_dir, entry_path, compressed_paths):
+    """
+    Atomically create a cache entry with compressed variants. Concurrent
+    writers of the same entry do not conflict, because their content is the
+    same.
+    """
+    temp_path = os.path.join(cache_dir, CACHE_TEMP_DIR, uuid.uuid4().hex)
+    os.makedirs(temp_path)
+    try:
+        for compressed_path in compressed_paths:
+            link_or_copy(
+                compressed_path, os.path.join(temp_path, compressed_path[-3:]))
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        try:
+            os.rename(temp_path, entry_path)
+        except OSError as e:
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+    finally:
+        shutil.rmtree(temp_path, ignore_errors=True)
+
+
+def link_or_copy(source, destination):
+    """
+    Hard link a file, replacing the destination. Copy it across filesystems.
+    """
+    try:
+        os.unlink(destination)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def evict_compression_cache(cache_dir, max_size):
+    """
+    Remove the least recently used cache entries until the cache is no larger
+    than 90% of `max_size`, in bytes. Return the number of entries removed.
+    """
+    entries = []
+    total_size = 0
+    for shard in os.listdir(cache_dir):
+        shard_path = os.path.join(cache_dir, shard)
+        if shard == CACHE_TEMP_DIR or not os.path.isdir(shard_path):
+            continue
+        for key in os.listdir(shard_path):
+            entry_path = os.path.join(shard_path, key)
+            try:
+                mtime = os.stat(entry_path).st_mtime
+                size = sum(
+                    os.stat(os.path.join(entry_path, name)).st_size
+                    for name in os.listdir(entry_path))
+            except OSError:
+                continue
+            entries.append((mtime, size, entry_path))
+            total_size += size
+    if total_size <= max_size:
+        return 0
+    removed_count = 0
+    for mtime, size, entry_path in sorted(entries):
+        if total_size <= max_size * 0.9:
+            break
+        shutil.rmtree(entry_path, ignore_errors=True)
+        total_size -= size
+        removed_count += 1
+    return removed_count
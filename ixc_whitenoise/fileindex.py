@@ -0,0 +1,222 @@
+"""
+A compact, read-only index of the files in a directory, which can be memory
+mapped and shared by all worker processes instead of each process building its
+own dictionary of `StaticFile` objects.
+
+The index is a single file with a header, a table of record offsets and a list
+of records, sorted by name:
+
+    header:  magic (8 bytes), record count (uint32)
+    offsets: record offset (uint64) * record count
+    record:  name length (uint16), name (UTF-8), size (uint64), mtime (double),
+             gzip size (int64, -1 if missing), brotli size (int64, -1 if
+             missing), content type length (uint8), content type (ASCII)
+
+Names are relative paths with forward slashes. Lookups are a binary search
+over the memory mapped file, so they only touch the pages they need.
+"""
+
+import mmap
+import os
+import stat
+import struct
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+from django.conf import settings
+from whitenoise.media_types import MediaTypes
+from whitenoise.scantree import scantree
+
+# Directory to read and write file indexes in. `None` to disable.
+FILE_INDEX_DIR = getattr(settings, 'IXC_WHITENOISE_FILE_INDEX_DIR', None)
+
+# Seconds between checks for a rebuilt index file.
+FILE_INDEX_CHECK_INTERVAL = getattr(
+    settings, 'IXC_WHITENOISE_FILE_INDEX_CHECK_INTERVAL', 10)
+
+MAGIC = b'IXWNIDX1'
+HEADER = struct.Struct('<8sI')
+OFFSET = struct.Struct('<Q')
+NAME_LENGTH = struct.Struct('<H')
+STATS = struct.Struct('<Qdqq')
+CONTENT_TYPE_LENGTH = struct.Struct('<B')
+
+# Compressed variants, by encoding, as served by WhiteNoise.
+ENCODINGS = (('gzip', '.gz'), ('br', '.br'))
+
+FileIndexEntry = namedtuple(
+    'FileIndexEntry', ('name', 'size', 'mtime', 'content_type', 'encodings'))
+
+# Just enough of `os.stat_result` for `whitenoise.responders.StaticFile`.
+IndexedStat = namedtuple('IndexedStat', ('st_mode', 'st_size', 'st_mtime'))
+
+
+def get_index_path(name):
+    """
+    Return the path of the named index (e.g. `static` or `media`), or `None`
+    if file indexes are disabled.
+    """
+    if FILE_INDEX_DIR:
+        return os.path.join(FILE_INDEX_DIR, '%s.idx' % name)
+
+
+def build_file_index(root, index_path, media_types=None):
+    """
+    Scan `root` and atomically write an index of its files to `index_path`.
+    Compressed variants are recorded with their uncompressed file, not as
+    files of their own. Return the number of indexed files.
+    """
+    if media_types is None:
+        media_types = MediaTypes(
+            extra_types=getattr(settings, 'WHITENOISE_MIMETYPES', None))
+    root = os.path.abspath(root).rstrip(os.path.sep) + os.path.sep
+    index_path = os.path.abspath(index_path)
+
+    stat_cache = {}
+    if os.path.isdir(root):
+        stat_cache = dict(scantree(root))
+    records = []
+    for path, stat_result in stat_cache.items():
+        if path == index_path:
+            continue
+        if path[-3:] in ('.gz', '.br') and path[:-3] in stat_cache:
+            continue
+        name = path[len(root):].replace('\\', '/').encode('utf-8')
+        variant_sizes = []
+        for encoding, suffix in ENCODINGS:
+            variant = stat_cache.get(path + suffix)
+            variant_sizes.append(variant.st_size if variant else -1)
+        content_type = media_types.get_type(path).encode('ascii')
+        records.append((name, b''.join((
+            NAME_LENGTH.pack(len(name)),
+            name,
+            STATS.pack(
+                stat_result.st_size, stat_result.st_mtime, *variant_sizes),
+            CONTENT_TYPE_LENGTH.pack(len(content_type)),
+            content_type,
+        ))))
+    records.sort()
+
+    index_dir = os.path.dirname(index_path)
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    temp_path = os.path.join(index_dir, '.%s.%s' % (
+        os.path.basename(index_path), uuid.uuid4().hex))
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(records)))
+            offset = HEADER.size + OFFSET.size * len(records)
+            for name, record in records:
+                f.write(OFFSET.pack(offset))
+                offset += len(record)
+            for name, record in records:
+                f.write(record)
+        # Replace the index atomically, so readers never see a partial file.
+        os.rename(temp_path, index_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+    return len(records)
+
+
+class FileIndex(object):
+    """
+    Look up files in a memory mapped index. The index is remapped when it is
+    rebuilt, checking at most every `check_interval` seconds.
+    """
+
+    def __init__(self, index_path, check_interval=FILE_INDEX_CHECK_INTERVAL):
+        self.index_path = index_path
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.mapped = (None, 0)
+        self.stat_key = None
+        self.checked = 0
+        self.open()
+
+    def __len__(self):
+        return self.mapped[1]
+
+    def open(self):
+        stat_result = os.stat(self.index_path)
+        with open(self.index_path, 'rb') as f:
+            index_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = HEADER.unpack_from(index_mmap)
+        if magic != MAGIC:
+            index_mmap.close()
+            raise ValueError('Not a file index: %s' % self.index_path)
+        # Replace the map and count together, without closing the old map,
+        # which other threads may still be reading. It is closed when it is
+        # garbage collected.
+        self.mapped = (index_mmap, count)
+        self.stat_key = (stat_result.st_ino, stat_result.st_mtime)
+        self.checked = time.time()
+
+    def check(self):
+        """
+        Remap the index if it has been rebuilt since it was last opened.
+        """
+        if time.time() - self.checked < self.check_interval:
+            return
+        with self.lock:
+            self.checked = time.time()
+            try:
+                stat_result = os.stat(self.index_path)
+            except OSError:
+                return
+            if (stat_result.st_ino, stat_result.st_mtime) != self.stat_key:
+                self.open()
+
+    def name_at(self, index_mmap, position):
+        offset, = OFFSET.unpack_from(
+            index_mmap, HEADER.size + OFFSET.size * position)
+        length, = NAME_LENGTH.unpack_from(index_mmap, offset)
+        start = offset + NAME_LENGTH.size
+        return index_mmap[start:start + length], start + length
+
+    def get(self, name):
+        """
+        Return a `FileIndexEntry` for the named file, or `None`.
+        """
+        self.check()
+        index_mmap, count = self.mapped
+        key = name.encode('utf-8')
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if self.name_at(index_mmap, middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == count:
+            return None
+        found, offset = self.name_at(index_mmap, low)
+        if found != key:
+            return None
+        size, mtime, gzip_size, brotli_size = \
+            STATS.unpack_from(index_mmap, offset)
+        offset += STATS.size
+        length, = CONTENT_TYPE_LENGTH.unpack_from(index_mmap, offset)
+        offset += CONTENT_TYPE_LENGTH.size
+        content_type = index_mmap[offset:offset + length].decode('ascii')
+        encodings = {}
+        for (encoding, suffix), variant_size in zip(
+                ENCODINGS, (gzip_size, brotli_size)):
+            if variant_size >= 0:
+                encodings[encoding] = (suffix, variant_size)
+        return FileIndexEntry(name, size, mtime, content_type, encodings)
+
+    def get_stat_cache(self, path, entry):
+        """
+        Return a stat cache for `StaticFile`, for a file and its compressed
+        variants at `path`.
+        """
+        stat_cache = {
+            path: IndexedStat(stat.S_IFREG | 0o644, entry.size, entry.mtime),
+        }
+        for encoding, (suffix, size) in entry.encodings.items():
+            stat_cache[path + suffix] = \
+                IndexedStat(stat.S_IFREG | 0o644, size, entry.mtime)
+        return stat_cache
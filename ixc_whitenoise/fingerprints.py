@@ -0,0 +1,83 @@
+"""
+A database of source file fingerprints for incremental `collectstatic`.
+
+For each collected file (by clean name), it stores the source file's size,
+modification time and content hash, the hashed name it was post-processed to,
+and the names of the files it references (found by the URL converter). It is
+saved as JSON, with a signature of the settings that affect post-processing.
+A database with a different signature is ignored.
+"""
+
+import json
+import os
+import uuid
+from collections import namedtuple
+
+VERSION = 1
+
+Fingerprint = namedtuple(
+    'Fingerprint', ('size', 'mtime', 'content_hash', 'hashed_name',
+                    'dependencies'))
+
+
+def load_fingerprints(path, signature):
+    """
+    Return a dictionary of fingerprints by name, or an empty dictionary if
+    there is no database at `path` or it was saved with another signature.
+    """
+    try:
+        with open(path) as f:
+            stored = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    if stored.get('version') != VERSION or \
+            stored.get('signature') != signature:
+        return {}
+    return dict(
+        (name, Fingerprint(*values))
+        for name, values in stored.get('files', {}).items()
+    )
+
+
+def save_fingerprints(path, signature, fingerprints):
+    """
+    Atomically save a dictionary of fingerprints by name.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    temp_path = os.path.join(directory, '.%s.%s' % (
+        os.path.basename(path), uuid.uuid4().hex))
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump({
+                'version': VERSION,
+                'signature': signature,
+                'files': dict(
+                    (name, list(fingerprint))
+                    for name, fingerprint in sorted(fingerprints.items())
+                ),
+            }, f)
+        os.rename(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+
+
+def get_dependents(fingerprints, names):
+    """
+    Return `names` and the names of all files that reference them, directly
+    or indirectly.
+    """
+    referenced_by = {}
+    for name, fingerprint in fingerprints.items():
+        for dependency in fingerprint.dependencies:
+            referenced_by.setdefault(dependency, set()).add(name)
+    dependents = set(names)
+    pending = list(names)
+    while pending:
+        for name in referenced_by.get(pending.pop(), ()):
+            if name not in dependents:
+                dependents.add(name)
+                pending.append(name)
+    return dependents
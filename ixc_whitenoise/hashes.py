@@ -0,0 +1,52 @@
+"""
+Content hash algorithms for unique storage.
+
+Each algorithm is a factory that returns a new hash object with `update()` and
+`hexdigest()` methods. `xxhash` and `blake3` are only available when the
+corresponding packages are installed.
+"""
+
+import hashlib
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+
+HASH_ALGORITHMS = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+    # Truncate BLAKE2 digests to 256 bits, to keep unique names reasonably
+    # short.
+    'blake2b': lambda: hashlib.blake2b(digest_size=32),
+    'blake2s': hashlib.blake2s,
+}
+
+if xxhash is not None:
+    HASH_ALGORITHMS.update({
+        'xxh64': xxhash.xxh64,
+        'xxh3_128': xxhash.xxh3_128,
+    })
+
+if blake3 is not None:
+    HASH_ALGORITHMS['blake3'] = blake3.blake3
+
+
+def new_hash(algorithm):
+    """
+    Return a new hash object for the named algorithm.
+    """
+    try:
+        factory = HASH_ALGORITHMS[algorithm]
+    except KeyError:
+        raise ValueError(
+            'Unknown or unavailable hash algorithm: %r. Available algorithms: '
+            '%s' % (algorithm, ', '.join(sorted(HASH_ALGORITHMS))))
+    return factory()
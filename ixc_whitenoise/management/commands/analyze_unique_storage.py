@@ -0,0 +1,439 @@
+import datetime
+import functools
+import io
+import itertools
+import json
+import logging
+import os
+import posixpath
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from ixc_whitenoise.hashes import new_hash
+from ixc_whitenoise.storage import \
+    DEDUPE_PATH_PREFIX, HASH_ALGORITHM, HASH_CHUNK_SIZE, \
+    STREAMING_SAVE_TEMP_DIR, UniqueMixin, unlazy_storage
+from ixc_whitenoise.utils import external_sort, get_unique_file_fields
+
+logger = logging.getLogger(__name__)
+
+HASH_CACHE_PATH = '.analyze_unique_storage.sqlite3'
+
+# Number of example names to keep for each group of duplicates.
+EXAMPLE_COUNT = 3
+
+
+class HashCache(object):
+    """
+    Content hashes cached in a SQLite database by path, size and mtime, so
+    repeated runs only hash new and changed files.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS hashes ('
+            'path TEXT NOT NULL, '
+            'algorithm TEXT NOT NULL, '
+            'size INTEGER NOT NULL, '
+            'mtime REAL NOT NULL, '
+            'content_hash TEXT NOT NULL, '
+            'PRIMARY KEY (path, algorithm))')
+
+    def get(self, path, algorithm, size, mtime):
+        row = self.connection.execute(
+            'SELECT content_hash FROM hashes '
+            'WHERE path = ? AND algorithm = ? AND size = ? AND mtime = ?',
+            (path, algorithm, size, mtime),
+        ).fetchone()
+        if row:
+            return row[0]
+
+    def set_many(self, rows):
+        """
+        Save `(path, algorithm, size, mtime, content_hash)` rows.
+        """
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO hashes '
+            '(path, algorithm, size, mtime, content_hash) '
+            'VALUES (?, ?, ?, ?, ?)',
+            rows,
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+class Command(BaseCommand):
+    help = 'Report how much space `deduplicate_unique_storage` would save, ' \
+        'without writing to storage or the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--path',
+            help='Analyze all files in a directory, instead of all file '
+            'fields that use `UniqueMixin`.')
+        parser.add_argument(
+            '--workers', default=4, type=int,
+            help='Number of threads to hash files with.')
+        parser.add_argument(
+            '--batch-size', default=1000, type=int,
+            help='Number of files to hash at a time.')
+        parser.add_argument(
+            '--algorithm', default=HASH_ALGORITHM,
+            help='Hash algorithm. Default: `IXC_WHITENOISE_HASH_ALGORITHM`.')
+        parser.add_argument(
+            '--hash-cache', default=HASH_CACHE_PATH,
+            help='SQLite database to cache content hashes in. Default: '
+            '`%s`.' % HASH_CACHE_PATH)
+        parser.add_argument(
+            '--top', default=10, type=int,
+            help='Number of largest duplicate groups to report.')
+        parser.add_argument(
+            '--output',
+            help='Write a JSON report of all duplicate groups to this file.')
+        parser.add_argument(
+            '--chunk-size', default=1000000, type=int,
+            help='Number of files to sort in memory before merging on disk.')
+
+    def handle(self, *args, **options):
+        self.algorithm = options['algorithm']
+        new_hash(self.algorithm)  # Fail early for unknown algorithms.
+
+        self.missing_count = 0
+        self.error_count = 0
+        self.analyzed_count = 0
+        self.cached_count = 0
+        self.hashed_bytes = 0
+        self.hash_time = 0
+
+        if options['path']:
+            files = self.iter_path_files(options['path'])
+        else:
+            files = self.iter_field_files()
+
+        self.hash_cache = HashCache(options['hash_cache'])
+        self.executor = ThreadPoolExecutor(max_workers=options['workers'])
+        try:
+            # Hashed files are sorted by the unique name they would be
+            # deduplicated to on disk, so memory use does not depend on the
+            # number of files.
+            rows = external_sort(
+                self.iter_hashed_files(files, options['batch_size']),
+                options['chunk_size'])
+            self.report(
+                rows, options['top'], options['output'], options['chunk_size'])
+        finally:
+            self.executor.shutdown()
+            self.hash_cache.close()
+
+    def iter_hashed_files(self, files, batch_size):
+        """
+        Hash files in batches and yield `(unique name, content hash, size,
+        key, name)` for each file.
+        """
+        batch = []
+        for item in files:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                for row in self.analyze_batch(batch):
+                    yield row
+                batch = []
+        if batch:
+            for row in self.analyze_batch(batch):
+                yield row
+
+    def iter_path_files(self, root):
+        """
+        Yield `(key, name, size, mtime, opener, storage)` for all files in a
+        directory. Unique names are determined with the default storage.
+        """
+        root = os.path.abspath(root)
+        storage = unlazy_storage(default_storage)
+        for dirpath, dirnames, filenames in os.walk(root):
+            # Skip incomplete streaming saves.
+            if STREAMING_SAVE_TEMP_DIR in dirnames:
+                dirnames.remove(STREAMING_SAVE_TEMP_DIR)
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat_result = os.stat(path)
+                except OSError:
+                    self.missing_count += 1
+                    continue
+                yield (
+                    path,
+                    os.path.relpath(path, root),
+                    stat_result.st_size,
+                    stat_result.st_mtime,
+                    functools.partial(io.open, path, 'rb'),
+                    storage,
+                )
+
+    def iter_field_files(self):
+        """
+        Yield `(key, name, size, mtime, opener, storage)` for each file in all
+        file fields that use `UniqueMixin`. Files in several fields are
+        counted once, when sorted.
+        """
+        for model, file_fields in get_unique_file_fields():
+            for field_name in file_fields:
+                storage = unlazy_storage(
+                    model._meta.get_field(field_name).storage)
+                names = model._default_manager \
+                    .exclude(**{field_name: ''}) \
+                    .exclude(**{'%s__isnull' % field_name: True}) \
+                    .order_by() \
+                    .values_list(field_name, flat=True) \
+                    .distinct() \
+                    .iterator()
+                for name in names:
+                    item = self.get_storage_file(storage, name)
+                    if item is not None:
+                        yield item
+
+    def get_storage_file(self, storage, name):
+        """
+        Return `(key, name, size, mtime, opener, storage)` for a file in
+        storage, or
+        `None` if it does not exist. Local files are keyed by their absolute
+        path, so they share cached hashes with `--path`.
+        """
+        try:
+            if storage.is_local():
+                key = os.path.abspath(storage.path(name))
+                stat_result = os.stat(key)
+                size, mtime = stat_result.st_size, stat_result.st_mtime
+            else:
+                key = '%s.%s:%s' % (
+                    storage.__class__.__module__,
+                    storage.__class__.__name__,
+                    name,
+                )
+                size = storage.size(name)
+                try:
+                    mtime = storage.get_modified_time(name).timestamp()
+                except NotImplementedError:
+                    mtime = 0
+        except (IOError, OSError):
+            self.missing_count += 1
+            logger.warning('File does not exist: %s' % name)
+            return None
+        return key, name, size, mtime, functools.partial(
+            storage.open, name, 'rb'), storage
+
+    def hash_file(self, opener):
+        """
+        Return the content hash and hashing time for a file. Called in a
+        worker thread.
+        """
+        start = time.time()
+        content_hash = new_hash(self.algorithm)
+        chunk_size = HASH_CHUNK_SIZE or File.DEFAULT_CHUNK_SIZE
+        with opener() as f:
+            for chunk in iter(functools.partial(f.read, chunk_size), b''):
+                content_hash.update(chunk)
+        return content_hash.hexdigest(), time.time() - start
+
+    def analyze_batch(self, batch):
+        """
+        Hash a batch of files and return `(unique name, content hash, size,
+        key, name)` for each file.
+        """
+        futures = {}
+        content_hashes = {}
+        for key, name, size, mtime, opener, storage in batch:
+            content_hash = self.hash_cache.get(
+                key, self.algorithm, size, mtime)
+            if content_hash:
+                content_hashes[key] = content_hash
+                self.cached_count += 1
+            else:
+                futures[key] = self.executor.submit(self.hash_file, opener)
+
+        rows = []
+        cache_rows = []
+        for key, name, size, mtime, opener, storage in batch:
+            if key in futures:
+                try:
+                    content_hash, hash_time = futures[key].result()
+                except (IOError, OSError):
+                    self.error_count += 1
+                    logger.exception('Unable to hash: %s' % name)
+                    continue
+                self.hashed_bytes += size
+                self.hash_time += hash_time
+                cache_rows.append(
+                    (key, self.algorithm, size, mtime, content_hash))
+            else:
+                content_hash = content_hashes[key]
+
+            self.analyzed_count += 1
+            rows.append((
+                self.get_unique_name(storage, name, content_hash),
+                content_hash,
+                size,
+                key,
+                name,
+            ))
+
+        self.hash_cache.set_many(cache_rows)
+        logger.info('Analyzed %s files (%s cached)' % (
+            self.analyzed_count,
+            self.cached_count,
+        ))
+        return rows
+
+    def get_unique_name(self, storage, name, content_hash):
+        """
+        Return the unique name `deduplicate_unique_storage` would save a file
+        with. Only files with the same unique name are deduplicated, not all
+        files with the same content. For storage classes without
+        `UniqueMixin` (e.g. with `--path`), use the directory, content hash
+        and extension.
+        """
+        if isinstance(storage, UniqueMixin):
+            return storage.get_unique_name(name, content_hash)
+        path, basename = posixpath.split(name)
+        return posixpath.join(
+            DEDUPE_PATH_PREFIX,
+            path,
+            content_hash + posixpath.splitext(basename)[1].lower(),
+        )
+
+    def iter_duplicates(self, rows):
+        """
+        Count files and unique files from rows sorted by unique name, and
+        yield `(-reclaimable, unique name, content hash, size, count,
+        examples)` for each group of duplicates.
+        """
+        for unique_name, group in itertools.groupby(
+                rows, key=lambda row: row[0]):
+            count = 0
+            examples = []
+            for unique_name, content_hash, size, key, name in group:
+                count += 1
+                if len(examples) < EXAMPLE_COUNT:
+                    examples.append(name)
+            self.file_count += count
+            self.total_bytes += size * count
+            self.unique_count += 1
+            self.unique_bytes += size
+            if count > 1:
+                self.duplicate_count += 1
+                yield (
+                    -size * (count - 1),
+                    unique_name,
+                    content_hash,
+                    size,
+                    count,
+                    tuple(examples),
+                )
+
+    def report(self, rows, top, output, chunk_size):
+        self.file_count = 0
+        self.total_bytes = 0
+        self.unique_count = 0
+        self.unique_bytes = 0
+        self.duplicate_count = 0
+
+        # Groups of duplicates are sorted by reclaimable bytes on disk too.
+        # Sorting consumes all rows, so totals are known after the first
+        # group.
+        duplicates = external_sort(self.iter_duplicates(rows), chunk_size)
+        first = next(duplicates, None)
+        if first is not None:
+            duplicates = itertools.chain([first], duplicates)
+        reclaimable = self.total_bytes - self.unique_bytes
+
+        # Deduplicating reads and writes every file once, which is estimated
+        # from the hashing throughput per worker thread of this run.
+        if self.hash_time:
+            throughput = self.hashed_bytes / self.hash_time
+            estimate = datetime.timedelta(
+                seconds=int(self.total_bytes / throughput))
+        else:
+            throughput = estimate = None
+
+        logger.info('Files: %s, Missing: %s, Errors: %s' % (
+            self.file_count,
+            self.missing_count,
+            self.error_count,
+        ))
+        logger.info('Total: %.1f MB, Unique: %.1f MB, Reclaimable: %.1f MB '
+                    '(%.1f%%)' % (
+                        self.total_bytes / 1024 / 1024,
+                        self.unique_bytes / 1024 / 1024,
+                        reclaimable / 1024 / 1024,
+                        100.0 * reclaimable / self.total_bytes
+                        if self.total_bytes else 0,
+                    ))
+        logger.info('Duplicate groups: %s, Unique contents: %s' % (
+            self.duplicate_count,
+            self.unique_count,
+        ))
+        if estimate is not None:
+            logger.info('Hashed at %.1f MB/s, estimated time to deduplicate '
+                        'with one worker: %s' % (
+                            throughput / 1024 / 1024,
+                            estimate,
+                        ))
+
+        if output:
+            with open(output, 'w') as f:
+                self.write_report(f, duplicates, top, {
+                    'algorithm': self.algorithm,
+                    'file_count': self.file_count,
+                    'missing_count': self.missing_count,
+                    'error_count': self.error_count,
+                    'total_bytes': self.total_bytes,
+                    'unique_bytes': self.unique_bytes,
+                    'reclaimable_bytes': reclaimable,
+                    'estimated_seconds':
+                        estimate.total_seconds()
+                        if estimate is not None else None,
+                })
+            logger.info('Report written to: %s' % output)
+        else:
+            for group in itertools.islice(duplicates, top):
+                self.log_duplicates(group)
+
+    def log_duplicates(self, group):
+        reclaimable, unique_name, content_hash, size, count, examples = group
+        logger.info('%.1f MB reclaimable: %s copies of %.1f MB (%s) %s' % (
+            -reclaimable / 1024 / 1024,
+            count,
+            size / 1024 / 1024,
+            unique_name,
+            ', '.join(examples),
+        ))
+
+    def write_report(self, f, duplicates, top, totals):
+        """
+        Write a JSON report with all groups of duplicates, one group at a
+        time, and log the `top` groups.
+        """
+        f.write('{\n')
+        for key in sorted(totals):
+            f.write('  %s: %s,\n' % (json.dumps(key), json.dumps(totals[key])))
+        f.write('  "duplicates": [')
+        for index, group in enumerate(duplicates):
+            if index < top:
+                self.log_duplicates(group)
+            reclaimable, unique_name, content_hash, size, count, examples = \
+                group
+            f.write('%s\n    %s' % (',' if index else '', json.dumps({
+                'unique_name': unique_name,
+                'content_hash': content_hash,
+                'size': size,
+                'count': count,
+                'reclaimable': -reclaimable,
+                'examples': list(examples),
+            })))
+        f.write('\n  ]\n}\n')
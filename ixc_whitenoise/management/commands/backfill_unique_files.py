@@ -0,0 +1,85 @@
+import logging
+
+from django.core.files.storage import default_storage, get_storage_class
+from django.core.management.base import BaseCommand, CommandError
+
+from ixc_whitenoise.models import UniqueFile
+from ixc_whitenoise.storage import UniqueMixin, unlazy_storage
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Record the content hash and size of `UniqueFile` objects that ' \
+        'are missing them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', default=1000, type=int,
+            help='Number of `UniqueFile` objects to fetch at a time.')
+        parser.add_argument(
+            '--storage',
+            help='Dotted path to the `UniqueMixin` storage class that the '
+            'files were saved with. Default: `DEFAULT_FILE_STORAGE`.')
+
+    def handle(self, *args, **options):
+        if options['storage']:
+            storage = get_storage_class(options['storage'])()
+        else:
+            storage = unlazy_storage(default_storage)
+        if not isinstance(storage, UniqueMixin):
+            raise CommandError('%r does not use `UniqueMixin`.' % storage)
+
+        updated_count = 0
+        error_count = 0
+        last_pk = 0
+
+        # Loop through `UniqueFile` objects in batches, in primary key order,
+        # and update all objects with the same name at once.
+        while True:
+            batch = list(
+                UniqueFile.objects
+                .filter(pk__gt=last_pk, content_hash='')
+                .order_by('pk')
+                .values_list('pk', 'name')[:options['batch_size']]
+            )
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+
+            for name in sorted(set(name for pk, name in batch)):
+                try:
+                    content_hash = storage.get_content_hash(name)
+                    size = storage.size(name)
+                except (IOError, OSError):
+                    error_count += 1
+                    logger.warning(
+                        '%s, %s: Unable to read file: %s' % (
+                            updated_count,
+                            error_count,
+                            name,
+                        ))
+                    continue
+                updated_count += UniqueFile.objects \
+                    .filter(name=name, content_hash='') \
+                    .update(
+                        content_hash=content_hash,
+                        hash_algorithm=storage.hash_algorithm,
+                        size=size,
+                    )
+                logger.debug('%s, %s: Backfilled: %s (%s, %s bytes)' % (
+                    updated_count,
+                    error_count,
+                    name,
+                    content_hash,
+                    size,
+                ))
+
+            logger.info('Backfilled %s objects up to pk %s (%s errors).' % (
+                updated_count,
+                last_pk,
+                error_count,
+            ))
+
+        # Done.
+        logger.info('Updated: %s, Errors: %s' % (updated_count, error_count))
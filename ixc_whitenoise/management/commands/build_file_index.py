@@ -0,0 +1,37 @@
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ixc_whitenoise.fileindex import build_file_index, get_index_path
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Build the shared file indexes for `STATIC_ROOT` and `MEDIA_ROOT`.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--static', action='store_true',
+            help='Only build the index for `STATIC_ROOT`.')
+        parser.add_argument(
+            '--media', action='store_true',
+            help='Only build the index for `MEDIA_ROOT`.')
+
+    def handle(self, *args, **options):
+        if not get_index_path('static'):
+            raise CommandError(
+                'Set `IXC_WHITENOISE_FILE_INDEX_DIR` to build file indexes.')
+        roots = []
+        if options['static'] or not options['media']:
+            roots.append(('static', settings.STATIC_ROOT))
+        if options['media'] or not options['static']:
+            roots.append(('media', settings.MEDIA_ROOT))
+        for name, root in roots:
+            if not root:
+                continue
+            index_path = get_index_path(name)
+            count = build_file_index(root, index_path)
+            logger.info('Indexed %s files in %s: %s' % (
+                count, root, index_path))
@@ -0,0 +1,100 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Min
+
+from ixc_whitenoise.models import UniqueFile
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Delete duplicate `UniqueFile` objects with the same name and ' \
+        'original name, in small batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', default=1000, type=int,
+            help='Number of `UniqueFile` objects to check in each transaction.')
+        parser.add_argument(
+            '--start-pk', default=0, type=int,
+            help='Resume from this primary key, as logged by a previous run.')
+        parser.add_argument(
+            '--sleep', default=0, type=float,
+            help='Seconds to sleep between batches, to reduce database load.')
+
+    def handle(self, *args, **options):
+        deleted_count = 0
+        last_pk = options['start_pk']
+
+        # Loop through `UniqueFile` objects in primary key order. Each batch is
+        # committed separately so no lock is held for long, and the command
+        # can be resumed from the last primary key that was logged.
+        while True:
+            with transaction.atomic():
+                batch = list(
+                    UniqueFile.objects
+                    .filter(pk__gt=last_pk)
+                    .order_by('pk')
+                    .values_list('pk', 'name', 'original_name')
+                    [:options['batch_size']]
+                )
+                if not batch:
+                    break
+                last_pk = batch[-1][0]
+                deleted_count += self.compact_batch(batch)
+            logger.info('Deleted %s duplicates up to pk %s.' % (
+                deleted_count,
+                last_pk,
+            ))
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        # Done.
+        logger.info('Deleted: %s' % deleted_count)
+
+    def compact_batch(self, batch):
+        """
+        Delete objects in the batch that are duplicates of an object with a
+        lower primary key, keeping any content hash and size recorded on the
+        duplicates. Return the number of deleted objects.
+        """
+        # Find the first object for each name and original name in the batch,
+        # with one query.
+        first_pks = {}
+        queryset = UniqueFile.objects \
+            .filter(name__in=set(name for pk, name, original_name in batch)) \
+            .order_by() \
+            .values('name', 'original_name') \
+            .annotate(min_pk=Min('pk'))
+        for values in queryset:
+            first_pks[(values['name'], values['original_name'])] = \
+                values['min_pk']
+
+        duplicate_pks = {}
+        for pk, name, original_name in batch:
+            first_pk = first_pks[(name, original_name)]
+            if pk != first_pk:
+                duplicate_pks[pk] = first_pk
+        if not duplicate_pks:
+            return 0
+
+        # Copy content hashes and sizes to the objects that are kept, when
+        # they are missing.
+        duplicates = UniqueFile.objects \
+            .filter(pk__in=duplicate_pks) \
+            .exclude(content_hash='') \
+            .values_list('pk', 'content_hash', 'hash_algorithm', 'size')
+        for pk, content_hash, hash_algorithm, size in duplicates:
+            UniqueFile.objects \
+                .filter(pk=duplicate_pks[pk], content_hash='') \
+                .update(
+                    content_hash=content_hash,
+                    hash_algorithm=hash_algorithm,
+                    size=size,
+                )
+
+        deleted, _ = UniqueFile.objects.filter(pk__in=duplicate_pks).delete()
+        return deleted
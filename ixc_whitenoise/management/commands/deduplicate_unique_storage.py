@@ -1,217 +1,380 @@
+import datetime
+import json
 import logging
 import os
 import posixpath
 import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from django.core.management.base import BaseCommand
-from django.db import models
-from django.db.models.fields.files import FileField
 
 from ixc_whitenoise.models import UniqueFile
-from ixc_whitenoise.storage import UniqueMixin, unlazy_storage
-
-try:
-    from django.apps import apps
-except ImportError:
-    get_models = models.get_models
-else:
-    get_models = apps.get_models
+from ixc_whitenoise.storage import unlazy_storage
+from ixc_whitenoise.utils import get_unique_file_fields
 
 logger = logging.getLogger(__name__)
 
 TERMINATE = False
 
+CHECKPOINT_PATH = '.deduplicate_unique_storage.json'
+
 
 class Command(BaseCommand):
     help = 'Deduplicate all file fields using `UniqueMixin`.'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', default=1000, type=int,
+            help='Number of instances to fetch and update at a time.')
+        parser.add_argument(
+            '--workers', default=1, type=int,
+            help='Number of threads to hash and save files with. Database '
+            'writes are always done by the main thread.')
+        parser.add_argument(
+            '--checkpoint', default=CHECKPOINT_PATH,
+            help='File to save the last primary key processed for each model '
+            'to, after each batch. Default: `%s`.' % CHECKPOINT_PATH)
+        parser.add_argument(
+            '--resume', action='store_true',
+            help='Continue from the primary keys saved in the checkpoint file.')
+
     def handle(self, *args, **options):
-        error_count = 0
-        updated_count = 0
-        skipped_count = 0
+        self.error_count = 0
+        self.updated_count = 0
+        self.skipped_count = 0
+        self.saved_count = 0
+        self.saved_bytes = 0
+        self.processed_count = 0
+
+        self.checkpoint_path = options['checkpoint']
+        self.checkpoint = {}
+        if options['resume'] and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as f:
+                self.checkpoint = json.load(f)
+            logger.info('Resuming from checkpoint: %s' % self.checkpoint_path)
+
+        # Count instances up front, for the ETA.
+        unique_file_fields = get_unique_file_fields()
+        self.total_count = 0
+        for model, file_fields in unique_file_fields:
+            self.total_count += self.get_queryset(model).count()
+
+        self.start_time = time.time()
+        self.executor = ThreadPoolExecutor(max_workers=options['workers'])
+        try:
+            self.deduplicate(unique_file_fields, options['batch_size'])
+        finally:
+            self.executor.shutdown()
+
+        # Start over next time, unless interrupted.
+        if not TERMINATE and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
 
-        # Loop through ALL models.
-        for model in get_models():
+        # Done.
+        logger.info('Updated: %s, Skipped: %s, Errors: %s' % (
+            self.updated_count,
+            self.skipped_count,
+            self.error_count,
+        ))
+
+    def deduplicate(self, unique_file_fields, batch_size):
+        # Loop through ALL models with file fields that use `UniqueMixin`.
+        for model, file_fields in unique_file_fields:
 
             if TERMINATE:
                 logger.error('Breaking out of outer loop.')
                 break
 
-            model_count = 0
-
-            # Get all file fields that use `UniqueMixin`.
-            file_fields = []
-            for field in model._meta.fields:
-                if isinstance(field, FileField):
-                    storage = unlazy_storage(field.storage)
-                    if isinstance(storage, UniqueMixin):
-                        file_fields.append(field.name)
-                        logger.info('Found unique file field: %s.%s (%r)' % (
-                            model._meta.app_label,
-                            model._meta.label,
-                            field.name,
-                        ))
-                    else:
-                        logger.debug('Skipping file field: %s.%s (%r)' % (
-                            model._meta.app_label,
-                            model._meta.label,
-                            field.name,
-                        ))
-
-            # Skip models with no file fields.
-            if not file_fields:
-                continue
+            self.model_count = 0
 
-            # Loop through ALL instances. Sort by primary key so we have some
-            # kind of progress indicator as it counts down.
-            for instance in model.objects.order_by('-pk'):
+            # Loop through ALL instances in batches. Sort by primary key so we
+            # have some kind of progress indicator as it counts down.
+            while True:
 
                 if TERMINATE:
                     logger.error('Breaking out of inner loop.')
                     break
 
-                updated = False
-
-                # Loop through file fields.
-                for field_name in file_fields:
-
-                    field = getattr(instance, field_name)
-                    original_name = field.name
-                    unique_name = None
-
-                    # Skip empty fields.
-                    if not field:
-                        continue
+                batch = list(
+                    self.get_queryset(model)
+                    .order_by('-pk')
+                    .values_list('pk', *file_fields)[:batch_size]
+                )
+                if not batch:
+                    break
 
-                    # Assume that files with a matching `UniqueFile` object (by
-                    # unique name) have already been deduplicated, with nothing
-                    # left to do.
-                    unique_file = UniqueFile.objects \
-                            .filter(name=original_name).last()
-                    if unique_file:
-                        skipped_count += 1
-                        logger.debug(
+                self.deduplicate_batch(model, file_fields, batch)
+
+                self.processed_count += len(batch)
+                self.save_checkpoint(model, batch[-1][0])
+                self.log_progress()
+
+    def get_queryset(self, model):
+        """
+        Return instances that have not been processed yet, according to the
+        checkpoint.
+        """
+        queryset = model._default_manager.all()
+        last_pk = self.checkpoint.get(model._meta.label)
+        if last_pk is not None:
+            queryset = queryset.filter(pk__lt=last_pk)
+        return queryset
+
+    def save_checkpoint(self, model, last_pk):
+        """
+        Atomically save the last primary key processed for a model.
+        """
+        self.checkpoint[model._meta.label] = last_pk
+        temp_path = '%s.tmp' % self.checkpoint_path
+        with open(temp_path, 'w') as f:
+            json.dump(self.checkpoint, f, default=str)
+        os.rename(temp_path, self.checkpoint_path)
+
+    def log_progress(self):
+        elapsed = max(time.time() - self.start_time, 0.001)
+        rate = self.processed_count / elapsed
+        remaining = max(self.total_count - self.processed_count, 0)
+        logger.info(
+            'Processed %s of %s instances, %.1f files/s, %.1f MB/s, '
+            'ETA: %s' % (
+                self.processed_count,
+                self.total_count,
+                self.saved_count / elapsed,
+                self.saved_bytes / elapsed / 1024 / 1024,
+                datetime.timedelta(seconds=int(remaining / rate))
+                if rate else 'unknown',
+            ))
+
+    def save_file(self, storage, name):
+        """
+        Save a file with its unique name. Called in a worker thread, so it
+        must not touch the database. Return `None` if the file does not
+        exist.
+        """
+        if not storage.exists(name):
+            return None
+        # Local files are hard linked to their unique name instead of copied.
+        # The original name is deleted after the batch is updated.
+        if storage.is_local():
+            return storage.save_unique_from_path(name, storage.path(name))
+        with storage.open(name, 'rb') as content:
+            return storage.save_unique(name, content)
+
+    def deduplicate_batch(self, model, file_fields, batch):
+        """
+        Deduplicate a batch of `(pk, name, ...)` rows with two `UniqueFile`
+        queries and one update query, instead of several queries per row.
+        """
+        storages = dict(
+            (field_name, unlazy_storage(model._meta.get_field(field_name).storage))
+            for field_name in file_fields
+        )
+
+        # Find `UniqueFile` objects for all names in the batch, by unique name
+        # and by original name. Use the same object as `.last()` would when
+        # there are several for an original name.
+        names = set(name for row in batch for name in row[1:] if name)
+        deduplicated_names = set(
+            UniqueFile.objects
+            .filter(name__in=names)
+            .values_list('name', flat=True)
+        )
+        unique_names = {}
+        for original_name, unique_name in UniqueFile.objects \
+                .filter(original_name__in=names) \
+                .order_by('-pk') \
+                .values_list('original_name', 'name'):
+            unique_names[original_name] = unique_name
+
+        # Hash and save files that have not been deduplicated yet in worker
+        # threads, once for each name.
+        futures = {}
+        for row in batch:
+            for field_name, name in zip(file_fields, row[1:]):
+                key = (storages[field_name], name)
+                if name and name not in deduplicated_names and \
+                        name not in unique_names and key not in futures:
+                    futures[key] = self.executor.submit(
+                        self.save_file, storages[field_name], name)
+
+        updated_rows = []
+        updated_fields = set()
+        deleted_names = []
+
+        # Loop through file fields.
+        for row in batch:
+            pk = row[0]
+            values = dict(zip(file_fields, row[1:]))
+            updated = False
+
+            for field_name in file_fields:
+
+                storage = storages[field_name]
+                original_name = values[field_name]
+                unique_name = None
+
+                # Skip empty fields.
+                if not original_name:
+                    continue
+
+                # Assume that files with a matching `UniqueFile` object (by
+                # unique name) have already been deduplicated, with nothing
+                # left to do.
+                if original_name in deduplicated_names:
+                    self.skipped_count += 1
+                    logger.debug(
+                        '%s (%s), %s, %s: '
+                        'Already deduplicated: '
+                        '%s.%s (pk: %s) %s' % (
+                            self.updated_count,
+                            self.model_count,
+                            self.skipped_count,
+                            self.error_count,
+                            model._meta.model_name,
+                            field_name,
+                            pk,
+                            original_name,
+                        ))
+                    continue
+
+                # Assume that files with a matching `UniqueFile` object (by
+                # original name) have already been deduplicated, but we
+                # still need to update the field which is now pointing to a
+                # file that no longer exists.
+                if original_name in unique_names:
+                    unique_name = unique_names[original_name]
+
+                # Wait for the worker thread to save the file.
+                else:
+                    try:
+                        result = futures[(storage, original_name)].result()
+                    except:
+                        # Otherwise, log the exception and continue.
+                        self.error_count += 1
+                        logger.exception(
                             '%s (%s), %s, %s: '
-                            'Already deduplicated: '
-                            '%s.%s (pk: %s) %s -> %s' % (
-                                updated_count,
-                                model_count,
-                                skipped_count,
-                                error_count,
+                            'Unable to save: %s.%s (pk: %s) %s' % (
+                                self.updated_count,
+                                self.model_count,
+                                self.skipped_count,
+                                self.error_count,
                                 model._meta.model_name,
                                 field_name,
-                                instance.pk,
-                                unique_file.original_name,
-                                unique_file.name,
+                                pk,
+                                original_name,
                             ))
                         continue
 
-                    # Assume that files with a matching `UniqueFile` object (by
-                    # original name) have already been deduplicated, but we
-                    # still need to update the field which is now pointing to a
-                    # file that no longer exists.
-                    unique_file = UniqueFile.objects \
-                            .filter(original_name=original_name).last()
-                    if unique_file:
-                        unique_name = unique_file.name
-
                     # Skip fields with files that do not exist.
-                    elif not field.storage.exists(field.name):
-                        error_count += 1
+                    if result is None:
+                        self.error_count += 1
                         logger.warning(
                             '%s (%s), %s, %s: '
                             'File does not exist: %s.%s (pk: %s) %s' % (
-                                updated_count,
-                                model_count,
-                                skipped_count,
-                                error_count,
+                                self.updated_count,
+                                self.model_count,
+                                self.skipped_count,
+                                self.error_count,
                                 model._meta.model_name,
                                 field_name,
-                                instance.pk,
+                                pk,
                                 original_name,
                             ))
                         continue
 
-                    # Deduplicate.
-                    else:
-                        try:
-                            unique_name = field.storage.save(
-                                original_name, field.file)
-                        except:
-                            # Otherwise, log the exception and continue.
-                            error_count += 1
-                            logger.exception(
-                                '%s (%s), %s, %s: '
-                                'Unable to save: %s.%s (pk: %s) %s' % (
-                                    updated_count,
-                                    model_count,
-                                    skipped_count,
-                                    error_count,
-                                    model._meta.model_name,
-                                    field_name,
-                                    instance.pk,
-                                    original_name,
-                                ))
-                            continue
-                        finally:
-                            # Avoid keeping too many files open.
-                            field.close()
-
-                    # Something was updated.
+                    # Deduplicated. Create a record of the original name, and
+                    # later rows in this batch with the same name are now
+                    # already deduplicated.
+                    unique_name, content_hash, size = result
                     if unique_name != original_name:
-                        setattr(instance, field_name, unique_name)
-                        updated = True
-                        updated_count += 1
-                        model_count += 1
-                        logger.info(
-                            '%s (%s), %s, %s: '
-                            'Deduplicated: %s.%s (pk: %s) %s -> %s' % (
-                                updated_count,
-                                model_count,
-                                skipped_count,
-                                error_count,
-                                model._meta.model_name,
-                                field_name,
-                                instance.pk,
-                                original_name,
-                                unique_name,
-                            ))
-
-                        # Cleanup original file and source directory.
-                        field.storage.delete(original_name)
-                        try:
-                            os.removedirs(field.storage.path(
-                                posixpath.dirname(original_name)))
-                        except (NotImplementedError, OSError):
-                            pass
-
-                    # Nothing updated. This can happen when no matching
-                    # `UniqueFile` exists for an already uniquely named file.
-                    else:
-                        skipped_count += 1
-                        logger.debug(
-                            '%s (%s), %s, %s: '
-                            'Already uniquely named: %s.%s (pk: %s) %s' % (
-                                updated_count,
-                                model_count,
-                                skipped_count,
-                                error_count,
-                                model._meta.model_name,
-                                field_name,
-                                instance.pk,
-                                original_name,
-                            ))
-
-                # Save instance after all fields have been deduplicated.
-                if updated:
-                    instance.save()
+                        storage.record_unique_file(
+                            unique_name, original_name, content_hash, size)
+                    unique_names[original_name] = unique_name
+                    self.saved_count += 1
+                    self.saved_bytes += size or 0
+
+                # Something was updated.
+                if unique_name != original_name:
+                    values[field_name] = unique_name
+                    updated = True
+                    updated_fields.add(field_name)
+                    self.updated_count += 1
+                    self.model_count += 1
+                    logger.info(
+                        '%s (%s), %s, %s: '
+                        'Deduplicated: %s.%s (pk: %s) %s -> %s' % (
+                            self.updated_count,
+                            self.model_count,
+                            self.skipped_count,
+                            self.error_count,
+                            model._meta.model_name,
+                            field_name,
+                            pk,
+                            original_name,
+                            unique_name,
+                        ))
+                    deleted_names.append((storage, original_name))
+
+                # Nothing updated. This can happen when no matching
+                # `UniqueFile` exists for an already uniquely named file.
+                else:
+                    self.skipped_count += 1
+                    logger.debug(
+                        '%s (%s), %s, %s: '
+                        'Already uniquely named: %s.%s (pk: %s) %s' % (
+                            self.updated_count,
+                            self.model_count,
+                            self.skipped_count,
+                            self.error_count,
+                            model._meta.model_name,
+                            field_name,
+                            pk,
+                            original_name,
+                        ))
 
-        # Done.
-        logger.info('Updated: %s, Skipped: %s, Errors: %s' % (
-            updated_count,
-            skipped_count,
-            error_count,
-        ))
+            if updated:
+                updated_rows.append((pk, values))
+
+        # Save all instances in the batch after all fields have been
+        # deduplicated.
+        self.update_rows(model, updated_rows, sorted(updated_fields))
+
+        # Cleanup original files and source directories, once nothing refers
+        # to them.
+        for storage, original_name in deleted_names:
+            storage.delete(original_name)
+            try:
+                os.removedirs(storage.path(posixpath.dirname(original_name)))
+            except (NotImplementedError, OSError):
+                pass
+
+    def update_rows(self, model, rows, field_names):
+        """
+        Update file fields for `(pk, values)` rows with a single query where
+        `bulk_update()` is available (Django 2.2+). Model `save()` methods
+        and signals are not called.
+        """
+        if not rows:
+            return
+        manager = model._default_manager
+        if hasattr(manager, 'bulk_update'):
+            manager.bulk_update(
+                [
+                    model(pk=pk, **dict(
+                        (field_name, values[field_name])
+                        for field_name in field_names
+                    ))
+                    for pk, values in rows
+                ],
+                field_names,
+            )
+        else:
+            for pk, values in rows:
+                manager.filter(pk=pk).update(**dict(
+                    (field_name, values[field_name])
+                    for field_name in field_names
+                ))
 
 
 # Allow graceful termination of current loop iteration.
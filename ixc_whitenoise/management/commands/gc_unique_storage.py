@@ -0,0 +1,256 @@
+import datetime
+import errno
+import logging
+import os
+import time
+
+from django.core.files.storage import default_storage, get_storage_class
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from ixc_whitenoise.cache import reset_exists_filter, resolution_cache
+from ixc_whitenoise.models import UniqueFile
+from ixc_whitenoise.storage import \
+    DEDUPE_PATH_PREFIX, UniqueMixin, unlazy_storage
+from ixc_whitenoise.utils import \
+    external_sort, get_unique_file_fields, iter_unique_names, \
+    quarantine_file, remove_empty_directories
+
+logger = logging.getLogger(__name__)
+
+# Compressed variants are live when their uncompressed file is live.
+VARIANT_SUFFIXES = ('.gz', '.br')
+
+
+class Command(BaseCommand):
+    help = 'Delete deduplicated files that are no longer referenced by any ' \
+        'file field that uses `UniqueMixin`, and their `UniqueFile` objects.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--grace-days', default=7, type=float,
+            help='Keep files changed, and names recorded in `UniqueFile` '
+            'objects seen, within this many days. Default: 7.')
+        parser.add_argument(
+            '--quarantine',
+            help='Move unreferenced files to this local directory instead of '
+            'deleting them.')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Log the files that would be deleted, without deleting them.')
+        parser.add_argument(
+            '--batch-size', default=1000, type=int,
+            help='Number of files to delete before deleting their '
+            '`UniqueFile` objects.')
+        parser.add_argument(
+            '--chunk-size', default=1000000, type=int,
+            help='Number of names to sort in memory before merging on disk.')
+        parser.add_argument(
+            '--storage',
+            help='Dotted path to the `UniqueMixin` storage class to collect. '
+            'Default: `DEFAULT_FILE_STORAGE`.')
+
+    def handle(self, *args, **options):
+        if options['storage']:
+            storage = get_storage_class(options['storage'])()
+        else:
+            storage = unlazy_storage(default_storage)
+        if not isinstance(storage, UniqueMixin):
+            raise CommandError('%r does not use `UniqueMixin`.' % storage)
+
+        self.storage = storage
+        self.options = options
+        self.cutoff = time.time() - options['grace_days'] * 24 * 60 * 60
+        self.deleted_count = 0
+        self.deleted_bytes = 0
+        self.recent_count = 0
+        self.error_count = 0
+
+        # Both streams are sorted on disk, so memory use does not depend on
+        # the number of names.
+        stored_names = external_sort(
+            iter_unique_names(storage), options['chunk_size'])
+        live_names = external_sort(
+            self.iter_live_names(), options['chunk_size'])
+
+        batch = []
+        for name in self.iter_unreferenced(stored_names, live_names):
+            batch.append(name)
+            if len(batch) >= options['batch_size']:
+                self.collect_batch(batch)
+                batch = []
+        if batch:
+            self.collect_batch(batch)
+
+        # Done.
+        logger.info('Deleted: %s (%.1f MB), Recent: %s, Errors: %s' % (
+            self.deleted_count,
+            self.deleted_bytes / 1024 / 1024,
+            self.recent_count,
+            self.error_count,
+        ))
+
+    def iter_live_names(self):
+        """
+        Yield all deduplicated names in file fields that use `UniqueMixin`,
+        and in `UniqueFile` objects seen within the grace period, which may
+        belong to instances that have not been saved yet. Also yield their
+        compressed variants.
+        """
+        for queryset in self.get_live_querysets(
+                'startswith', DEDUPE_PATH_PREFIX + '/'):
+            for name in queryset.iterator():
+                yield name
+                for suffix in VARIANT_SUFFIXES:
+                    yield name + suffix
+
+    def get_live_querysets(self, lookup, value):
+        """
+        Return querysets of live names in `UniqueFile` objects seen within
+        the grace period and in file fields that use `UniqueMixin`, filtered
+        by a lookup.
+        """
+        querysets = [
+            UniqueFile.objects
+            .filter(**{
+                'last_seen__gte': timezone.now() - datetime.timedelta(
+                    days=self.options['grace_days']),
+                'name__%s' % lookup: value,
+            })
+            .values_list('name', flat=True)
+        ]
+        for model, field_names in get_unique_file_fields():
+            for field_name in field_names:
+                querysets.append(
+                    model._default_manager
+                    .filter(**{'%s__%s' % (field_name, lookup): value})
+                    .order_by()
+                    .values_list(field_name, flat=True)
+                )
+        return querysets
+
+    def get_live_names(self, names):
+        """
+        Return the names in a batch that are live now, or whose uncompressed
+        file is live. Instances may have been saved with existing files,
+        which are not modified, after live names were read.
+        """
+        base_names = {}
+        for name in names:
+            base_names[name] = name
+            for suffix in VARIANT_SUFFIXES:
+                if name.endswith(suffix):
+                    base_names[name] = name[:-len(suffix)]
+        live_names = set()
+        for queryset in self.get_live_querysets(
+                'in', sorted(set(base_names.values()))):
+            live_names.update(queryset)
+        return set(
+            name for name in names if base_names[name] in live_names)
+
+    def iter_unreferenced(self, stored_names, live_names):
+        """
+        Yield stored names that are not live, from two sorted streams.
+        """
+        live_name = next(live_names, None)
+        for name in stored_names:
+            while live_name is not None and live_name < name:
+                live_name = next(live_names, None)
+            if name != live_name:
+                yield name
+
+    def get_stat(self, name):
+        """
+        Return the time a file was last changed and its size, or `None` if it
+        no longer exists. Local files use the inode change time, which is
+        updated when an existing file is linked or moved into place, unlike
+        its modified time.
+        """
+        try:
+            if self.storage.is_local():
+                stat_result = os.stat(self.storage.path(name))
+                return stat_result.st_ctime, stat_result.st_size
+            return (
+                self.storage.get_modified_time(name).timestamp(),
+                self.storage.size(name),
+            )
+        except (IOError, OSError):
+            return None
+
+    def collect_batch(self, names):
+        candidates = []
+        for name in names:
+            stat = self.get_stat(name)
+            if stat is None:
+                continue
+            changed_time, size = stat
+
+            # Keep recently changed files, which may have been saved after
+            # live names were read.
+            if changed_time >= self.cutoff:
+                self.recent_count += 1
+                logger.debug('Recently changed: %s' % name)
+                continue
+
+            candidates.append((name, size))
+
+        # Check again right before deleting, for names that became live since
+        # live names were read.
+        live_names = self.get_live_names([name for name, size in candidates])
+
+        collected = []
+        for name, size in candidates:
+            if name in live_names:
+                self.recent_count += 1
+                logger.debug('Recently referenced: %s' % name)
+                continue
+
+            if self.options['dry_run']:
+                logger.info('Would delete: %s' % name)
+                continue
+
+            try:
+                if self.options['quarantine']:
+                    quarantine_file(
+                        self.storage, name, self.options['quarantine'])
+                else:
+                    self.delete_file(name)
+            except (IOError, OSError):
+                self.error_count += 1
+                logger.exception('Unable to delete: %s' % name)
+                continue
+
+            collected.append(name)
+            self.deleted_count += 1
+            self.deleted_bytes += size
+            logger.info('%s: %s %s' % (
+                self.deleted_count,
+                'Quarantined' if self.options['quarantine'] else 'Deleted',
+                name,
+            ))
+
+        # Delete `UniqueFile` objects for collected names, so their original
+        # names are no longer redirected to missing files.
+        unique_files = UniqueFile.objects.filter(name__in=collected)
+        original_names = set(
+            unique_files.values_list('original_name', flat=True))
+        unique_files.delete()
+        for original_name in original_names:
+            resolution_cache.invalidate(original_name)
+
+        # This and other processes may remember collected names as existing, and
+        # skip saving them again.
+        if collected:
+            reset_exists_filter(self.storage.exists_filter_path)
+            self.storage.exists_cache.clear()
+
+    def delete_file(self, name):
+        if not self.storage.is_local():
+            self.storage.delete(name)
+            return
+        try:
+            os.unlink(self.storage.path(name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        remove_empty_directories(self.storage, name)
@@ -0,0 +1,231 @@
+import logging
+import posixpath
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.files import File
+from django.core.files.storage import default_storage, get_storage_class
+from django.core.management.base import BaseCommand, CommandError
+
+from ixc_whitenoise.cache import reset_exists_filter
+from ixc_whitenoise.hashes import HASH_ALGORITHMS, new_hash
+from ixc_whitenoise.models import UniqueFile
+from ixc_whitenoise.storage import \
+    HASH_ALGORITHM, HASH_CHUNK_SIZE, HASH_LENGTH, ORIGINAL_BASENAME, \
+    UniqueMixin, unlazy_storage
+from ixc_whitenoise.utils import iter_unique_names, quarantine_file
+
+logger = logging.getLogger(__name__)
+
+HEX_RE = re.compile(r'^[0-9a-f]+$')
+
+
+class RateLimiter(object):
+    """
+    Limit the combined read rate of all worker threads, in bytes per second.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_time = time.time()
+
+    def consume(self, size):
+        """
+        Wait until `size` more bytes can be read.
+        """
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            start = max(self.next_time, now)
+            self.next_time = start + float(size) / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+class Command(BaseCommand):
+    help = 'Verify that deduplicated files still match the content hash in ' \
+        'their name.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', default=2, type=int,
+            help='Number of threads to hash files with.')
+        parser.add_argument(
+            '--max-rate', default=0, type=float,
+            help='Maximum combined read rate for all workers, in MB/s. '
+            'Default: 0 (unlimited).')
+        parser.add_argument(
+            '--sample', default=1, type=float,
+            help='Fraction of files to verify, chosen at random. Default: 1 '
+            '(all files).')
+        parser.add_argument(
+            '--quarantine',
+            help='Move corrupt files to this local directory.')
+        parser.add_argument(
+            '--batch-size', default=1000, type=int,
+            help='Number of files to verify at a time.')
+        parser.add_argument(
+            '--storage',
+            help='Dotted path to the `UniqueMixin` storage class to scrub. '
+            'Default: `DEFAULT_FILE_STORAGE`.')
+
+    def handle(self, *args, **options):
+        if options['storage']:
+            storage = get_storage_class(options['storage'])()
+        else:
+            storage = unlazy_storage(default_storage)
+        if not isinstance(storage, UniqueMixin):
+            raise CommandError('%r does not use `UniqueMixin`.' % storage)
+
+        self.storage = storage
+        self.options = options
+        self.rate_limiter = RateLimiter(options['max_rate'] * 1024 * 1024)
+        # Hex digest length -> algorithms, to verify full hashes in names
+        # without a `UniqueFile` object, which may have been saved with a
+        # previous algorithm.
+        self.algorithms_by_length = {}
+        for algorithm in sorted(HASH_ALGORITHMS):
+            self.algorithms_by_length.setdefault(
+                len(new_hash(algorithm).hexdigest()), []).append(algorithm)
+        self.verified_count = 0
+        self.verified_bytes = 0
+        self.corrupt_count = 0
+        self.skipped_count = 0
+        self.error_count = 0
+        self.start_time = time.time()
+
+        self.executor = ThreadPoolExecutor(max_workers=options['workers'])
+        try:
+            batch = []
+            for name in iter_unique_names(storage):
+                if options['sample'] < 1 and \
+                        random.random() >= options['sample']:
+                    continue
+                batch.append(name)
+                if len(batch) >= options['batch_size']:
+                    self.scrub_batch(batch)
+                    batch = []
+            if batch:
+                self.scrub_batch(batch)
+        finally:
+            self.executor.shutdown()
+
+        # Done.
+        logger.info('Verified: %s, Corrupt: %s, Skipped: %s, Errors: %s' % (
+            self.verified_count,
+            self.corrupt_count,
+            self.skipped_count,
+            self.error_count,
+        ))
+
+    def get_expected_hash(self, name, unique_files):
+        """
+        Return the expected (full or abbreviated) content hash for a name and
+        the algorithms it may have been created with, or `None` if the name
+        has no content hash, e.g. a compressed variant.
+        """
+        basename = posixpath.splitext(posixpath.basename(name))[0]
+        unique_hash = self.storage.get_unique_hash(basename)
+        if not HEX_RE.match(unique_hash):
+            return None
+
+        # Abbreviated hashes are verified against the full hash recorded in
+        # `UniqueFile`, when there is one.
+        if name in unique_files:
+            content_hash, hash_algorithm = unique_files[name]
+            if content_hash.startswith(unique_hash):
+                return content_hash, [hash_algorithm or HASH_ALGORITHM]
+
+        if ORIGINAL_BASENAME:
+            if len(unique_hash) != HASH_LENGTH:
+                return None
+            return unique_hash, [HASH_ALGORITHM]
+        algorithms = self.algorithms_by_length.get(len(unique_hash))
+        if not algorithms:
+            return None
+        return unique_hash, algorithms
+
+    def hash_file(self, name, algorithms):
+        """
+        Return hex digests for a file, for each algorithm. Called in a worker
+        thread.
+        """
+        hashes = [new_hash(algorithm) for algorithm in algorithms]
+        chunk_size = HASH_CHUNK_SIZE or File.DEFAULT_CHUNK_SIZE
+        size = 0
+        with self.storage.open(name, 'rb') as f:
+            while True:
+                self.rate_limiter.consume(chunk_size)
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                for content_hash in hashes:
+                    content_hash.update(chunk)
+        return [content_hash.hexdigest() for content_hash in hashes], size
+
+    def scrub_batch(self, names):
+        unique_files = {}
+        for name, content_hash, hash_algorithm in UniqueFile.objects \
+                .filter(name__in=names) \
+                .exclude(content_hash='') \
+                .values_list('name', 'content_hash', 'hash_algorithm'):
+            unique_files[name] = (content_hash, hash_algorithm)
+
+        quarantined = False
+        futures = []
+        for name in names:
+            expected = self.get_expected_hash(name, unique_files)
+            if expected is None:
+                self.skipped_count += 1
+                logger.debug('No content hash: %s' % name)
+                continue
+            futures.append((name, expected[0], self.executor.submit(
+                self.hash_file, name, expected[1])))
+
+        for name, expected_hash, future in futures:
+            try:
+                digests, size = future.result()
+            except (IOError, OSError):
+                self.error_count += 1
+                logger.exception('Unable to read: %s' % name)
+                continue
+            self.verified_count += 1
+            self.verified_bytes += size
+            if any(digest.startswith(expected_hash) for digest in digests):
+                continue
+
+            self.corrupt_count += 1
+            logger.error('Corrupt: %s (expected %s, got %s)' % (
+                name,
+                expected_hash,
+                ', '.join(digests),
+            ))
+            if self.options['quarantine']:
+                try:
+                    quarantine_file(
+                        self.storage, name, self.options['quarantine'])
+                except (IOError, OSError):
+                    self.error_count += 1
+                    logger.exception('Unable to quarantine: %s' % name)
+                else:
+                    quarantined = True
+                    logger.info('Quarantined: %s' % name)
+
+        # This and other processes may remember quarantined names as existing, and
+        # skip saving them again.
+        if quarantined:
+            reset_exists_filter(self.storage.exists_filter_path)
+            self.storage.exists_cache.clear()
+
+        elapsed = max(time.time() - self.start_time, 0.001)
+        logger.info('Verified %s files, %.1f MB/s, %s corrupt' % (
+            self.verified_count,
+            self.verified_bytes / elapsed / 1024 / 1024,
+            self.corrupt_count,
+        ))
@@ -0,0 +1,288 @@
+import errno
+import logging
+import os
+import shutil
+
+from django.core.files.storage import default_storage, get_storage_class
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Case, CharField, F, Value, When
+
+from ixc_whitenoise.cache import resolution_cache
+from ixc_whitenoise.models import UniqueFile, get_names_hash
+from ixc_whitenoise.storage import \
+    DEDUPE_PATH_PREFIX, UniqueMixin, unlazy_storage
+from ixc_whitenoise.utils import get_unique_file_fields
+
+logger = logging.getLogger(__name__)
+
+# Compressed variants are moved with their uncompressed file.
+VARIANT_SUFFIXES = ('', '.gz', '.br')
+
+
+class Command(BaseCommand):
+    help = 'Move deduplicated files to the configured shard layout and ' \
+        'update `UniqueFile` objects and file fields that refer to them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', default=1000, type=int,
+            help='Number of names to move in each batch.')
+        parser.add_argument(
+            '--from-depth', default=0, type=int,
+            help='Shard depth of the existing layout. Default: 0 (flat).')
+        parser.add_argument(
+            '--from-width', default=None, type=int,
+            help='Shard width of the existing layout. Default: '
+            '`IXC_WHITENOISE_SHARD_WIDTH`.')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Log the files that would be moved, without moving them.')
+        parser.add_argument(
+            '--storage',
+            help='Dotted path to the `UniqueMixin` storage class for '
+            '`UniqueFile` objects. Default: `DEFAULT_FILE_STORAGE`.')
+
+    def handle(self, *args, **options):
+        if options['storage']:
+            storage = get_storage_class(options['storage'])()
+        else:
+            storage = unlazy_storage(default_storage)
+        if not isinstance(storage, UniqueMixin):
+            raise CommandError('%r does not use `UniqueMixin`.' % storage)
+        if options['from_width'] is None:
+            options['from_width'] = storage.shard_width
+        if (options['from_depth'], options['from_width']) == \
+                (storage.shard_depth, storage.shard_width):
+            raise CommandError(
+                'The existing layout is the same as the configured layout.')
+
+        self.options = options
+        self.unique_file_fields = get_unique_file_fields()
+        self.moved_count = 0
+        self.error_count = 0
+
+        # Move names recorded in `UniqueFile` objects.
+        last_pk = 0
+        while True:
+            batch = list(
+                UniqueFile.objects
+                .filter(pk__gt=last_pk)
+                .order_by('pk')
+                .values_list('pk', 'name')[:options['batch_size']]
+            )
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+            self.reshard(storage, set(name for pk, name in batch))
+            logger.info('Moved %s files up to `UniqueFile` pk %s.' % (
+                self.moved_count,
+                last_pk,
+            ))
+
+        # Move deduplicated names in file fields that have no `UniqueFile`
+        # object, e.g. files saved with a name that was already unique.
+        for model, field_names in self.unique_file_fields:
+            for field_name in field_names:
+                field_storage = unlazy_storage(
+                    model._meta.get_field(field_name).storage)
+                last_pk = None
+                while True:
+                    queryset = model._default_manager \
+                        .filter(**{
+                            '%s__startswith' % field_name:
+                                DEDUPE_PATH_PREFIX + '/',
+                        }) \
+                        .order_by('pk') \
+                        .values_list('pk', field_name)
+                    if last_pk is not None:
+                        queryset = queryset.filter(pk__gt=last_pk)
+                    batch = list(queryset[:options['batch_size']])
+                    if not batch:
+                        break
+                    last_pk = batch[-1][0]
+                    self.reshard(field_storage, set(
+                        name for pk, name in batch))
+                logger.info('Moved %s files up to %s.%s pk %s.' % (
+                    self.moved_count,
+                    model._meta.label,
+                    field_name,
+                    last_pk,
+                ))
+
+        # Done.
+        logger.info('Moved: %s, Errors: %s' % (
+            self.moved_count,
+            self.error_count,
+        ))
+
+    def reshard(self, storage, names):
+        """
+        Move a batch of names to the configured layout. New names are created
+        before `UniqueFile` objects and file fields are updated, and old names
+        are only removed after, so every name in the database always exists.
+        Old names are recorded as original names of the new names, so
+        `WhiteNoiseMiddleware` redirects requests for them.
+        """
+        moves = {}
+        for name in sorted(names):
+            new_name = storage.get_resharded_name(
+                name, self.options['from_depth'], self.options['from_width'])
+            if new_name == name:
+                continue
+            if self.options['dry_run']:
+                logger.info('Would move: %s -> %s' % (name, new_name))
+                continue
+            try:
+                if self.copy_file(storage, name, new_name):
+                    moves[name] = new_name
+            except (IOError, OSError):
+                self.error_count += 1
+                logger.exception('Unable to move: %s -> %s' % (name, new_name))
+        if not moves:
+            return
+
+        with transaction.atomic():
+            # Delete `UniqueFile` objects that would duplicate an existing
+            # object for the new name, then rename the rest.
+            existing = set(
+                UniqueFile.objects
+                .filter(name__in=moves.values())
+                .values_list('name', 'original_name')
+            )
+            unique_files = list(
+                UniqueFile.objects
+                .filter(name__in=moves)
+                .values_list('pk', 'name', 'original_name')
+            )
+            UniqueFile.objects.filter(pk__in=[
+                pk for pk, name, original_name in unique_files
+                if (moves[name], original_name) in existing
+            ]).delete()
+            UniqueFile.objects \
+                .filter(name__in=moves) \
+                .update(
+                    name=self.get_rename_expression('name', moves),
+                    names_hash=Case(
+                        *[
+                            When(pk=pk, then=Value(get_names_hash(
+                                moves[name], original_name)))
+                            for pk, name, original_name in unique_files
+                        ],
+                        default=F('names_hash'),
+                        output_field=CharField(),
+                    ),
+                )
+
+            # Update file fields.
+            for model, field_names in self.unique_file_fields:
+                for field_name in field_names:
+                    model._default_manager \
+                        .filter(**{'%s__in' % field_name: list(moves)}) \
+                        .update(**{
+                            field_name:
+                                self.get_rename_expression(field_name, moves),
+                        })
+
+            # Record old names as original names of the new names, so old
+            # URLs (e.g. cached by a CDN or in HTML) are redirected.
+            hashes = {}
+            for name, content_hash, hash_algorithm, size in UniqueFile.objects \
+                    .filter(name__in=moves.values()) \
+                    .exclude(content_hash='') \
+                    .values_list(
+                        'name', 'content_hash', 'hash_algorithm', 'size'):
+                hashes[name] = (content_hash, hash_algorithm, size)
+            redirects = []
+            for name, new_name in sorted(moves.items()):
+                content_hash, hash_algorithm, size = \
+                    hashes.get(new_name, ('', '', None))
+                redirects.append(UniqueFile(
+                    name=new_name,
+                    original_name=name,
+                    content_hash=content_hash,
+                    hash_algorithm=hash_algorithm,
+                    size=size,
+                    names_hash=get_names_hash(new_name, name),
+                ))
+            UniqueFile.objects.bulk_create(redirects, ignore_conflicts=True)
+
+        for pk, name, original_name in unique_files:
+            resolution_cache.invalidate(original_name)
+        for name in moves:
+            resolution_cache.invalidate(name)
+        for name, new_name in moves.items():
+            self.delete_file(storage, name)
+            self.moved_count += 1
+            logger.debug('Moved: %s -> %s' % (name, new_name))
+
+    def get_rename_expression(self, field_name, moves):
+        return Case(
+            *[
+                When(**{field_name: name, 'then': Value(new_name)})
+                for name, new_name in moves.items()
+            ],
+            default=F(field_name),
+            output_field=CharField(),
+        )
+
+    def copy_file(self, storage, name, new_name):
+        """
+        Create `new_name` with the content of `name`, and its compressed
+        variants. Local files are hard linked, or copied when hard links are
+        not supported. Return `False` if `name` does not exist.
+        """
+        if not storage.is_local():
+            if not storage.exists(name):
+                return self.log_missing(name, storage.exists(new_name))
+            if not storage.exists(new_name):
+                with storage.open(name, 'rb') as content:
+                    # Bypass `UniqueMixin._save()`, which would record the
+                    # new name as a new `UniqueFile`.
+                    super(UniqueMixin, storage)._save(new_name, content)
+            return True
+
+        path = storage.path(name)
+        new_path = storage.path(new_name)
+        if not os.path.exists(path):
+            return self.log_missing(name, os.path.exists(new_path))
+        storage._makedirs(os.path.dirname(new_path))
+        for suffix in VARIANT_SUFFIXES:
+            if not os.path.exists(path + suffix):
+                continue
+            try:
+                os.link(path + suffix, new_path + suffix)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    shutil.copy2(path + suffix, new_path + suffix)
+        return True
+
+    def delete_file(self, storage, name):
+        """
+        Delete the old name, its compressed variants and empty directories.
+        """
+        if not storage.is_local():
+            storage.delete(name)
+            return
+        path = storage.path(name)
+        for suffix in VARIANT_SUFFIXES:
+            try:
+                os.unlink(path + suffix)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        try:
+            os.removedirs(os.path.dirname(path))
+        except OSError:
+            pass
+
+    def log_missing(self, name, new_name_exists):
+        """
+        Log a missing file. Return `True` to update references to it anyway
+        when it has already been moved.
+        """
+        if new_name_exists:
+            return True
+        self.error_count += 1
+        logger.warning('File does not exist: %s' % name)
+        return False
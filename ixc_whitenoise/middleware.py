@@ -1,4 +1,6 @@
+import os
 import posixpath
+import time
 
 from django.core.exceptions import ImproperlyConfigured
 from django.core.files.storage import default_storage
@@ -6,13 +8,18 @@ from django.http import HttpResponseRedirect
 from django.utils.functional import empty
 from six.moves.urllib.parse import urlparse
 from whitenoise.middleware import WhiteNoiseMiddleware
+from whitenoise.responders import MissingFileError, StaticFile
+from wsgiref.headers import Headers
 
 try:
     from whitenoise.string_utils import ensure_leading_trailing_slash  # >=4.0b1
 except ImportError:
     from whitenoise.utils import ensure_leading_trailing_slash
 
-from ixc_whitenoise.storage import UniqueMixin, unlazy_storage
+from ixc_whitenoise.cache import LRUCache, resolution_cache
+from ixc_whitenoise.fileindex import FileIndex, get_index_path
+from ixc_whitenoise.storage import \
+    DEDUPE_PATH_PREFIX, LocalCacheMixin, UniqueMixin, unlazy_storage
 
 
 class StripVaryHeaderMiddleware(object):
@@ -37,13 +44,44 @@ class StripVaryHeaderMiddleware(object):
 # Redirect requests for deduplicated unique storage.
 class WhiteNoiseMiddleware(WhiteNoiseMiddleware):
 
-    config_attrs = WhiteNoiseMiddleware.config_attrs + ('media_prefix', )
+    config_attrs = WhiteNoiseMiddleware.config_attrs + (
+        'media_prefix', 'lazy_media', 'lazy_media_cache_size',
+        'file_index_cache_size', 'compress_media_pending_seconds',
+        'missing_media_cache_ttl')
     media_prefix = None
+    # Find media files on first request instead of scanning `MEDIA_ROOT` at
+    # startup.
+    lazy_media = False
+    # Maximum number of unique media files to keep in each process.
+    lazy_media_cache_size = 10000
+    # Maximum number of files found in shared file indexes to keep in each
+    # process.
+    file_index_cache_size = 10000
+    # Seconds after a unique media file is saved during which its compressed
+    # variants may still be written, so it is not cached without them.
+    compress_media_pending_seconds = 60
+    # Seconds to remember unique media files that are missing from remote
+    # storage with `LocalCacheMixin`, so repeated 404s do not query storage.
+    missing_media_cache_ttl = 60
 
     def __init__(self, *args, **kwargs):
+        # Populated by `add_files()`, which is called by the superclass.
+        self.file_indexes = []
         super(WhiteNoiseMiddleware, self).__init__(*args, **kwargs)
+        self.media_files = LRUCache(self.lazy_media_cache_size)
+        self.indexed_files = LRUCache(self.file_index_cache_size)
+        self.missing_media_files = LRUCache(
+            self.lazy_media_cache_size, self.missing_media_cache_ttl)
+        # Media is looked up in the index first, if available, then on demand,
+        # because files may have been uploaded since the index was built.
+        self.find_media_on_demand = self.lazy_media
         if self.media_root:
-            self.add_files(self.media_root, prefix=self.media_prefix)
+            index = self.get_file_index(self.media_root)
+            if index is not None:
+                self.add_file_index(self.media_root, self.media_prefix, index)
+                self.find_media_on_demand = True
+            elif not self.lazy_media:
+                self.add_files(self.media_root, prefix=self.media_prefix)
 
     def check_settings(self, settings):
         super(WhiteNoiseMiddleware, self).check_settings(settings)
@@ -60,6 +98,182 @@ class WhiteNoiseMiddleware(WhiteNoiseMiddleware):
         self.media_prefix = ensure_leading_trailing_slash(self.media_prefix)
         self.media_root = settings.MEDIA_ROOT
 
+    def add_files(self, root, prefix=None):
+        """
+        Use a shared file index instead of scanning `STATIC_ROOT` or
+        `MEDIA_ROOT`, if one has been built.
+        """
+        index = self.get_file_index(root)
+        if index is not None:
+            self.add_file_index(root, prefix, index)
+        else:
+            super(WhiteNoiseMiddleware, self).add_files(root, prefix=prefix)
+
+    def add_file_index(self, root, prefix, index):
+        root = os.path.abspath(root).rstrip(os.path.sep) + os.path.sep
+        prefix = ensure_leading_trailing_slash(prefix)
+        self.file_indexes.append((root, prefix, index))
+
+    def get_file_index(self, root):
+        """
+        Return the shared file index for `STATIC_ROOT` or `MEDIA_ROOT`, or
+        `None` if there is no index for `root`.
+        """
+        if self.autorefresh:
+            return None
+        for name, index_root in (
+                ('static', self.static_root), ('media', self.media_root)):
+            if index_root and \
+                    os.path.abspath(root) == os.path.abspath(index_root):
+                index_path = get_index_path(name)
+                if index_path and os.path.exists(index_path):
+                    return FileIndex(index_path)
+        return None
+
+    def find_indexed_file(self, url):
+        """
+        Find a file in the shared file indexes. Files are cached until their
+        index is rebuilt.
+        """
+        for root, prefix, index in self.file_indexes:
+            if not url.startswith(prefix):
+                continue
+            name = url[len(prefix):]
+            if self.index_file and (not name or name.endswith('/')):
+                name += self.index_file
+            key = (url, index.stat_key)
+            static_file = self.indexed_files.get(key)
+            if static_file is None:
+                entry = index.get(name)
+                if entry is None:
+                    continue
+                static_file = self.get_indexed_static_file(
+                    os.path.join(root, *name.split('/')), url, index, entry)
+                self.indexed_files.set(key, static_file)
+            return static_file
+        return None
+
+    def get_indexed_static_file(self, path, url, index, entry):
+        """
+        Like `get_static_file()`, but use the content type and file stats from
+        the index instead of the filesystem.
+        """
+        headers = Headers([])
+        if entry.content_type.startswith('text/') or \
+                entry.content_type == 'application/javascript':
+            params = {'charset': str(self.charset)}
+        else:
+            params = {}
+        headers.add_header('Content-Type', str(entry.content_type), **params)
+        self.add_cache_headers(headers, path, url)
+        if self.allow_all_origins:
+            headers['Access-Control-Allow-Origin'] = '*'
+        if self.add_headers_function:
+            self.add_headers_function(headers, path, url)
+        return StaticFile(
+            path,
+            headers.items(),
+            stat_cache=index.get_stat_cache(path, entry),
+            encodings={'gzip': path + '.gz', 'br': path + '.br'},
+        )
+
+    def process_request(self, request):
+        response = super(WhiteNoiseMiddleware, self).process_request(request)
+        if response is None and self.file_indexes:
+            static_file = self.find_indexed_file(request.path_info)
+            if static_file is not None:
+                response = self.serve(static_file, request)
+        if response is None and self.find_media_on_demand and \
+                self.media_root and \
+                request.path_info.startswith(self.media_prefix):
+            static_file = self.find_media_file(request.path_info)
+            if static_file is not None:
+                response = self.serve(static_file, request)
+        if response is None and \
+                request.path_info.startswith(self.media_prefix):
+            static_file = self.find_cached_media_file(request.path_info)
+            if static_file is not None:
+                response = self.serve(static_file, request)
+        return response
+
+    def find_media_file(self, url):
+        """
+        Find a media file on demand. Unique media files never change, so they
+        are cached without revalidation.
+        """
+        static_file = self.media_files.get(url)
+        if static_file is not None:
+            return static_file
+        if not self.url_is_canonical(url):
+            return None
+        root = os.path.abspath(self.media_root).rstrip(os.path.sep) + \
+            os.path.sep
+        path = os.path.join(root, url[len(self.media_prefix):])
+        # Do not serve files outside `MEDIA_ROOT`.
+        if os.path.commonprefix((root, path)) != root:
+            return None
+        try:
+            static_file = self.find_file_at_path(path, url)
+        except MissingFileError:
+            return None
+        if self.is_unique_media(url) and not self.autorefresh and \
+                not self.is_compression_pending(static_file, path, url):
+            self.media_files.set(url, static_file)
+        return static_file
+
+    def is_compression_pending(self, static_file, path, url):
+        """
+        Return `True` if compressed variants of a unique media file that was
+        saved recently may not have been written yet.
+        """
+        if len(getattr(static_file, 'alternatives', ())) > 1:
+            return False
+        storage = unlazy_storage(default_storage)
+        name = url[len(self.media_prefix):]
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            return False
+        if not storage.should_compress_media(name, stat_result.st_size):
+            return False
+        # The inode change time is updated when the file is linked or moved
+        # into place, unlike its modification time.
+        return time.time() - stat_result.st_ctime < \
+            self.compress_media_pending_seconds
+
+    def find_cached_media_file(self, url):
+        """
+        Find a unique media file in the local disk cache of a remote default
+        storage class with `LocalCacheMixin`, downloading it on a miss. Files
+        missing from remote storage are cached too.
+        """
+        storage = unlazy_storage(default_storage)
+        if not isinstance(storage, LocalCacheMixin) or \
+                not self.is_unique_media(url) or \
+                not self.url_is_canonical(url) or \
+                url in self.missing_media_files:
+            return None
+        try:
+            path = storage.cached_path(url[len(self.media_prefix):])
+        except (IOError, OSError):
+            return None
+        if path is None:
+            self.missing_media_files.set(url, True)
+            return None
+        # Not cached in memory, because the file may be evicted from disk.
+        try:
+            return self.find_file_at_path(path, url)
+        except MissingFileError:
+            return None
+
+    def is_unique_media(self, url):
+        """
+        Return `True` if the URL is for a deduplicated file with a unique name.
+        """
+        storage = unlazy_storage(default_storage)
+        return isinstance(storage, UniqueMixin) and url.startswith(
+            posixpath.join(self.media_prefix, DEDUPE_PATH_PREFIX, ''))
+
     # Files with unique names are always immutable.
     def is_immutable_file(self, path, url):
         if super(WhiteNoiseMiddleware, self).is_immutable_file(path, url):
@@ -75,19 +289,16 @@ class WhiteNoiseMiddleware(WhiteNoiseMiddleware):
 
     def process_response(self, request, response, *args, **kwargs):
         """
-        Redirect requests for deduplicated unique storage.
+        Redirect requests for deduplicated unique storage. Resolved names and
+        misses are cached, so repeated 404s do not query the database.
         """
-        from ixc_whitenoise.models import UniqueFile  # Avoid circular import
         if response.status_code == 404 and \
                 request.path_info.startswith(self.media_prefix):
             original_name = request.path_info[len(self.media_prefix):]
-            # There could be more than one `UniqueFile` object for a given
-            # name. Redirect to the most recently deduplicated one.
-            unique_file = UniqueFile.objects \
-                .filter(original_name=original_name).last()
-            if unique_file:
+            unique_name = resolution_cache.get(original_name)
+            if unique_name:
                 response = HttpResponseRedirect(posixpath.join(
                     self.media_prefix,
-                    unique_file.name,
+                    unique_name,
                 ))
         return response
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-18 11:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ixc_whitenoise', '0002_auto_20211117_1246'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uniquefile',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=128),
+        ),
+        migrations.AddField(
+            model_name='uniquefile',
+            name='hash_algorithm',
+            field=models.CharField(blank=True, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='uniquefile',
+            name='size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
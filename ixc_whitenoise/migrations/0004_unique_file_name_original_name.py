@@ -0,0 +1,152 @@
+# Generated by Django 3.2.25 on 2026-10-18 11:29
+
+from django.db import migrations, models, transaction
+from django.db.models import Count, Min
+
+from ixc_whitenoise.models import get_names_hash
+
+BATCH_SIZE = 1000
+
+
+def delete_duplicates(apps, schema_editor):
+    """
+    Delete all but the first `UniqueFile` object for each name and original
+    name, keeping any content hash and size recorded on a duplicate. Each
+    name and original name is committed separately. Run the
+    `compact_unique_files` management command first on large tables, to do
+    this in small batches while the site is running.
+    """
+    UniqueFile = apps.get_model('ixc_whitenoise', 'UniqueFile')
+    duplicates = UniqueFile.objects \
+        .order_by() \
+        .values('name', 'original_name') \
+        .annotate(count=Count('pk'), min_pk=Min('pk')) \
+        .filter(count__gt=1)
+    for duplicate in list(duplicates):
+        with transaction.atomic(using=schema_editor.connection.alias):
+            unique_files = UniqueFile.objects.filter(
+                name=duplicate['name'],
+                original_name=duplicate['original_name'],
+            )
+            hashed = unique_files.exclude(content_hash='') \
+                .order_by('-pk').first()
+            if hashed:
+                unique_files \
+                    .filter(pk=duplicate['min_pk'], content_hash='') \
+                    .update(
+                        content_hash=hashed.content_hash,
+                        hash_algorithm=hashed.hash_algorithm,
+                        size=hashed.size,
+                    )
+            unique_files.exclude(pk=duplicate['min_pk']).delete()
+
+
+def set_names_hashes(apps, schema_editor):
+    """
+    Set the names hash of all `UniqueFile` objects, in batches that are each
+    committed separately.
+    """
+    UniqueFile = apps.get_model('ixc_whitenoise', 'UniqueFile')
+    last_pk = 0
+    while True:
+        batch = list(
+            UniqueFile.objects
+            .filter(pk__gt=last_pk, names_hash__isnull=True)
+            .order_by('pk')
+            .only('pk', 'name', 'original_name')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+        for unique_file in batch:
+            unique_file.names_hash = get_names_hash(
+                unique_file.name, unique_file.original_name)
+        with transaction.atomic(using=schema_editor.connection.alias):
+            UniqueFile.objects.bulk_update(batch, ['names_hash'])
+
+
+def get_unique_columns(schema_editor, model):
+    """
+    Return the columns of `model`, mapped to whether each has a single column
+    unique constraint.
+    """
+    connection = schema_editor.connection
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        columns = connection.introspection.get_table_description(
+            cursor, table)
+        constraints = connection.introspection.get_constraints(cursor, table)
+    unique_columns = set(
+        constraint['columns'][0] for constraint in constraints.values()
+        if constraint['unique'] and len(constraint['columns']) == 1
+    )
+    return {
+        column.name: column.name in unique_columns for column in columns
+    }
+
+
+class AddFieldIfMissing(migrations.AddField):
+    """
+    Add a field, unless its column was added by an earlier run that did not
+    complete.
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state,
+                          to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        column = model._meta.get_field(self.name).column
+        if column not in get_unique_columns(schema_editor, model):
+            super(AddFieldIfMissing, self).database_forwards(
+                app_label, schema_editor, from_state, to_state)
+
+
+class AlterFieldUniqueIfNot(migrations.AlterField):
+    """
+    Make a field unique, unless it was made unique by an earlier run that
+    did not complete.
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state,
+                          to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        column = model._meta.get_field(self.name).column
+        if not get_unique_columns(schema_editor, model).get(column):
+            super(AlterFieldUniqueIfNot, self).database_forwards(
+                app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state,
+                           to_state):
+        migrations.AlterField.database_forwards(
+            self, app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+
+    # Do not hold locks on the whole table while duplicates are deleted and
+    # hashes are set. Each step can be run again if a later step fails, e.g.
+    # when old code creates a duplicate while the migration is running.
+    atomic = False
+
+    dependencies = [
+        ('ixc_whitenoise', '0003_unique_file_content_hash_size'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicates, migrations.RunPython.noop),
+        AddFieldIfMissing(
+            model_name='uniquefile',
+            name='names_hash',
+            field=models.CharField(editable=False, max_length=40, null=True),
+        ),
+        migrations.RunPython(set_names_hashes, migrations.RunPython.noop),
+        # Delete duplicates created while hashes were set, and set hashes for
+        # objects created since, right before adding the constraint.
+        migrations.RunPython(delete_duplicates, migrations.RunPython.noop),
+        migrations.RunPython(set_names_hashes, migrations.RunPython.noop),
+        AlterFieldUniqueIfNot(
+            model_name='uniquefile',
+            name='names_hash',
+            field=models.CharField(
+                editable=False, max_length=40, null=True, unique=True),
+        ),
+    ]
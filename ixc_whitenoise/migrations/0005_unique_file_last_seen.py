@@ -0,0 +1,22 @@
+# Generated by Django 3.2.25 on 2026-10-18 12:32
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ixc_whitenoise', '0004_unique_file_name_original_name'),
+    ]
+
+    operations = [
+        # Existing objects are seen now, so `gc_unique_storage` keeps their
+        # files for one more grace period.
+        migrations.AddField(
+            model_name='uniquefile',
+            name='last_seen',
+            field=models.DateTimeField(
+                db_index=True, default=django.utils.timezone.now),
+        ),
+    ]
@@ -1,13 +1,40 @@
+import hashlib
+import json
+
 from django.db import models
+from django.utils import timezone
+
+
+def get_names_hash(name, original_name):
+    """
+    Return a fixed length hash of a unique name and original name, so they
+    can be unique together. Both are too long to be indexed together by some
+    databases (e.g. MySQL with `utf8mb4`).
+    """
+    return hashlib.sha1(
+        json.dumps([name, original_name]).encode('utf-8')).hexdigest()
 
 
 class UniqueFile(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     name = models.CharField(db_index=True, max_length=500)
     original_name = models.CharField(db_index=True, max_length=500)
+    content_hash = models.CharField(blank=True, db_index=True, max_length=128)
+    hash_algorithm = models.CharField(blank=True, max_length=20)
+    size = models.BigIntegerField(blank=True, null=True)
+    # Set on save. Objects created with `bulk_create()` must set it first.
+    names_hash = models.CharField(
+        editable=False, max_length=40, null=True, unique=True)
+    # Updated when an existing file is saved again with the same names, so
+    # `gc_unique_storage` keeps it.
+    last_seen = models.DateTimeField(db_index=True, default=timezone.now)
 
     class Meta:
         ordering = ('-pk', )
 
     def __unicode__(self):
         return '%s -> %s' % (self.original_name, self.name)
+
+    def save(self, *args, **kwargs):
+        self.names_hash = get_names_hash(self.name, self.original_name)
+        super(UniqueFile, self).save(*args, **kwargs)
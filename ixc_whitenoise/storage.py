@@ -1,17 +1,60 @@
+import atexit
+import datetime
+import errno
 import hashlib
+import io
 import logging
+import os
 import posixpath
 import re
+import shutil
 import six
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import django
 from django.conf import settings
+from django.contrib.staticfiles.utils import matches_patterns
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
+from django.core.files.base import ContentFile
 from django.core.files.storage import FileSystemStorage
+from django.utils import timezone
+from django.utils._os import safe_join
 from django.utils.functional import empty, LazyObject
+from six.moves.urllib.parse import unquote, urldefrag, urlsplit
+from whitenoise.compress import brotli_installed
+from whitenoise.compress import Compressor
 from whitenoise.storage import \
     CompressedManifestStaticFilesStorage, HelpfulExceptionMixin, \
     MissingFileError
 
+from ixc_whitenoise.cache import \
+    EXISTS_CACHE_SIZE, EXISTS_CACHE_TTL, EXISTS_FILTER_PATH, ExistsCache, \
+    resolution_cache
+from ixc_whitenoise.compress import \
+    compress_path, evict_compression_cache
+from ixc_whitenoise.fileindex import build_file_index, get_index_path
+from ixc_whitenoise.fingerprints import \
+    Fingerprint, get_dependents, load_fingerprints, save_fingerprints
+from ixc_whitenoise.hashes import new_hash
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:
+    sync_to_async = None  # Django < 3.0
+
+try:
+    from django.core.files.utils import validate_file_name
+except ImportError:
+    validate_file_name = None  # Django < 2.2.21
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows
 
 logger = logging.getLogger(__name__)
 
@@ -31,6 +74,97 @@ HASH_LENGTH = getattr(
 ORIGINAL_BASENAME = getattr(
     settings, 'IXC_WHITENOISE_ORIGINAL_BASENAME', False)
 
+# Changing the algorithm only affects new files. Existing files keep their
+# names, which are never recomputed.
+HASH_ALGORITHM = getattr(settings, 'IXC_WHITENOISE_HASH_ALGORITHM', 'md5')
+
+# Use the default chunk size for content when `None`.
+HASH_CHUNK_SIZE = getattr(settings, 'IXC_WHITENOISE_HASH_CHUNK_SIZE', None)
+
+# Split deduplicated files into this many levels of subdirectories, named after
+# the leading characters of their content hash. `0` for a flat layout.
+SHARD_DEPTH = getattr(settings, 'IXC_WHITENOISE_SHARD_DEPTH', 0)
+
+# The number of content hash characters in each shard directory name.
+SHARD_WIDTH = getattr(settings, 'IXC_WHITENOISE_SHARD_WIDTH', 2)
+
+STREAMING_SAVE = getattr(settings, 'IXC_WHITENOISE_STREAMING_SAVE', False)
+
+# Minimum seconds between updates of `UniqueFile.last_seen` when an existing
+# file is saved again with the same names. The `gc_unique_storage` grace
+# period must be longer than this.
+LAST_SEEN_INTERVAL = 60 * 60
+
+# Directory for a local disk cache of files with unique names, in front of
+# remote storage classes with `LocalCacheMixin`. `None` to disable.
+LOCAL_CACHE_DIR = getattr(settings, 'IXC_WHITENOISE_LOCAL_CACHE_DIR', None)
+
+# Maximum total size of the local disk cache, in bytes.
+LOCAL_CACHE_MAX_SIZE = getattr(
+    settings, 'IXC_WHITENOISE_LOCAL_CACHE_MAX_SIZE', 1024 ** 3)
+
+# Save gzip and brotli (if installed) compressed variants next to local files
+# with unique names, for `WhiteNoiseMiddleware` to serve. Files with extensions
+# in `WHITENOISE_SKIP_COMPRESS_EXTENSIONS` are not compressed.
+COMPRESS_MEDIA = getattr(settings, 'IXC_WHITENOISE_COMPRESS_MEDIA', False)
+
+# Number of background threads to compress media with. `0` to compress before
+# `save()` returns.
+COMPRESS_MEDIA_WORKERS = getattr(
+    settings, 'IXC_WHITENOISE_COMPRESS_MEDIA_WORKERS', 0)
+
+# Only keep variants that are at least this fraction smaller than the file.
+COMPRESS_MEDIA_MIN_SAVING = getattr(
+    settings, 'IXC_WHITENOISE_COMPRESS_MEDIA_MIN_SAVING', 0.05)
+
+# Do not compress files larger than this, in bytes, which are read into memory.
+COMPRESS_MEDIA_MAX_SIZE = getattr(
+    settings, 'IXC_WHITENOISE_COMPRESS_MEDIA_MAX_SIZE', 10 * 1024 * 1024)
+
+# Number of processes to compress static files with in `collectstatic`. `1` to
+# compress serially, `None` for one per CPU.
+COMPRESS_WORKERS = getattr(settings, 'IXC_WHITENOISE_COMPRESS_WORKERS', 1)
+
+# Directory to cache compressed static files in, by content hash, so files that
+# did not change since the last `collectstatic` are not compressed again.
+# `None` to disable.
+COMPRESS_CACHE_DIR = getattr(
+    settings, 'IXC_WHITENOISE_COMPRESS_CACHE_DIR', None)
+
+# Maximum total size of the compression cache, in bytes.
+COMPRESS_CACHE_MAX_SIZE = getattr(
+    settings, 'IXC_WHITENOISE_COMPRESS_CACHE_MAX_SIZE', 1024 ** 3)
+
+# File to save source file fingerprints and references between static files
+# to, so `collectstatic` only post-processes changed files and the files that
+# reference them. `None` to post-process all files.
+STATIC_FINGERPRINTS_PATH = getattr(
+    settings, 'IXC_WHITENOISE_STATIC_FINGERPRINTS_PATH', None)
+
+# Post-process static files once each, in the order of the references between
+# them, instead of repeating passes over all adjustable files until their
+# hashed names stop changing.
+GRAPH_POST_PROCESS = getattr(
+    settings, 'IXC_WHITENOISE_GRAPH_POST_PROCESS', False)
+
+# What to do with files that reference each other, directly or indirectly,
+# with `GRAPH_POST_PROCESS`. `'error'` to fail, like repeated passes do, or
+# `'group'` to name the files in a cycle after their combined content.
+POST_PROCESS_CYCLES = getattr(
+    settings, 'IXC_WHITENOISE_POST_PROCESS_CYCLES', 'error')
+
+# Linux `ioctl` request to share the data of one file with another, on file
+# systems that support copy-on-write (e.g. Btrfs and XFS).
+FICLONE = 0x40049409
+
+# Temporary files for streaming saves are written to this directory inside
+# `DEDUPE_PATH_PREFIX`, so they are on the same filesystem as their target.
+STREAMING_SAVE_TEMP_DIR = '.tmp'
+
+# Shared by all storage instances, created on first use.
+_compress_media_executor = None
+_compress_media_executor_lock = threading.Lock()
+
 
 # Log a warning instead of raising an exception when a referenced file is
 # not found. These are often in 3rd party packages and outside our control.
@@ -45,45 +179,520 @@ class HelpfulWarningMixin(HelpfulExceptionMixin):
         return exception
 
 
+# Find all `url()`, `@import` and `sourceMappingURL` references in a file in a
+# single pass, instead of one pass per pattern. Each alternative is a named
+# group for the whole reference, containing a `<name>_url` group for its URL.
+# Only references that Django's own patterns rewrite are rewritten: CSS source
+# maps since Django 4.0, and JavaScript source maps since Django 4.1.
+CSS_URL_PATTERN = (
+    r"""(?P<url>url\(['"]{0,1}\s*(?P<url_url>.*?)["']{0,1}\))"""
+    r"""|(?P<import>@import\s*["']\s*(?P<import_url>.*?)["'])"""
+)
+if django.VERSION[:2] >= (4, 0):
+    CSS_URL_PATTERN += (
+        r"""|(?P<css_map>/\*#[ \t](?-i:sourceMappingURL)="""
+        r"""(?P<css_map_url>.*?)[ \t]*\*/)"""
+    )
+JS_URL_PATTERN = (
+    r"""(?m)^(?P<js_map>//# (?-i:sourceMappingURL)=(?P<js_map_url>.*))$"""
+)
+
+# Templates for rewritten references, by alternative.
+URL_TEMPLATES = {
+    'url': 'url("%s")',
+    'import': '@import url("%s")',
+    'css_map': '/*# sourceMappingURL=%s */',
+    'js_map': '//# sourceMappingURL=%s',
+}
+
 # Don't try to rewrite URLs with unknown schemes.
+SKIP_URL_RE = re.compile(r'(?i)([a-z]+://|//|#|data:)')
+
+
+class URLMatch(object):
+    """
+    A reference found by a single pass pattern, in the shape Django's URL
+    converter expects from its own patterns.
+    """
+
+    __slots__ = ('matched', 'url')
+
+    def __init__(self, matched, url):
+        self.matched = matched
+        self.url = url
+
+    def groups(self):
+        return self.matched, self.url
+
+    def groupdict(self):
+        return {'matched': self.matched, 'url': self.url}
+
+
 class RegexURLConverterMixin(object):
 
+    patterns = (
+        ('*.css', (CSS_URL_PATTERN,)),
+    )
+    if django.VERSION[:2] >= (4, 1):
+        patterns += (
+            ('*.js', (JS_URL_PATTERN,)),
+        )
+
+    # References that could not be rewritten while post-processing, which are
+    # left unchanged. See `_post_process()`.
+    _reference_errors = None
+
+    def _post_process(self, paths, adjustable_paths, hashed_files):
+        """
+        Yield errors for references that could not be rewritten in each file,
+        before the file itself. Django's converter raises `ValueError` for a
+        missing file, which would otherwise stop all other references in the
+        same file being rewritten, because they are found in a single pass.
+        """
+        self._reference_errors = []
+        try:
+            files = super(RegexURLConverterMixin, self)._post_process(
+                paths, adjustable_paths, hashed_files)
+            for name, hashed_name, processed, substitutions in files:
+                errors = self._reference_errors
+                self._reference_errors = []
+                for error in errors:
+                    yield name, None, error, False
+                yield name, hashed_name, processed, substitutions
+        finally:
+            self._reference_errors = None
+
+    def get_url_match(self, matchobj):
+        """
+        Return the alternative, whole reference and URL for a match. The
+        alternative is `None` for patterns with two unnamed groups.
+        """
+        kind = matchobj.lastgroup
+        if kind in URL_TEMPLATES:
+            return kind, matchobj.group(kind), matchobj.group(kind + '_url')
+        matched, url = matchobj.groups()[:2]
+        return None, matched, url
+
+    def get_url_template(self, kind):
+        # Django 4.0+ templates use named placeholders.
+        template = URL_TEMPLATES[kind]
+        if '%(url)s' in self.default_template:
+            template = template.replace('%s', '%(url)s')
+        return template
+
     def url_converter(self, name, hashed_files=None, template=None):
-        # `hashed_files` parameter is only supported since Django 1.11
-        # https://github.com/django/django/commit/53bffe8d03f01bd3214a5404998cb965fb28cd0b
-        if django.VERSION[:2] >= (1, 11):
-            if hashed_files is None:
-                hashed_files = {}
-            converter = super(RegexURLConverterMixin, self).url_converter(
-                name, hashed_files=hashed_files, template=template)
-        else:
-            converter = super(RegexURLConverterMixin, self).url_converter(
-                name, template=template)
+        # Django's converters, by template. Only created when used.
+        converters = {}
+
+        def get_converter(template):
+            try:
+                return converters[template]
+            except KeyError:
+                pass
+            # `hashed_files` parameter is only supported since Django 1.11
+            # https://github.com/django/django/commit/53bffe8d03f01bd3214a5404998cb965fb28cd0b
+            if django.VERSION[:2] >= (1, 11):
+                converter = super(RegexURLConverterMixin, self).url_converter(
+                    name, hashed_files=hashed_files, template=template)
+            else:
+                converter = super(RegexURLConverterMixin, self).url_converter(
+                    name, template=template)
+            converters[template] = converter
+            return converter
+
+        if hashed_files is None:
+            hashed_files = {}
+
+        # The same reference is often repeated in a file, and always converts
+        # to the same URL while the file is rewritten.
+        converted = {}
 
         def custom_converter(matchobj):
-            print(matchobj)
-            groups = matchobj.groups()
-            print(groups)
-            print(f"Number of groups:{len(groups)}")
-            matched, url = matchobj.groups()
-            if re.match(r'(?i)([a-z]+://|//|#|data:)', url):
-                return matched
-            return converter(matchobj)
+            kind, matched, url = self.get_url_match(matchobj)
+            try:
+                return converted[matched]
+            except KeyError:
+                pass
+            if SKIP_URL_RE.match(url):
+                result = matched
+            else:
+                try:
+                    if kind is None:
+                        result = get_converter(template)(matchobj)
+                    else:
+                        result = get_converter(self.get_url_template(kind))(
+                            URLMatch(matched, url))
+                except ValueError as e:
+                    if self._reference_errors is None:
+                        raise
+                    self._reference_errors.append(e)
+                    result = matched
+            converted[matched] = result
+            return result
 
         return custom_converter
 
+    def get_target_name(self, name, url):
+        """
+        Return the name of the static file that a URL in a file refers to, or
+        `None`, like the URL converter.
+        """
+        if re.match(r'(?i)([a-z]+:|//|#)', url):
+            return None
+        url_path = urldefrag(url)[0]
+        if url_path.startswith('/'):
+            if not url_path.startswith(settings.STATIC_URL):
+                return None
+            target_name = url_path[len(settings.STATIC_URL):]
+        else:
+            target_name = posixpath.join(
+                posixpath.dirname(self.clean_name(name)), url_path)
+        target_name = urlsplit(unquote(target_name)).path.strip()
+        return self.clean_name(posixpath.normpath(target_name))
+
+
+def find_components(graph):
+    """
+    Return the strongly connected components of a graph (a dictionary of
+    targets by node) as sorted lists, with Tarjan's algorithm. Components are
+    in reverse topological order: each comes after the components it has
+    edges to. Iterative, so deep graphs do not exceed the recursion limit.
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+    for root in sorted(graph):
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(sorted(graph[root])))]
+        while work:
+            node, targets = work[-1]
+            for target in targets:
+                if target not in index:
+                    index[target] = lowlink[target] = len(index)
+                    stack.append(target)
+                    on_stack.add(target)
+                    work.append((target, iter(sorted(graph.get(target, ())))))
+                    break
+                if target in on_stack:
+                    lowlink[node] = min(lowlink[node], index[target])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(sorted(component))
+    return components
+
+
+class GraphPostProcessMixin(object):
+    """
+    Post-process each static file once, in the order of the references
+    between them, instead of repeating passes over all adjustable files until
+    their hashed names stop changing.
+
+    Adjustable files are read once and scanned for references, to build a
+    graph. Files that are not adjustable are hashed and saved first. Then
+    adjustable files are rewritten, hashed and saved, after the files they
+    reference. Files that reference each other, directly or indirectly, are
+    handled according to `post_process_cycles`.
+
+    Requires `RegexURLConverterMixin`, to find references.
+    """
+
+    graph_post_process = GRAPH_POST_PROCESS
+    post_process_cycles = POST_PROCESS_CYCLES
+
+    # Set when the graph has been processed in this `post_process()`, so
+    # Django's repeated passes have nothing left to do.
+    _graph_processed = False
+
+    # Counts and timings for the last graph `post_process()`.
+    post_process_stats = None
+
+    def post_process(self, *args, **kwargs):
+        self._graph_processed = False
+        return super(GraphPostProcessMixin, self).post_process(*args, **kwargs)
+
+    def _post_process(self, paths, adjustable_paths, hashed_files):
+        if not self.graph_post_process or django.VERSION[:2] < (1, 11):
+            return super(GraphPostProcessMixin, self)._post_process(
+                paths, adjustable_paths, hashed_files)
+        if self._graph_processed:
+            return iter(())
+        self._graph_processed = True
+        return self.graph_post_process_files(
+            paths, adjustable_paths, hashed_files)
+
+    def graph_post_process_files(self, paths, adjustable_paths, hashed_files):
+        """
+        Post-process files in reference order. Yield the same values as
+        `_post_process()`, once per file.
+        """
+        if self.post_process_cycles not in ('error', 'group'):
+            raise ValueError(
+                'Unknown post-process cycle strategy: %r' %
+                self.post_process_cycles)
+        stats = self.post_process_stats = {
+            'files': len(paths),
+            'adjustable_files': 0,
+            'references': 0,
+            'edges': 0,
+            'components': 0,
+            'cycles': 0,
+            'cycle_files': 0,
+        }
+
+        # Scan adjustable files for references to other files.
+        start = time.time()
+        adjustable_paths = set(adjustable_paths)
+        names = dict((self.clean_name(name), name) for name in paths)
+        contents = {}
+        graph = {}
+        for name in paths:
+            if name not in adjustable_paths:
+                continue
+            storage, path = paths[name]
+            with storage.open(path) as original_file:
+                content = original_file.read().decode('utf-8')
+            contents[name] = content
+            graph[name] = targets = set()
+            for matchobj in self.find_references(path, content):
+                stats['references'] += 1
+                kind, matched, url = self.get_url_match(matchobj)
+                if SKIP_URL_RE.match(url):
+                    continue
+                target = names.get(self.get_target_name(name, url))
+                if target in adjustable_paths:
+                    targets.add(target)
+        stats['adjustable_files'] = len(graph)
+        stats['edges'] = sum(len(targets) for targets in graph.values())
+        stats['scan_seconds'] = time.time() - start
+
+        start = time.time()
+        components = find_components(graph)
+        stats['components'] = len(components)
+        stats['sort_seconds'] = time.time() - start
+
+        # Files that are not adjustable do not depend on other files.
+        start = time.time()
+        for name in sorted(paths):
+            if name in graph:
+                continue
+            storage, path = paths[name]
+            hash_key = self.hash_key(self.clean_name(name))
+            with storage.open(path) as original_file:
+                hashed_name = self.hashed_name(name, original_file)
+                if hasattr(original_file, 'seek'):
+                    original_file.seek(0)
+                processed = False
+                if not self.exists(hashed_name):
+                    processed = True
+                    saved_name = self._save(hashed_name, original_file)
+                    hashed_name = self.clean_name(saved_name)
+            hashed_files[hash_key] = hashed_name
+            yield name, hashed_name, processed, False
+
+        for component in components:
+            name = component[0]
+            if len(component) == 1 and name not in graph[name]:
+                content, errors = self.rewrite_references(
+                    name, paths[name][1], contents.pop(name), hashed_files)
+                for error in errors:
+                    yield name, None, error, False
+                content_file = ContentFile(content.encode())
+                yield self.save_processed(
+                    name, self.hashed_name(name, content_file), content_file,
+                    hashed_files)
+                continue
+
+            stats['cycles'] += 1
+            stats['cycle_files'] += len(component)
+            cycle = ' -> '.join(component + component[:1])
+            if self.post_process_cycles == 'error':
+                for name in component:
+                    yield name, None, RuntimeError(
+                        'Files reference each other: %s' % cycle), False
+                continue
+            logger.warning(
+                'Naming files that reference each other after their combined '
+                'content: %s' % cycle)
+            for item in self.process_cycle(
+                    component, paths, contents, hashed_files):
+                yield item
+        stats['process_seconds'] = time.time() - start
+
+        # Keep the manifest in the order repeated passes would save it.
+        ordered = []
+        for name in sorted(
+                paths, key=lambda name: len(name.split(os.sep)),
+                reverse=True):
+            hash_key = self.hash_key(self.clean_name(name))
+            if hash_key in hashed_files:
+                ordered.append((hash_key, hashed_files.pop(hash_key)))
+        ordered.extend(hashed_files.items())
+        hashed_files.clear()
+        hashed_files.update(ordered)
+
+        logger.info(
+            'Post-processed %(files)s files (%(adjustable_files)s adjustable) '
+            'with %(references)s references and %(edges)s edges between '
+            'adjustable files, in %(components)s components with '
+            '%(cycles)s cycles (%(cycle_files)s files). Scan: '
+            '%(scan_seconds).2fs, sort: %(sort_seconds).2fs, hash and '
+            'rewrite: %(process_seconds).2fs.' % stats)
+
+    def process_cycle(self, component, paths, contents, hashed_files):
+        """
+        Post-process files that reference each other. Each is named after its
+        content with references to files outside the cycle rewritten, and the
+        same content of the other files in the cycle. So all their names
+        change when any of them, or any file they reference, changes.
+        """
+        skip = set(self.clean_name(name) for name in component)
+        partial_contents = {}
+        for name in component:
+            partial_contents[name] = self.rewrite_references(
+                name, paths[name][1], contents[name], hashed_files, skip)[0]
+        cycle_hash = hashlib.md5()
+        for name in component:
+            cycle_hash.update(partial_contents[name].encode())
+        cycle_hash = cycle_hash.hexdigest().encode()
+        for name in component:
+            hashed_name = self.hashed_name(name, ContentFile(
+                partial_contents[name].encode() + b'\n' + cycle_hash))
+            hashed_files[self.hash_key(self.clean_name(name))] = hashed_name
+        for name in component:
+            content, errors = self.rewrite_references(
+                name, paths[name][1], contents.pop(name), hashed_files)
+            for error in errors:
+                yield name, None, error, False
+            yield self.save_processed(
+                name, hashed_files[self.hash_key(self.clean_name(name))],
+                ContentFile(content.encode()), hashed_files)
+
+    def find_references(self, path, content):
+        for extension, patterns in self._patterns.items():
+            if matches_patterns(path, (extension,)):
+                for pattern, template in patterns:
+                    for matchobj in pattern.finditer(content):
+                        yield matchobj
+
+    def rewrite_references(self, name, path, content, hashed_files,
+                           skip=()):
+        """
+        Return content with references rewritten to hashed names, except
+        references to files in `skip`, and a list of errors for references
+        that could not be rewritten and are left unchanged.
+        """
+        errors = []
+        previous_errors = self._reference_errors
+        self._reference_errors = errors
+        try:
+            for extension, patterns in self._patterns.items():
+                if not matches_patterns(path, (extension,)):
+                    continue
+                for pattern, template in patterns:
+                    converter = self.url_converter(
+                        name, hashed_files, template)
+
+                    def skip_converter(matchobj):
+                        kind, matched, url = self.get_url_match(matchobj)
+                        if skip and self.get_target_name(name, url) in skip:
+                            return matched
+                        return converter(matchobj)
+
+                    content = pattern.sub(skip_converter, content)
+        finally:
+            self._reference_errors = previous_errors
+        return content, errors
+
+    def save_processed(self, name, hashed_name, content_file, hashed_files):
+        if self.exists(hashed_name):
+            self.delete(hashed_name)
+        saved_name = self._save(hashed_name, content_file)
+        hashed_name = self.clean_name(saved_name)
+        hashed_files[self.hash_key(self.clean_name(name))] = hashed_name
+        return name, hashed_name, True, False
+
 
 class UniqueMixin(object):
     """
     Save files with unique names so they can be deduplicated and cached forever.
     """
 
-    def generate_content_hash(self, content):
+    # Stream content into a temporary file while hashing it, then link it into
+    # place. Only used for storage classes with local file paths.
+    streaming_save = STREAMING_SAVE
+
+    hash_algorithm = HASH_ALGORITHM
+    hash_chunk_size = HASH_CHUNK_SIZE
+
+    shard_depth = SHARD_DEPTH
+    shard_width = SHARD_WIDTH
+
+    # Remember unique names known to exist, so storage is only asked about
+    # names that have not been seen yet. Storage classes that do not share
+    # files with the default storage should use their own filter path.
+    exists_cache_size = EXISTS_CACHE_SIZE
+    exists_cache_ttl = EXISTS_CACHE_TTL
+    exists_filter_path = EXISTS_FILTER_PATH
+
+    compress_media = COMPRESS_MEDIA
+    compress_media_workers = COMPRESS_MEDIA_WORKERS
+    compress_media_min_saving = COMPRESS_MEDIA_MIN_SAVING
+    compress_media_max_size = COMPRESS_MEDIA_MAX_SIZE
+
+    @property
+    def exists_cache(self):
+        try:
+            return self._exists_cache
+        except AttributeError:
+            self._exists_cache = ExistsCache(
+                self.exists_cache_size, self.exists_filter_path,
+                ttl=self.exists_cache_ttl)
+            if self.exists_filter_path:
+                atexit.register(self._exists_cache.flush)
+            return self._exists_cache
+
+    def unique_name_exists(self, name):
+        """
+        Return `True` if a file with a unique name exists. Files with unique
+        names never change, so only names not known to exist are checked.
+        """
+        if name in self.exists_cache:
+            return True
+        if self.exists(name):
+            self.exists_cache.add(name)
+            return True
+        return False
+
+    def new_hash(self, algorithm=None):
+        """
+        Return a new hash object for the configured content hash algorithm.
+        """
+        return new_hash(algorithm or self.hash_algorithm)
+
+    def iter_content_chunks(self, content):
+        """
+        Rewind content and yield its chunks as bytes.
+        """
         # Rewind content to ensure we generate a complete hash.
         content.seek(0)
-        # Generate content hash.
-        md5 = hashlib.md5()
-        for chunk in content.chunks():
+        for chunk in content.chunks(self.hash_chunk_size):
             # If content is a string, instead of bytes, encode with UTF-8 for
             # hashing to work. While we're assuming that the file has been
             # decoded with UTF-8, the only scenario in which we've encountered
@@ -92,34 +701,133 @@ class UniqueMixin(object):
             # have decoded using UTF-8.
             if isinstance(chunk, six.text_type):
                 chunk = chunk.encode()
-            md5.update(chunk)
-        return md5.hexdigest()
+            yield chunk
+
+    def get_content_size(self, content):
+        """
+        Return the number of bytes saving content writes. The `size` of text
+        content (e.g. a `ContentFile` created from a string) is its number of
+        characters, so text is measured after encoding, like it is hashed.
+        """
+        if isinstance(getattr(content, 'file', content), io.TextIOBase):
+            return sum(len(chunk) for chunk in self.iter_content_chunks(content))
+        return getattr(content, 'size', None)
 
-    def get_content_hash(self, name):
+    def get_precomputed_content_hash(self, content):
+        """
+        Return the content hash attached to an uploaded file by one of the
+        `ixc_whitenoise.uploadhandler` handlers, if it was generated with the
+        configured algorithm.
+        """
+        for obj in (content, getattr(content, 'file', None)):
+            algorithm = getattr(obj, 'content_hash_algorithm', None)
+            if algorithm and algorithm == self.hash_algorithm:
+                return obj.content_hash
+        return None
+
+    def generate_content_hash(self, content):
+        # Avoid reading uploaded files again when they were hashed on upload.
+        content_hash = self.get_precomputed_content_hash(content)
+        if content_hash:
+            return content_hash
+
+        # Generate content hash.
+        content_hash = self.new_hash()
+        for chunk in self.iter_content_chunks(content):
+            content_hash.update(chunk)
+        return content_hash.hexdigest()
+
+    def get_content_hash(self, name, algorithm=None):
         """
         Return the content hash for the named file. Local storage classes should
         generate it. Remote storage classes should get it from metadata, if
         available (e.g. the Etag header from S3).
+
+        The `UniqueFile` index is checked first, so files are only read when
+        their hash was not recorded.
         """
-        md5 = hashlib.md5()
+        content_hash = self.get_indexed_content_hash(name, algorithm)
+        if content_hash:
+            return content_hash
+        content_hash = self.new_hash(algorithm)
         with self.open(name, 'rb') as content:
-            for chunk in content.chunks():
-                md5.update(chunk)
-        content_hash = md5.hexdigest()
-        return content_hash
+            for chunk in content.chunks(self.hash_chunk_size):
+                content_hash.update(chunk)
+        return content_hash.hexdigest()
+
+    def get_indexed_content_hash(self, name, algorithm=None):
+        """
+        Return the content hash recorded for the named file in the `UniqueFile`
+        index, or `None`.
+        """
+        from ixc_whitenoise.models import UniqueFile  # Avoid circular import
+        return UniqueFile.objects \
+            .filter(name=name, hash_algorithm=algorithm or self.hash_algorithm) \
+            .exclude(content_hash='') \
+            .values_list('content_hash', flat=True) \
+            .first()
+
+    def get_indexed_size(self, name):
+        """
+        Return the size recorded for the named file in the `UniqueFile` index,
+        or `None`.
+        """
+        from ixc_whitenoise.models import UniqueFile  # Avoid circular import
+        return UniqueFile.objects \
+            .filter(name=name, size__isnull=False) \
+            .values_list('size', flat=True) \
+            .first()
+
+    def get_name_for_content_hash(self, content_hash, algorithm=None):
+        """
+        Return the latest unique name for content with the given hash from the
+        `UniqueFile` index alone, or `None` if we do not have that content.
+        """
+        from ixc_whitenoise.models import UniqueFile  # Avoid circular import
+        return UniqueFile.objects \
+            .filter(
+                content_hash=content_hash,
+                hash_algorithm=algorithm or self.hash_algorithm,
+            ) \
+            .values_list('name', flat=True) \
+            .first()
+
+    def size(self, name):
+        """
+        Get the size of remote files from the `UniqueFile` index, if available.
+        Unique names are immutable, so the recorded size never goes stale.
+        """
+        if not self.is_local():
+            size = self.get_indexed_size(name)
+            if size is not None:
+                return size
+        return super(UniqueMixin, self).size(name)
 
     def get_unique_name(self, name, content_hash):
         """
         Determine the unique name for a given original name and content hash.
         """
 
+        # Shard directories must be recoverable from the abbreviated hash, or
+        # they cannot be stripped when an existing unique name is saved again.
+        if ORIGINAL_BASENAME and \
+                self.shard_depth * self.shard_width > HASH_LENGTH:
+            raise ImproperlyConfigured(
+                'IXC_WHITENOISE_SHARD_DEPTH multiplied by '
+                'IXC_WHITENOISE_SHARD_WIDTH must not exceed '
+                'IXC_WHITENOISE_ORIGINAL_BASENAME_HASH_LENGTH.')
+
         # Get path, name and extension.
         path, basename = posixpath.split(name)
         basename, ext = posixpath.splitext(basename)
         ext = DEDUPE_EXTENTIONS.get(ext.lower(), ext.lower())
 
-        # Strip dedupe path prefix and unique hash suffix.
-        path = re.sub(r'^%s/' % re.escape(DEDUPE_PATH_PREFIX), '', path)
+        # Strip dedupe path prefix, shard directories and unique hash suffix.
+        unique_path = re.sub(r'^%s/' % re.escape(DEDUPE_PATH_PREFIX), '', path)
+        if unique_path != path:
+            unique_path, shard_path = self.split_shard_path(
+                unique_path, self.get_unique_hash(basename))
+        path = unique_path
         basename = re.sub(r'\.[0-9a-z]+$', '', basename)
 
         # Determine unique name. An abbreviated hash is sufficient when
@@ -129,38 +837,585 @@ class UniqueMixin(object):
         else:
             basename = content_hash
 
-        return posixpath.join(DEDUPE_PATH_PREFIX, path, basename + ext)
+        return posixpath.join(
+            DEDUPE_PATH_PREFIX,
+            path,
+            self.get_shard_path(content_hash),
+            basename + ext,
+        )
+
+    def get_unique_hash(self, basename):
+        """
+        Return the full or abbreviated content hash from the basename (without
+        extension) of a unique name.
+        """
+        if ORIGINAL_BASENAME:
+            return basename.rsplit('.', 1)[-1]
+        return basename
+
+    def get_shard_path(self, content_hash, depth=None, width=None):
+        """
+        Return the shard directories for a content hash, e.g. `ab/cd`.
+        """
+        depth = self.shard_depth if depth is None else depth
+        width = self.shard_width if width is None else width
+        return '/'.join(
+            content_hash[i * width:(i + 1) * width] for i in range(depth))
+
+    def split_shard_path(self, path, unique_hash, depth=None, width=None):
+        """
+        Split the path of a unique name (without dedupe path prefix) into its
+        original path and shard directories. Trailing directories are only
+        considered shard directories when they match the unique hash.
+        """
+        depth = self.shard_depth if depth is None else depth
+        segments = path.split('/') if path else []
+        if depth and len(segments) >= depth:
+            shard_path = '/'.join(segments[-depth:])
+            if shard_path == self.get_shard_path(unique_hash, depth, width):
+                return '/'.join(segments[:-depth]), shard_path
+        return path, ''
+
+    def get_resharded_name(self, name, from_depth=0, from_width=None):
+        """
+        Move a unique name from one shard layout to the configured layout,
+        without rehashing its content. Return other names unchanged.
+        """
+        path, basename = posixpath.split(name)
+        if path != DEDUPE_PATH_PREFIX and \
+                not path.startswith(DEDUPE_PATH_PREFIX + '/'):
+            return name
+        path = path[len(DEDUPE_PATH_PREFIX) + 1:]
+        unique_hash = self.get_unique_hash(posixpath.splitext(basename)[0])
+        # Abbreviated hashes must be long enough for all shard directories.
+        if not re.match(r'^[0-9a-f]+$', unique_hash) or \
+                len(unique_hash) < self.shard_depth * self.shard_width:
+            return name
+        # Skip names that are already in the configured layout.
+        if self.split_shard_path(path, unique_hash)[1]:
+            return name
+        path, shard_path = self.split_shard_path(
+            path, unique_hash, from_depth, from_width)
+        return posixpath.join(
+            DEDUPE_PATH_PREFIX,
+            path,
+            self.get_shard_path(unique_hash),
+            basename,
+        )
 
     def _save(self, name, content):
         """
         Save file with a content hash as its name and create a record of its
         original name.
         """
+        unique_name, content_hash, size = self.save_unique(name, content)
+
+        # Create a record of the original name.
+        if unique_name != name:
+            self.record_unique_file(unique_name, name, content_hash, size)
+
+        return unique_name
+
+    def save_unique(self, name, content, content_hash=None):
+        """
+        Save file with a content hash as its name, without creating a record of
+        its original name. Return the unique name, content hash and size.
+
+        Pass `content_hash` if the content has already been hashed with the
+        configured algorithm, so it is not read again.
+
+        This does not touch the database, so it can be called from worker
+        threads that leave `record_unique_file()` to the caller.
+        """
+        # Content that was hashed on upload can be moved or written directly,
+        # without streaming.
+        if self.streaming_save and self.is_local() and not content_hash and \
+                not self.get_precomputed_content_hash(content):
+            unique_name, content_hash, size = \
+                self._save_streaming(name, content)
+        else:
+            # Get content hash and size. Get the size before saving, because
+            # temporary uploaded files are moved.
+            if not content_hash:
+                content_hash = self.generate_content_hash(content)
+            size = self.get_content_size(content)
+
+            # Get unique name.
+            unique_name = self.get_unique_name(name, content_hash)
+
+            # Only save if file does not already exist, because existing files
+            # with the same name must also have the same content.
+            if not self.unique_name_exists(unique_name):
+                super(UniqueMixin, self)._save(unique_name, content)
+                self.exists_cache.add(unique_name)
+                self.schedule_compression(unique_name, size)
+            else:
+                self.touch_unique_file(unique_name)
+
+        return unique_name, content_hash, size
+
+    def touch_unique_file(self, name):
+        """
+        Update the inode change time of an existing local file that is saved
+        again, so `gc_unique_storage` keeps it for another grace period.
+        """
+        if not self.is_local():
+            return
+        try:
+            os.utime(self.path(name))
+        except OSError as e:
+            # Deleted since it was known to exist, e.g. by `gc_unique_storage`.
+            if e.errno != errno.ENOENT:
+                raise
+
+    def record_unique_file(self, name, original_name, content_hash, size):
+        """
+        Create a record of the original name, content hash and size for a
+        unique name. Only one record is created for each unique name and
+        original name, no matter how many times the same file is saved.
+        """
         from ixc_whitenoise.models import UniqueFile  # Avoid circular import
+        unique_file, created = UniqueFile.objects.get_or_create(
+            name=name,
+            original_name=original_name,
+            defaults={
+                'content_hash': content_hash,
+                'hash_algorithm': self.hash_algorithm,
+                'size': size,
+            },
+        )
+        if created:
+            # Avoid redirecting to a stale unique name, or 404ing, when the
+            # original name is requested.
+            resolution_cache.invalidate(original_name)
+            return unique_file
+        # Fill in the content hash and size for records created before they
+        # were recorded.
+        if not unique_file.content_hash:
+            UniqueFile.objects \
+                .filter(pk=unique_file.pk, content_hash='') \
+                .update(
+                    content_hash=content_hash,
+                    hash_algorithm=self.hash_algorithm,
+                    size=size,
+                )
+        # Keep the file for another `gc_unique_storage` grace period.
+        now = timezone.now()
+        if unique_file.last_seen < now - datetime.timedelta(
+                seconds=LAST_SEEN_INTERVAL):
+            UniqueFile.objects \
+                .filter(pk=unique_file.pk) \
+                .update(last_seen=now)
+        return unique_file
 
-        # Get content hash.
-        content_hash = self.generate_content_hash(content)
+    def save_many(self, files, max_workers=None):
+        """
+        Save an iterable of `(name, content)` pairs with content hashes as
+        their names and create records of their original names. Content is
+        hashed and written in a thread pool, identical content is only
+        written once, and all records are created with a single query (Django
+        2.2+).
 
-        # Get unique name.
-        unique_name = self.get_unique_name(name, content_hash)
+        Return the unique names, in the same order as `files`.
+        """
+        # Avoid circular import.
+        from ixc_whitenoise.models import UniqueFile, get_names_hash
+
+        # Prepare names and content like `Storage.save()`.
+        prepared = []
+        for name, content in files:
+            if name is None:
+                name = content.name
+            if not hasattr(content, 'chunks'):
+                content = File(content, name)
+            prepared.append((self.get_available_name(name), content))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            hashes = list(executor.map(
+                lambda item: self.generate_content_hash(item[1]), prepared))
+            unique_names = [
+                self.get_unique_name(name, content_hash)
+                for (name, content), content_hash in zip(prepared, hashes)
+            ]
+
+            # Only save the first content for each unique name.
+            first_contents = {}
+            for unique_name, (name, content), content_hash in zip(
+                    unique_names, prepared, hashes):
+                first_contents.setdefault(
+                    unique_name, (name, content, content_hash))
+            sizes = dict(
+                (unique_name, size) for unique_name, content_hash, size
+                in executor.map(
+                    lambda item: self.save_unique(*item),
+                    first_contents.values(),
+                )
+            )
+
+        # Ensure that the names are still valid, like `Storage.save()`.
+        if validate_file_name is not None:
+            for unique_name in unique_names:
+                validate_file_name(unique_name, allow_relative_path=True)
+
+        # Create records of the original names.
+        records = {}
+        for unique_name, (name, content), content_hash in zip(
+                unique_names, prepared, hashes):
+            if unique_name != name:
+                records[(unique_name, name)] = \
+                    (content_hash, sizes[unique_name])
+        if not records:
+            return unique_names
+
+        # Conflicts cannot be ignored before Django 2.2.
+        if django.VERSION[:2] < (2, 2):
+            for (unique_name, name), (content_hash, size) in records.items():
+                self.record_unique_file(unique_name, name, content_hash, size)
+            return unique_names
+
+        unique_files = [
+            UniqueFile(
+                name=unique_name,
+                original_name=name,
+                content_hash=content_hash,
+                hash_algorithm=self.hash_algorithm,
+                size=size,
+                names_hash=get_names_hash(unique_name, name),
+            )
+            for (unique_name, name), (content_hash, size) in records.items()
+        ]
+        UniqueFile.objects.bulk_create(unique_files, ignore_conflicts=True)
+        for unique_name, name in records:
+            resolution_cache.invalidate(name)
+
+        # Keep existing files for another `gc_unique_storage` grace period.
+        # Records created above were seen now.
+        now = timezone.now()
+        names_hashes = [unique_file.names_hash for unique_file in unique_files]
+        for i in range(0, len(names_hashes), 1000):
+            UniqueFile.objects \
+                .filter(
+                    names_hash__in=names_hashes[i:i + 1000],
+                    last_seen__lt=now - datetime.timedelta(
+                        seconds=LAST_SEEN_INTERVAL),
+                ) \
+                .update(last_seen=now)
+
+        return unique_names
+
+    def _save_streaming(self, name, content):
+        """
+        Write content to a temporary file in the dedupe directory while hashing
+        it, then hard link the temporary file to its unique name. Each byte is
+        read once. When the unique name already exists, because the same
+        content was saved before or is being saved concurrently by another
+        process, the link fails and the temporary file is simply dropped.
+
+        Return the unique name, content hash and size.
+        """
+        temp_path = self.path(posixpath.join(
+            DEDUPE_PATH_PREFIX, STREAMING_SAVE_TEMP_DIR, uuid.uuid4().hex))
+        self._makedirs(os.path.dirname(temp_path))
+
+        try:
+            # The current umask value is masked out by os.open!
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                         getattr(os, 'O_BINARY', 0), 0o666)
+            content_hash = self.new_hash()
+            size = 0
+            with os.fdopen(fd, 'wb') as temp_file:
+                for chunk in self.iter_content_chunks(content):
+                    content_hash.update(chunk)
+                    temp_file.write(chunk)
+                    size += len(chunk)
+            content_hash = content_hash.hexdigest()
+            if self.file_permissions_mode is not None:
+                os.chmod(temp_path, self.file_permissions_mode)
+
+            unique_name = self.get_unique_name(name, content_hash)
+            full_path = self.path(unique_name)
+            self._makedirs(os.path.dirname(full_path))
+
+            # Linking never replaces an existing file, so there is no window in
+            # which a partially written file is visible under a unique name.
+            try:
+                os.link(temp_path, full_path)
+                created = True
+            except OSError as e:
+                created = False
+                if e.errno != errno.EEXIST:
+                    # Hard links are not supported here. Fall back to rename,
+                    # which is atomic but may replace an identical file.
+                    if not os.path.exists(full_path):
+                        os.rename(temp_path, full_path)
+                        created = True
+        finally:
+            try:
+                os.unlink(temp_path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+        self.exists_cache.add(unique_name)
+        if created:
+            self.schedule_compression(unique_name, size)
+        else:
+            self.touch_unique_file(unique_name)
+        return unique_name, content_hash, size
+
+    def save_from_path(self, name, path, move=False):
+        """
+        Save an existing local file with a content hash as its name and create
+        a record of its original name, without copying its data when
+        possible. Return the unique name.
+        """
+        unique_name, content_hash, size = \
+            self.save_unique_from_path(name, path, move)
 
         # Create a record of the original name.
         if unique_name != name:
-            UniqueFile.objects.create(name=unique_name, original_name=name)
-
-        # Only save if file does not already exist, because existing files with
-        # the same name must also have the same content.
-        if not self.exists(unique_name):
-            super(UniqueMixin, self)._save(unique_name, content)
+            self.record_unique_file(unique_name, name, content_hash, size)
 
         return unique_name
 
+    def save_unique_from_path(self, name, path, move=False):
+        """
+        Like `save_unique()`, for an existing local file. The file is hashed,
+        then hard linked into place, so only metadata is written. When that is
+        not possible, e.g. across file systems, the file is renamed (if `move`
+        is true), reflinked or copied. With `move`, the file at `path` is
+        always removed.
+
+        Hard linked files share their data and permissions with `path`, which
+        must not be modified in place afterwards.
+
+        Return the unique name, content hash and size.
+        """
+        if not self.is_local():
+            with open(path, 'rb') as f:
+                result = self.save_unique(name, File(f, name))
+            if move:
+                os.unlink(path)
+            return result
+
+        with open(path, 'rb') as f:
+            content = File(f, name)
+            content_hash = self.generate_content_hash(content)
+            size = content.size
+
+        unique_name = self.get_unique_name(name, content_hash)
+        full_path = self.path(unique_name)
+
+        # Existing files with the same name must also have the same content.
+        # Check the file itself, which is cheap, because `path` may be removed.
+        if not os.path.exists(full_path):
+            self._makedirs(os.path.dirname(full_path))
+            self._place_file(path, full_path, move)
+            self.schedule_compression(unique_name, size)
+        else:
+            self.touch_unique_file(unique_name)
+        self.exists_cache.add(unique_name)
+
+        if move and os.path.exists(path) and \
+                os.path.realpath(path) != os.path.realpath(full_path):
+            os.unlink(path)
+
+        return unique_name, content_hash, size
+
+    def _place_file(self, path, full_path, move):
+        """
+        Create `full_path` with the content of `path`, with the cheapest
+        operation available. Never replace an existing file with a partially
+        written one.
+        """
+        # Hard link. No data is written.
+        try:
+            os.link(path, full_path)
+            return
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                return
+
+        # Rename. No data is written, and `path` is consumed anyway.
+        if move:
+            try:
+                os.rename(path, full_path)
+                return
+            except OSError:
+                pass
+
+        # Reflink or copy to a temporary file, then link it into place.
+        temp_path = self.path(posixpath.join(
+            DEDUPE_PATH_PREFIX, STREAMING_SAVE_TEMP_DIR, uuid.uuid4().hex))
+        self._makedirs(os.path.dirname(temp_path))
+        try:
+            # The current umask value is masked out by os.open!
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                         getattr(os, 'O_BINARY', 0), 0o666)
+            with open(path, 'rb') as source, os.fdopen(fd, 'wb') as temp_file:
+                if not self._reflink(source, temp_file):
+                    shutil.copyfileobj(source, temp_file, 1024 * 1024)
+            if self.file_permissions_mode is not None:
+                os.chmod(temp_path, self.file_permissions_mode)
+            try:
+                os.link(temp_path, full_path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    if not os.path.exists(full_path):
+                        os.rename(temp_path, full_path)
+        finally:
+            try:
+                os.unlink(temp_path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def should_compress_media(self, name, size=None):
+        """
+        Return `True` if compressed variants should be saved for a file with
+        a unique name.
+        """
+        if not self.compress_media or not self.is_local():
+            return False
+        if size is not None and size > self.compress_media_max_size:
+            return False
+        return self.get_media_compressor().should_compress(name)
+
+    def get_media_compressor(self):
+        extensions = getattr(
+            settings, 'WHITENOISE_SKIP_COMPRESS_EXTENSIONS', None)
+        return Compressor(extensions=extensions, quiet=True)
+
+    def schedule_compression(self, name, size=None):
+        """
+        Save compressed variants of a newly saved file, in a background thread
+        if `compress_media_workers` is set. Errors are logged, not raised,
+        because the file itself has been saved.
+        """
+        if not self.should_compress_media(name, size):
+            return
+        if not self.compress_media_workers:
+            self._compress_media_file(name)
+            return
+        global _compress_media_executor
+        with _compress_media_executor_lock:
+            if _compress_media_executor is None:
+                _compress_media_executor = ThreadPoolExecutor(
+                    max_workers=self.compress_media_workers)
+        _compress_media_executor.submit(self._compress_media_file, name)
+
+    def _compress_media_file(self, name):
+        try:
+            self.compress_media_file(name)
+        except Exception:
+            logger.exception('Unable to compress: %s' % name)
+
+    def compress_media_file(self, name):
+        """
+        Save gzip and brotli compressed variants of a local file next to it,
+        unless they would not be at least `compress_media_min_saving` smaller.
+        Variants have the same modification time as the file, and are written
+        atomically. Return the names of the variants saved.
+        """
+        path = self.path(name)
+        with open(path, 'rb') as f:
+            stat_result = os.fstat(f.fileno())
+            if stat_result.st_size > self.compress_media_max_size:
+                return []
+            data = f.read()
+        if not data:
+            return []
+        max_size = len(data) * (1 - self.compress_media_min_saving)
+        compressor = self.get_media_compressor()
+        compressed_names = []
+        if compressor.use_brotli:
+            compressed = compressor.compress_brotli(data)
+            # If Brotli compression wasn't effective gzip won't be either.
+            if len(compressed) > max_size:
+                return compressed_names
+            self._write_variant(path + '.br', compressed, stat_result)
+            compressed_names.append(name + '.br')
+        if compressor.use_gzip:
+            compressed = compressor.compress_gzip(data)
+            if len(compressed) <= max_size:
+                self._write_variant(path + '.gz', compressed, stat_result)
+                compressed_names.append(name + '.gz')
+        return compressed_names
+
+    def _write_variant(self, full_path, data, stat_result):
+        """
+        Atomically write a compressed variant, so it is never served partially
+        written.
+        """
+        temp_path = self.path(posixpath.join(
+            DEDUPE_PATH_PREFIX, STREAMING_SAVE_TEMP_DIR, uuid.uuid4().hex))
+        self._makedirs(os.path.dirname(temp_path))
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.utime(temp_path, (stat_result.st_atime, stat_result.st_mtime))
+            if self.file_permissions_mode is not None:
+                os.chmod(temp_path, self.file_permissions_mode)
+            os.rename(temp_path, full_path)
+        finally:
+            try:
+                os.unlink(temp_path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def _reflink(self, source, destination):
+        """
+        Share the data of an open source file with an open, empty destination
+        file. Return `False` if the file system does not support it.
+        """
+        if fcntl is None:
+            return False
+        try:
+            fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+        except (IOError, OSError):
+            return False
+        return True
+
+    def _makedirs(self, directory):
+        """
+        Create a directory and its parents, like `FileSystemStorage._save()`.
+        """
+        directory_permissions_mode = getattr(
+            self, 'directory_permissions_mode', None)
+        if directory_permissions_mode is not None:
+            # Set the umask because os.makedirs() doesn't apply the "mode"
+            # argument to intermediate-level directories.
+            old_umask = os.umask(0o777 & ~directory_permissions_mode)
+            try:
+                os.makedirs(directory, directory_permissions_mode, exist_ok=True)
+            finally:
+                os.umask(old_umask)
+        else:
+            os.makedirs(directory, exist_ok=True)
+
+    def is_local(self):
+        """
+        Return `True` if files in this storage have local filesystem paths.
+        """
+        try:
+            self.path('')
+        except NotImplementedError:
+            return False
+        return True
+
     def get_available_name(self, name, *args, **kwargs):
         """
         Disable name conflict resolution.
         """
         return name
 
+    def delete(self, name):
+        # Names cannot be removed from the shared filter. Reset it with
+        # `reset_exists_filter()` after deleting files with unique names.
+        super(UniqueMixin, self).delete(name)
+        self.exists_cache.discard(name)
+
     def original_name(self, name):
         """
         Return the latest original name for a file.
@@ -172,10 +1427,95 @@ class UniqueMixin(object):
         except UniqueFile.DoesNotExist:
             return name
 
+    # Async counterparts for ASGI. Content is hashed and written with
+    # `sync_to_async(thread_sensitive=False)`, which does not touch the ORM,
+    # so concurrent saves to slow (e.g. remote) storage do not queue up behind
+    # the single thread used by `sync_to_async()` for the ORM. Queries use
+    # Django's async ORM where available (Django 4.1+).
+
+    async def asave(self, name, content, max_length=None):
+        """
+        Like `save()`, without blocking the event loop.
+        """
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        name = self.get_available_name(name, max_length=max_length)
+
+        unique_name, content_hash, size = await sync_to_async(
+            self.save_unique, thread_sensitive=False)(name, content)
+        if validate_file_name is not None:
+            validate_file_name(unique_name, allow_relative_path=True)
+
+        # Create a record of the original name.
+        if unique_name != name:
+            await self.arecord_unique_file(
+                unique_name, name, content_hash, size)
+
+        return unique_name
+
+    async def arecord_unique_file(self, name, original_name, content_hash,
+                                  size):
+        """
+        Like `record_unique_file()`, without blocking the event loop.
+        """
+        from ixc_whitenoise.models import UniqueFile  # Avoid circular import
+        if not hasattr(UniqueFile.objects, 'aget_or_create'):
+            return await sync_to_async(self.record_unique_file)(
+                name, original_name, content_hash, size)
+        unique_file, created = await UniqueFile.objects.aget_or_create(
+            name=name,
+            original_name=original_name,
+            defaults={
+                'content_hash': content_hash,
+                'hash_algorithm': self.hash_algorithm,
+                'size': size,
+            },
+        )
+        if created:
+            await sync_to_async(resolution_cache.invalidate)(original_name)
+            return unique_file
+        if not unique_file.content_hash:
+            await UniqueFile.objects \
+                .filter(pk=unique_file.pk, content_hash='') \
+                .aupdate(
+                    content_hash=content_hash,
+                    hash_algorithm=self.hash_algorithm,
+                    size=size,
+                )
+        now = timezone.now()
+        if unique_file.last_seen < now - datetime.timedelta(
+                seconds=LAST_SEEN_INTERVAL):
+            await UniqueFile.objects \
+                .filter(pk=unique_file.pk) \
+                .aupdate(last_seen=now)
+        return unique_file
+
+    async def aexists(self, name):
+        """
+        Like `exists()`, without blocking the event loop.
+        """
+        return await sync_to_async(
+            self.exists, thread_sensitive=False)(name)
+
+    async def aoriginal_name(self, name):
+        """
+        Like `original_name()`, without blocking the event loop.
+        """
+        from ixc_whitenoise.models import UniqueFile  # Avoid circular import
+        queryset = UniqueFile.objects.filter(name=name).order_by('pk')
+        if not hasattr(queryset, 'afirst'):
+            return await sync_to_async(self.original_name)(name)
+        original_name = await queryset \
+            .values_list('original_name', flat=True).afirst()
+        return original_name or name
+
 
 class CompressedManifestStaticFilesStorage(
         HelpfulWarningMixin,
         RegexURLConverterMixin,
+        GraphPostProcessMixin,
         CompressedManifestStaticFilesStorage):
 
     # When collecting static files during deployment to global storage, there will be a
@@ -193,6 +1533,402 @@ class CompressedManifestStaticFilesStorage(
     # SCSS which is already compressed and given a unique filename.
     manifest_strict = False
 
+    compress_workers = COMPRESS_WORKERS
+    compress_cache_dir = COMPRESS_CACHE_DIR
+    compress_cache_max_size = COMPRESS_CACHE_MAX_SIZE
+
+    static_fingerprints_path = STATIC_FINGERPRINTS_PATH
+
+    # State for an incremental `post_process()`. See `start_incremental()`.
+    _all_paths = None
+    _fingerprints = None
+    _seed_hashed_files = None
+    _dependencies = None
+
+    def post_process(self, paths, *args, **kwargs):
+        incremental = bool(self.static_fingerprints_path) and \
+            not kwargs.get('dry_run')
+        try:
+            if incremental:
+                paths = self.start_incremental(paths)
+            files = super(CompressedManifestStaticFilesStorage, self) \
+                .post_process(paths, *args, **kwargs)
+            for name, hashed_name, processed in files:
+                yield name, hashed_name, processed
+            if incremental:
+                self.finish_incremental()
+        finally:
+            self._all_paths = None
+            self._fingerprints = None
+            self._seed_hashed_files = None
+            self._dependencies = None
+        # Rebuild the shared file index for `WhiteNoiseMiddleware`, including
+        # compressed variants.
+        index_path = get_index_path('static')
+        if index_path and not kwargs.get('dry_run'):
+            build_file_index(self.location, index_path)
+
+    def get_fingerprint_signature(self):
+        """
+        Return the settings that affect post-processing. Fingerprints saved
+        with other settings are ignored.
+        """
+        return [
+            django.get_version(),
+            '%s.%s' % (self.__class__.__module__, self.__class__.__name__),
+            settings.STATIC_URL,
+            self.manifest_version,
+            self.max_post_process_passes,
+            self.graph_post_process and self.post_process_cycles,
+            repr(self.patterns),
+            self.keep_only_hashed_files,
+            getattr(settings, 'WHITENOISE_SKIP_COMPRESS_EXTENSIONS', None),
+            brotli_installed,
+        ]
+
+    def get_source_stat(self, storage, path):
+        """
+        Return the size and modification time of a source file, or `None` if
+        it has no local path.
+        """
+        try:
+            stat_result = os.stat(storage.path(path))
+        except (NotImplementedError, OSError):
+            return None
+        return stat_result.st_size, stat_result.st_mtime
+
+    def get_source_hash(self, storage, path):
+        content_hash = hashlib.md5()
+        with storage.open(path) as f:
+            for chunk in f.chunks():
+                content_hash.update(chunk)
+        return content_hash.hexdigest()
+
+    def start_incremental(self, paths):
+        """
+        Compare source files with their saved fingerprints and return the
+        paths to post-process: files that changed, were added or whose hashed
+        file is missing, and all files that reference them, directly or
+        indirectly. Other files keep their hashed names from the last run.
+        """
+        signature = self.get_fingerprint_signature()
+        old_fingerprints = load_fingerprints(
+            self.static_fingerprints_path, signature)
+
+        fingerprints = {}
+        names = {}
+        changed = set(old_fingerprints)
+        for name, (storage, path) in paths.items():
+            clean_name = self.clean_name(name)
+            names[clean_name] = name
+            old = old_fingerprints.get(clean_name)
+            stat = self.get_source_stat(storage, path)
+            if old is not None and stat is not None and \
+                    (old.size, old.mtime) == stat:
+                content_hash = old.content_hash
+            else:
+                content_hash = self.get_source_hash(storage, path)
+            size, mtime = stat or (None, None)
+            if old is not None and old.content_hash == content_hash and \
+                    old.hashed_name and self.exists(old.hashed_name):
+                fingerprints[clean_name] = old._replace(size=size, mtime=mtime)
+                changed.discard(clean_name)
+            else:
+                fingerprints[clean_name] = Fingerprint(
+                    size, mtime, content_hash, None, [])
+                changed.add(clean_name)
+
+        # Removed files are changed too, so files that reference them are
+        # processed again.
+        dirty = get_dependents(old_fingerprints, changed) & set(names)
+        for clean_name in dirty:
+            fingerprints[clean_name] = fingerprints[clean_name]._replace(
+                hashed_name=None, dependencies=[])
+
+        self._all_paths = paths
+        self._fingerprints = fingerprints
+        self._dependencies = {}
+        self._seed_hashed_files = dict(
+            (self.hash_key(clean_name), fingerprint.hashed_name)
+            for clean_name, fingerprint in fingerprints.items()
+            if clean_name not in dirty
+        )
+        logger.info('Post-processing %s of %s files.' % (
+            len(dirty), len(paths)))
+        return dict(
+            (name, paths[name]) for name in paths
+            if self.clean_name(name) in dirty
+        )
+
+    def finish_incremental(self):
+        """
+        Save fingerprints with the hashed names and references found in this
+        run.
+        """
+        for clean_name, fingerprint in self._fingerprints.items():
+            if fingerprint.hashed_name is not None:
+                # Unchanged. Remove the original file again, which
+                # `collectstatic` copies if it is missing.
+                if self.keep_only_hashed_files and \
+                        fingerprint.hashed_name != clean_name:
+                    self.delete_files([clean_name])
+                continue
+            self._fingerprints[clean_name] = fingerprint._replace(
+                hashed_name=self.hashed_files.get(self.hash_key(clean_name)),
+                dependencies=sorted(self._dependencies.get(clean_name, ())),
+            )
+        save_fingerprints(
+            self.static_fingerprints_path,
+            self.get_fingerprint_signature(),
+            self._fingerprints,
+        )
+
+    def _post_process(self, paths, adjustable_paths, hashed_files):
+        # Resolve references to unchanged files to their hashed names from
+        # the last run.
+        if self._seed_hashed_files:
+            for hash_key, hashed_name in self._seed_hashed_files.items():
+                hashed_files.setdefault(hash_key, hashed_name)
+        return super(CompressedManifestStaticFilesStorage, self) \
+            ._post_process(paths, adjustable_paths, hashed_files)
+
+    def url_converter(self, name, hashed_files=None, template=None):
+        converter = super(CompressedManifestStaticFilesStorage, self) \
+            .url_converter(name, hashed_files, template)
+        if self._dependencies is None:
+            return converter
+        dependencies = self._dependencies.setdefault(
+            self.clean_name(name), set())
+
+        def recording_converter(matchobj):
+            kind, matched, url = self.get_url_match(matchobj)
+            target_name = self.get_target_name(name, url)
+            if target_name:
+                dependencies.add(target_name)
+            return converter(matchobj)
+
+        return recording_converter
+
+    def save_manifest(self):
+        # Save paths in the order a full run would, with the same content.
+        if self._all_paths is not None:
+            hashed_files = {}
+            for name in sorted(
+                    self._all_paths,
+                    key=lambda name: len(name.split(os.sep)),
+                    reverse=True):
+                hash_key = self.hash_key(self.clean_name(name))
+                if hash_key in self.hashed_files:
+                    hashed_files[hash_key] = self.hashed_files[hash_key]
+            for hash_key, hashed_name in self.hashed_files.items():
+                hashed_files.setdefault(hash_key, hashed_name)
+            self.hashed_files = hashed_files
+        super(CompressedManifestStaticFilesStorage, self).save_manifest()
+
+    def compress_files(self, names):
+        """
+        Compress files in a process pool, when `compress_workers` is not `1`,
+        and reuse compressed files from `compress_cache_dir`, when set. Files
+        are yielded in sorted order, so output does not depend on how work is
+        scheduled.
+
+        Workers create a `Compressor` with the settings of the one returned by
+        `create_compressor()`. When it returns another class, which workers
+        cannot recreate and may compress differently, files are compressed
+        serially in this process, without the cache.
+        """
+        extensions = getattr(
+            settings, 'WHITENOISE_SKIP_COMPRESS_EXTENSIONS', None)
+        compressor = self.create_compressor(extensions=extensions, quiet=True)
+        if type(compressor) is not Compressor or \
+                (self.compress_workers == 1 and not self.compress_cache_dir):
+            for name, compressed_name in super(
+                    CompressedManifestStaticFilesStorage, self) \
+                    .compress_files(names):
+                yield name, compressed_name
+            return
+        names = sorted(
+            name for name in names if compressor.should_compress(name))
+        paths = [self.path(name) for name in names]
+        args = (
+            compress_path,
+            paths,
+            [extensions] * len(paths),
+            [self.compress_cache_dir] * len(paths),
+            [compressor.use_gzip] * len(paths),
+            [compressor.use_brotli] * len(paths),
+        )
+        executor = None
+        if self.compress_workers != 1:
+            executor = ProcessPoolExecutor(max_workers=self.compress_workers)
+        try:
+            results = executor.map(*args) if executor else map(*args)
+            for name, path, compressed_paths in zip(names, paths, results):
+                prefix_len = len(path) - len(name)
+                for compressed_path in compressed_paths:
+                    yield name, compressed_path[prefix_len:]
+        finally:
+            if executor:
+                executor.shutdown()
+        if self.compress_cache_dir:
+            evict_compression_cache(
+                self.compress_cache_dir, self.compress_cache_max_size)
+
+
+class LocalCacheMixin(object):
+    """
+    Keep a size bounded local disk cache of files with unique names, in front
+    of a remote storage class with `UniqueMixin`:
+
+        class CachedS3Storage(LocalCacheMixin, UniqueMixin, S3Boto3Storage):
+            pass
+
+    Content never changes under a unique name, so cached files are never
+    revalidated. The least recently used files are evicted when the cache is
+    full, by modification time, which is updated on each hit. `exists()` is
+    not answered from the cache, because files may have been deleted from
+    remote storage (e.g. by `gc_unique_storage`) and must be saved again.
+    """
+
+    local_cache_dir = LOCAL_CACHE_DIR
+    local_cache_max_size = LOCAL_CACHE_MAX_SIZE
+
+    def __init__(self, *args, **kwargs):
+        super(LocalCacheMixin, self).__init__(*args, **kwargs)
+        self.local_cache_lock = threading.Lock()
+        # Unknown until the cache directory is first scanned.
+        self.local_cache_size = None
+
+    def is_cacheable(self, name):
+        """
+        Return `True` if the named file has a unique name and can be cached.
+        """
+        return bool(self.local_cache_dir) and \
+            name.startswith(DEDUPE_PATH_PREFIX + '/')
+
+    def get_cache_path(self, name):
+        return safe_join(self.local_cache_dir, name)
+
+    def cached_path(self, name):
+        """
+        Return the local path of a cached file, downloading it first if it is
+        not cached yet. Return `None` if the file cannot be cached or does not
+        exist.
+        """
+        if not self.is_cacheable(name):
+            return None
+        path = self.get_cache_path(name)
+
+        # Mark as recently used.
+        try:
+            os.utime(path, None)
+            return path
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        # Remote storage classes raise their own errors (e.g. `ClientError`)
+        # when opening a missing file, so check first.
+        if not super(LocalCacheMixin, self).exists(name):
+            return None
+
+        # Download to a temporary file, then rename it into place, so other
+        # processes never see a partial file.
+        temp_path = os.path.join(
+            self.local_cache_dir, STREAMING_SAVE_TEMP_DIR, uuid.uuid4().hex)
+        for directory in (os.path.dirname(path), os.path.dirname(temp_path)):
+            if not os.path.isdir(directory):
+                os.makedirs(directory, exist_ok=True)
+        try:
+            with super(LocalCacheMixin, self).open(name, 'rb') as content, \
+                    open(temp_path, 'wb') as f:
+                for chunk in content.chunks():
+                    f.write(chunk)
+            os.rename(temp_path, path)
+        finally:
+            try:
+                os.unlink(temp_path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+        self.add_local_cache_size(os.path.getsize(path))
+        return path
+
+    def add_local_cache_size(self, size):
+        """
+        Account for a newly cached file, and evict files when the cache is
+        full. The cache directory is only scanned when the size is unknown or
+        exceeded.
+        """
+        with self.local_cache_lock:
+            if self.local_cache_size is None:
+                self.local_cache_size = sum(
+                    size for mtime, size, path in self.iter_local_cache())
+            else:
+                self.local_cache_size += size
+            if self.local_cache_size > self.local_cache_max_size:
+                self.evict_local_cache()
+
+    def iter_local_cache(self):
+        """
+        Yield `(mtime, size, path)` for all cached files.
+        """
+        for dirpath, dirnames, filenames in os.walk(self.local_cache_dir):
+            if STREAMING_SAVE_TEMP_DIR in dirnames:
+                dirnames.remove(STREAMING_SAVE_TEMP_DIR)
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat_result = os.stat(path)
+                except OSError:
+                    continue
+                yield stat_result.st_mtime, stat_result.st_size, path
+
+    def evict_local_cache(self):
+        """
+        Delete the least recently used files until the cache is 90% full.
+        Other processes may evict and add files at the same time, so the size
+        is recounted from the directory.
+        """
+        entries = sorted(self.iter_local_cache())
+        total_size = sum(size for mtime, size, path in entries)
+        target_size = self.local_cache_max_size * 0.9
+        for mtime, size, path in entries:
+            if total_size <= target_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            total_size -= size
+        self.local_cache_size = total_size
+
+    def open(self, name, mode='rb'):
+        if mode in ('r', 'rb'):
+            path = self.cached_path(name)
+            if path is not None:
+                return File(open(path, mode), name)
+        return super(LocalCacheMixin, self).open(name, mode)
+
+    def size(self, name):
+        if self.is_cacheable(name):
+            try:
+                return os.path.getsize(self.get_cache_path(name))
+            except OSError:
+                pass
+        return super(LocalCacheMixin, self).size(name)
+
+    def delete(self, name):
+        super(LocalCacheMixin, self).delete(name)
+        if self.is_cacheable(name):
+            try:
+                os.unlink(self.get_cache_path(name))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
 
 class UniqueStorage(UniqueMixin, FileSystemStorage):
     pass
@@ -0,0 +1,59 @@
+"""
+Upload handlers that hash uploaded content as it arrives, so `UniqueMixin` does
+not need to read it again. Use in place of Django's default handlers:
+
+    FILE_UPLOAD_HANDLERS = [
+        'ixc_whitenoise.uploadhandler.MemoryFileUploadHandler',
+        'ixc_whitenoise.uploadhandler.TemporaryFileUploadHandler',
+    ]
+"""
+
+from django.core.files import uploadhandler
+
+from ixc_whitenoise.hashes import new_hash
+from ixc_whitenoise.storage import HASH_ALGORITHM
+
+
+class ContentHashUploadHandlerMixin(object):
+    """
+    Attach `content_hash` and `content_hash_algorithm` attributes to the
+    uploaded file.
+    """
+
+    hash_algorithm = HASH_ALGORITHM
+
+    def new_file(self, *args, **kwargs):
+        # The memory handler raises `StopFutureHandlers` when it will keep the
+        # file.
+        try:
+            super(ContentHashUploadHandlerMixin, self).new_file(*args, **kwargs)
+        finally:
+            self.content_hash = None
+            # Only hash content that this handler will keep. The memory handler
+            # passes large files through to the next handler.
+            if getattr(self, 'activated', True):
+                self.content_hash = new_hash(self.hash_algorithm)
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.content_hash is not None:
+            self.content_hash.update(raw_data)
+        return super(ContentHashUploadHandlerMixin, self) \
+            .receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super(ContentHashUploadHandlerMixin, self) \
+            .file_complete(file_size)
+        if file is not None and self.content_hash is not None:
+            file.content_hash = self.content_hash.hexdigest()
+            file.content_hash_algorithm = self.hash_algorithm
+        return file
+
+
+class MemoryFileUploadHandler(
+        ContentHashUploadHandlerMixin, uploadhandler.MemoryFileUploadHandler):
+    pass
+
+
+class TemporaryFileUploadHandler(
+        ContentHashUploadHandlerMixin, uploadhandler.TemporaryFileUploadHandler):
+    pass
@@ -0,0 +1,149 @@
+import heapq
+import json
+import logging
+import os
+import posixpath
+import shutil
+import tempfile
+
+from django.db import models
+from django.db.models.fields.files import FileField
+
+from ixc_whitenoise.storage import \
+    DEDUPE_PATH_PREFIX, STREAMING_SAVE_TEMP_DIR, UniqueMixin, unlazy_storage
+
+try:
+    from django.apps import apps
+except ImportError:
+    get_models = models.get_models
+else:
+    get_models = apps.get_models
+
+logger = logging.getLogger(__name__)
+
+
+def get_unique_file_fields():
+    """
+    Return a list of `(model, field_names)` tuples for all models with file
+    fields that use `UniqueMixin`.
+    """
+    unique_file_fields = []
+    for model in get_models():
+        file_fields = []
+        for field in model._meta.fields:
+            if isinstance(field, FileField):
+                storage = unlazy_storage(field.storage)
+                if isinstance(storage, UniqueMixin):
+                    file_fields.append(field.name)
+                    logger.info('Found unique file field: %s.%s (%r)' % (
+                        model._meta.app_label,
+                        model._meta.label,
+                        field.name,
+                    ))
+                else:
+                    logger.debug('Skipping file field: %s.%s (%r)' % (
+                        model._meta.app_label,
+                        model._meta.label,
+                        field.name,
+                    ))
+        if file_fields:
+            unique_file_fields.append((model, file_fields))
+    return unique_file_fields
+
+
+def external_sort(iterable, chunk_size=1000000, temp_dir=None):
+    """
+    Yield the strings (or tuples of JSON serializable values) from `iterable`
+    in sorted order, with duplicates removed, using bounded memory. Sorted
+    chunks of `chunk_size` values are written to temporary files and then
+    merged. Tuples are yielded as lists.
+    """
+    chunks = []
+    try:
+        chunk = []
+        for value in iterable:
+            chunk.append(value)
+            if len(chunk) >= chunk_size:
+                chunks.append(_write_sorted_chunk(chunk, temp_dir))
+                chunk = []
+        if chunk or not chunks:
+            chunks.append(_write_sorted_chunk(chunk, temp_dir))
+        previous = None
+        for value in heapq.merge(*[
+                (json.loads(line) for line in f) for f in chunks]):
+            if value != previous:
+                yield value
+                previous = value
+    finally:
+        for f in chunks:
+            f.close()
+
+
+def _write_sorted_chunk(chunk, temp_dir):
+    # JSON encoding keeps one value per line, even with newlines in names.
+    f = tempfile.TemporaryFile('w+', dir=temp_dir)
+    for value in sorted(set(chunk)):
+        f.write(json.dumps(value))
+        f.write('\n')
+    f.seek(0)
+    return f
+
+
+def iter_unique_names(storage):
+    """
+    Yield all names under `DEDUPE_PATH_PREFIX` in a storage, except incomplete
+    streaming saves.
+    """
+    if storage.is_local():
+        root = storage.path('')
+        for dirpath, dirnames, filenames in os.walk(
+                storage.path(DEDUPE_PATH_PREFIX)):
+            if STREAMING_SAVE_TEMP_DIR in dirnames:
+                dirnames.remove(STREAMING_SAVE_TEMP_DIR)
+            for filename in filenames:
+                yield os.path.relpath(
+                    os.path.join(dirpath, filename), root,
+                ).replace(os.path.sep, '/')
+    else:
+        directories = [DEDUPE_PATH_PREFIX]
+        while directories:
+            directory = directories.pop()
+            dirnames, filenames = storage.listdir(directory)
+            for dirname in dirnames:
+                if dirname != STREAMING_SAVE_TEMP_DIR:
+                    directories.append(posixpath.join(directory, dirname))
+            for filename in filenames:
+                yield posixpath.join(directory, filename)
+
+
+def quarantine_file(storage, name, quarantine_dir):
+    """
+    Move a file from a storage to a local quarantine directory, keeping its
+    name.
+    """
+    path = os.path.join(quarantine_dir, *name.split('/'))
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if storage.is_local():
+        shutil.move(storage.path(name), path)
+        remove_empty_directories(storage, name)
+    else:
+        with storage.open(name, 'rb') as content, open(path, 'wb') as f:
+            shutil.copyfileobj(content, f)
+        storage.delete(name)
+
+
+def remove_empty_directories(storage, name):
+    """
+    Remove empty directories left behind by a deleted local file, up to
+    `DEDUPE_PATH_PREFIX`.
+    """
+    root = storage.path(DEDUPE_PATH_PREFIX)
+    directory = os.path.dirname(storage.path(name))
+    while directory != root and directory.startswith(root):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            break
+        directory = os.path.dirname(directory)
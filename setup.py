@@ -32,9 +32,15 @@ setuptools.setup(
         'whitenoise>=4.1.3,<5',  # >=5 requires Python 3
     ],
     extras_require={
+        'blake3': [
+            'blake3',
+        ],
         'pipeline': [
             'django-pipeline',
         ],
+        'xxhash': [
+            'xxhash',
+        ],
     },
     setup_requires=['setuptools_scm'],
 )
@@ -0,0 +1,59 @@
+import os
+import shutil
+import tempfile
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.test import TestCase, override_settings
+from django.utils.functional import empty
+
+from ixc_whitenoise.cache import resolution_cache
+from ixc_whitenoise.storage import unlazy_storage
+
+
+class MediaTestCase(TestCase):
+    """
+    Give each test an empty `MEDIA_ROOT`, a new default storage instance and
+    an empty resolution cache, so nothing is remembered between tests.
+    """
+
+    def setUp(self):
+        super(MediaTestCase, self).setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        default_storage._wrapped = empty
+        self.addCleanup(setattr, default_storage, '_wrapped', empty)
+        self.storage = unlazy_storage(default_storage)
+        resolution_cache.local.clear()
+        self.addCleanup(resolution_cache.local.clear)
+
+    def save(self, name, content):
+        return self.storage.save(name, ContentFile(content))
+
+    def write(self, name, content):
+        """
+        Write a file directly, bypassing the storage class.
+        """
+        path = os.path.join(self.media_root, *name.split('/'))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def read(self, name):
+        with open(self.storage.path(name), 'rb') as f:
+            return f.read()
+
+    def age(self, name, days):
+        """
+        Set the access and modification times of a file to `days` ago.
+        """
+        path = self.storage.path(name)
+        stat_result = os.stat(path)
+        offset = days * 24 * 60 * 60
+        os.utime(path, (stat_result.st_atime - offset,
+                        stat_result.st_mtime - offset))
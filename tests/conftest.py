@@ -0,0 +1,42 @@
+import shutil
+import tempfile
+
+import django
+from django.conf import settings
+
+TEMP_DIR = tempfile.mkdtemp()
+
+
+def pytest_configure(config):
+    settings.configure(
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': ':memory:',
+            },
+        },
+        DEFAULT_AUTO_FIELD='django.db.models.AutoField',
+        DEFAULT_FILE_STORAGE='ixc_whitenoise.storage.UniqueStorage',
+        INSTALLED_APPS=[
+            'django.contrib.contenttypes',
+            'django.contrib.staticfiles',
+            'ixc_whitenoise',
+            'tests',
+        ],
+        MEDIA_ROOT=TEMP_DIR,
+        MEDIA_URL='/media/',
+        SECRET_KEY='tests',
+        STATIC_ROOT=TEMP_DIR,
+        STATIC_URL='/static/',
+        USE_TZ=True,
+    )
+    django.setup()
+
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0)
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(TEMP_DIR, ignore_errors=True)
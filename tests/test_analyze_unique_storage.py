@@ -0,0 +1,64 @@
+import json
+import os
+import shutil
+import tempfile
+
+from django.core.management import call_command
+
+from tests.base import MediaTestCase
+from tests.models import Document
+
+
+class AnalyzeUniqueStorageTestCase(MediaTestCase):
+
+    def setUp(self):
+        super(AnalyzeUniqueStorageTestCase, self).setUp()
+        self.write('documents/a.txt', b'same')
+        self.write('documents/b.txt', b'same')
+        self.write('documents/c.txt', b'other')
+        # Deduplicated to a different unique name, because it is in a
+        # different directory.
+        self.write('images/a.txt', b'same')
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir, True)
+
+    def analyze(self, **options):
+        output = os.path.join(self.temp_dir, 'report.json')
+        options.setdefault('path', self.media_root)
+        call_command(
+            'analyze_unique_storage',
+            hash_cache=os.path.join(self.temp_dir, 'hashes.sqlite3'),
+            output=output,
+            **options)
+        with open(output) as f:
+            return json.load(f)
+
+    def test_group_by_unique_name(self):
+        report = self.analyze()
+        self.assertEqual(report['file_count'], 4)
+        self.assertEqual(report['total_bytes'], 17)
+        self.assertEqual(report['unique_bytes'], 13)
+        self.assertEqual(report['reclaimable_bytes'], 4)
+        self.assertEqual(len(report['duplicates']), 1)
+        group = report['duplicates'][0]
+        self.assertEqual(group['count'], 2)
+        self.assertEqual(group['reclaimable'], 4)
+        self.assertEqual(
+            group['examples'], ['documents/a.txt', 'documents/b.txt'])
+        self.assertEqual(group['unique_name'], self.storage.get_unique_name(
+            'documents/a.txt', group['content_hash']))
+
+    def test_chunks(self):
+        # Files and groups sorted in chunks of one are merged on disk.
+        report = self.analyze(chunk_size=1)
+        self.assertEqual(report['unique_bytes'], 13)
+        self.assertEqual(
+            report['duplicates'], self.analyze()['duplicates'])
+
+    def test_field_files(self):
+        for name in ('documents/a.txt', 'documents/b.txt', 'documents/b.txt'):
+            Document.objects.create(file=name)
+        report = self.analyze(path=None)
+        # Files in several instances are counted once.
+        self.assertEqual(report['file_count'], 2)
+        self.assertEqual(report['reclaimable_bytes'], 4)
@@ -0,0 +1,216 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from django.core.cache import caches
+from django.test import override_settings
+
+from ixc_whitenoise.bloom import HEADER_V1, MAGIC_V1, BloomFilter
+from ixc_whitenoise.cache import (
+    ExistsCache, LRUCache, ResolutionCache, reset_exists_filter,
+    resolution_cache)
+
+from tests.base import MediaTestCase
+
+
+class ExistsCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir, True)
+        self.filter_path = os.path.join(self.temp_dir, 'exists.bloom')
+
+    def get_cache(self):
+        return ExistsCache(10, self.filter_path, 1000, 1e-6)
+
+    def test_save(self):
+        cache = self.get_cache()
+        cache.add('dd/a.txt')
+        cache.flush()
+        self.assertIn('dd/a.txt', self.get_cache())
+        self.assertTrue(os.path.exists(self.filter_path + '.lock'))
+
+    def test_save_after_reset(self):
+        cache = self.get_cache()
+        cache.add('dd/a.txt')
+        cache.flush()
+        cache.add('dd/b.txt')
+        reset_exists_filter(self.filter_path, 1000, 1e-6)
+        # Names added before the reset are dropped, instead of overwriting
+        # the reset filter with the old generation.
+        cache.flush()
+        saved = BloomFilter.load(self.filter_path)
+        self.assertEqual(saved.generation, 1)
+        self.assertNotIn('dd/a.txt', saved)
+        self.assertNotIn('dd/b.txt', saved)
+        self.assertNotIn('dd/b.txt', cache)
+
+    def test_load_corrupt(self):
+        with open(self.filter_path, 'wb') as f:
+            f.write(b'corrupt')
+        cache = self.get_cache()
+        self.assertNotIn('dd/a.txt', cache)
+        cache.add('dd/a.txt')
+        cache.flush()
+        self.assertIn('dd/a.txt', self.get_cache())
+
+    def test_full(self):
+        cache = ExistsCache(0, self.filter_path, 10, 1e-6)
+        for i in range(11):
+            cache.add('dd/%s.txt' % i)
+        # Names are not trusted past the capacity of the filter, and must be
+        # confirmed by storage.
+        self.assertNotIn('dd/0.txt', cache)
+        # The filter file is reset instead of saved.
+        cache.flush()
+        saved = BloomFilter.load(self.filter_path)
+        self.assertEqual((saved.generation, saved.count), (1, 0))
+        cache.add('dd/0.txt')
+        self.assertIn('dd/0.txt', cache)
+
+    def test_clear(self):
+        cache = self.get_cache()
+        cache.add('dd/a.txt')
+        reset_exists_filter(self.filter_path, 1000, 1e-6)
+        cache.clear()
+        self.assertNotIn('dd/a.txt', cache)
+
+
+class BloomFilterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir, True)
+        self.path = os.path.join(self.temp_dir, 'exists.bloom')
+
+    def test_count(self):
+        bloom = BloomFilter(100, 1e-6)
+        bloom.add('a')
+        bloom.add('a')
+        bloom.add('b')
+        self.assertEqual(bloom.count, 2)
+        bloom.save(self.path)
+        self.assertEqual(BloomFilter.load(self.path).count, 2)
+
+    def test_update(self):
+        bloom = BloomFilter(100, 1e-6)
+        other = BloomFilter(100, 1e-6)
+        for i in range(20):
+            bloom.add(str(i))
+            other.add(str(i + 10))
+        bloom.update(other)
+        # The estimated number of distinct values, not 40.
+        self.assertAlmostEqual(bloom.count, 30, delta=2)
+        bloom.update(other)
+        self.assertAlmostEqual(bloom.count, 30, delta=2)
+
+    def test_is_full(self):
+        bloom = BloomFilter(10, 1e-6)
+        for i in range(10):
+            bloom.add(str(i))
+        self.assertFalse(bloom.is_full())
+        bloom.add('10')
+        self.assertTrue(bloom.is_full())
+
+    def test_load_without_count(self):
+        bloom = BloomFilter(100, 1e-6, generation=3)
+        for i in range(20):
+            bloom.add(str(i))
+        with open(self.path, 'wb') as f:
+            f.write(HEADER_V1.pack(MAGIC_V1, 3, 100, 1e-6))
+            f.write(bloom.bits)
+        loaded = BloomFilter.load(self.path)
+        self.assertEqual(loaded.generation, 3)
+        self.assertIn('0', loaded)
+        self.assertAlmostEqual(loaded.count, 20, delta=2)
+
+    def test_load_corrupt(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'IXWNBLM2')
+        with self.assertRaises(ValueError):
+            BloomFilter.load(self.path)
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_maxsize(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        # The least recently used key is evicted.
+        self.assertEqual(sorted(cache.data), ['a', 'c'])
+
+    def test_ttl(self):
+        cache = LRUCache(10, ttl=60)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        future = time.time() + 61
+        with mock.patch('ixc_whitenoise.cache.time.time', lambda: future):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+
+class ResolutionCacheTestCase(MediaTestCase):
+
+    def setUp(self):
+        super(ResolutionCacheTestCase, self).setUp()
+        self.name = self.save('documents/a.txt', b'a')
+
+    def get_cache(self, **kwargs):
+        cache = ResolutionCache(**kwargs)
+        resolve_patch = mock.patch.object(
+            cache, 'resolve', side_effect=cache.resolve)
+        self.addCleanup(resolve_patch.stop)
+        return cache, resolve_patch.start()
+
+    def test_hit(self):
+        cache, resolve = self.get_cache()
+        self.assertEqual(cache.get('documents/a.txt'), self.name)
+        self.assertEqual(cache.get('documents/a.txt'), self.name)
+        self.assertEqual(resolve.call_count, 1)
+
+    def test_miss(self):
+        cache, resolve = self.get_cache()
+        self.assertIsNone(cache.get('documents/missing.txt'))
+        self.assertIsNone(cache.get('documents/missing.txt'))
+        self.assertEqual(resolve.call_count, 1)
+
+    def test_ttl(self):
+        cache, resolve = self.get_cache(ttl=60)
+        cache.get('documents/missing.txt')
+        future = time.time() + 61
+        with mock.patch('ixc_whitenoise.cache.time.time', lambda: future):
+            self.assertIsNone(cache.get('documents/missing.txt'))
+        self.assertEqual(resolve.call_count, 2)
+
+    def test_invalidate_on_save(self):
+        resolution_cache.get('documents/b.txt')
+        self.assertIn('documents/b.txt', resolution_cache.local)
+        name = self.save('documents/b.txt', b'b')
+        self.assertNotIn('documents/b.txt', resolution_cache.local)
+        self.assertEqual(resolution_cache.get('documents/b.txt'), name)
+
+    @override_settings(CACHES={
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    })
+    def test_shared(self):
+        caches['default'].clear()
+        cache, resolve = self.get_cache(alias='default')
+        self.assertEqual(cache.get('documents/a.txt'), self.name)
+        self.assertIsNone(cache.get('documents/missing.txt'))
+        # Another process gets hits and misses from the shared cache.
+        other_cache, other_resolve = self.get_cache(alias='default')
+        self.assertEqual(other_cache.get('documents/a.txt'), self.name)
+        self.assertIsNone(other_cache.get('documents/missing.txt'))
+        other_resolve.assert_not_called()
+        # Invalidated in all processes.
+        cache.invalidate('documents/a.txt')
+        self.assertIsNone(
+            caches['default'].get(cache.make_key('documents/a.txt')))
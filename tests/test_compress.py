@@ -0,0 +1,201 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from django.test import override_settings
+from whitenoise.compress import Compressor
+
+from ixc_whitenoise import storage as storage_module
+from ixc_whitenoise.compress import compress_path, evict_compression_cache
+from ixc_whitenoise.storage import CompressedManifestStaticFilesStorage
+
+from tests.base import MediaTestCase
+
+CONTENT = b'body { color: red; }\n' * 100
+
+
+class CompressPathTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.cache_dir = os.path.join(self.temp_dir, 'cache')
+        self.root = os.path.join(self.temp_dir, 'root')
+        os.makedirs(self.root)
+
+    def write(self, name, content):
+        path = os.path.join(self.root, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_no_cache(self):
+        path = self.write('a.css', CONTENT)
+        self.assertIn(path + '.gz', compress_path(path))
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_cache_hit(self):
+        a = self.write('a.css', CONTENT)
+        b = self.write('b.css', CONTENT)
+        self.assertEqual(
+            compress_path(a, cache_dir=self.cache_dir), [a + '.gz'])
+        self.assertEqual(
+            compress_path(b, cache_dir=self.cache_dir), [b + '.gz'])
+        self.assertEqual(self.read(a + '.gz'), self.read(b + '.gz'))
+        self.assertEqual(
+            os.stat(b + '.gz').st_mtime, os.stat(b).st_mtime)
+
+    def test_rollback(self):
+        # Content changes and is rolled back, e.g. between deploys. Variants
+        # linked from the cache are replaced, not truncated.
+        other = b'p { margin: 0; }\n' * 100
+        path = self.write('a.css', CONTENT)
+        compress_path(path, cache_dir=self.cache_dir)
+        expected = self.read(path + '.gz')
+        compress_path(path, cache_dir=self.cache_dir)
+        self.write('a.css', other)
+        compress_path(path, cache_dir=self.cache_dir)
+        self.assertNotEqual(self.read(path + '.gz'), expected)
+        self.write('a.css', CONTENT)
+        compress_path(path, cache_dir=self.cache_dir)
+        self.assertEqual(self.read(path + '.gz'), expected)
+        # The cache entry is intact too.
+        copy = self.write('b.css', CONTENT)
+        compress_path(copy, cache_dir=self.cache_dir)
+        self.assertEqual(self.read(copy + '.gz'), expected)
+
+    def test_stale_variants(self):
+        path = self.write('a.css', CONTENT)
+        compress_path(path, cache_dir=self.cache_dir)
+        self.write('a.css', os.urandom(1000))
+        self.assertEqual(compress_path(path, cache_dir=self.cache_dir), [])
+        self.assertFalse(os.path.exists(path + '.gz'))
+
+    def test_incompressible(self):
+        path = self.write('a.css', os.urandom(1000))
+        self.assertEqual(compress_path(path, cache_dir=self.cache_dir), [])
+        self.assertEqual(compress_path(path, cache_dir=self.cache_dir), [])
+        self.assertFalse(os.path.exists(path + '.gz'))
+
+    def test_evict(self):
+        for i in range(3):
+            path = self.write('%s.css' % i, CONTENT + str(i).encode())
+            compress_path(path, cache_dir=self.cache_dir)
+        self.assertEqual(evict_compression_cache(self.cache_dir, 10 ** 9), 0)
+        self.assertEqual(evict_compression_cache(self.cache_dir, 1), 3)
+
+
+class CountingCompressor(Compressor):
+
+    def compress(self, path):
+        self.count = getattr(self, 'count', 0) + 1
+        return super(CountingCompressor, self).compress(path)
+
+
+class CompressFilesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        settings_override = override_settings(STATIC_ROOT=self.temp_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.storage = CompressedManifestStaticFilesStorage()
+        self.names = ['b.css', 'a.css', 'c.jpg']
+        for name in self.names:
+            with open(self.storage.path(name), 'wb') as f:
+                f.write(CONTENT)
+
+    def compress_files(self, workers, create_compressor=None):
+        self.storage.compress_workers = workers
+        if create_compressor:
+            self.storage.create_compressor = create_compressor
+        return list(self.storage.compress_files(self.names))
+
+    def test_workers(self):
+        expected = [('a.css', 'a.css.gz'), ('b.css', 'b.css.gz')]
+        self.assertEqual(self.compress_files(2), expected)
+        self.assertEqual(sorted(self.compress_files(1)), expected)
+
+    def test_compressor_settings(self):
+        # Workers use the settings of the compressor from
+        # `create_compressor()`.
+        self.assertEqual(self.compress_files(
+            2, lambda **kwargs: Compressor(use_gzip=False, **kwargs)), [])
+        self.assertFalse(os.path.exists(self.storage.path('a.css.gz')))
+
+    def test_compressor_class(self):
+        # Other compressor classes are used in this process.
+        compressor = CountingCompressor(quiet=True)
+        self.assertEqual(
+            sorted(self.compress_files(2, lambda **kwargs: compressor)),
+            [('a.css', 'a.css.gz'), ('b.css', 'b.css.gz')])
+        self.assertEqual(compressor.count, 2)
+
+
+class CompressMediaTestCase(MediaTestCase):
+
+    def setUp(self):
+        super(CompressMediaTestCase, self).setUp()
+        self.storage.compress_media = True
+
+    def test_disabled(self):
+        self.storage.compress_media = False
+        name = self.save('documents/a.css', CONTENT)
+        self.assertFalse(os.path.exists(self.storage.path(name) + '.gz'))
+
+    def test_compress(self):
+        name = self.save('documents/a.css', CONTENT)
+        path = self.storage.path(name)
+        with gzip.open(path + '.gz') as f:
+            self.assertEqual(f.read(), CONTENT)
+        self.assertEqual(
+            os.stat(path + '.gz').st_mtime, os.stat(path).st_mtime)
+        # No temporary files are left behind.
+        self.assertEqual(os.listdir(self.storage.path(os.path.join(
+            storage_module.DEDUPE_PATH_PREFIX,
+            storage_module.STREAMING_SAVE_TEMP_DIR))), [])
+
+    def test_min_saving(self):
+        name = self.save('documents/a.css', os.urandom(1000))
+        self.assertFalse(os.path.exists(self.storage.path(name) + '.gz'))
+
+    def test_skip_extensions(self):
+        name = self.save('documents/a.jpg', CONTENT)
+        self.assertFalse(os.path.exists(self.storage.path(name) + '.gz'))
+
+    def test_max_size(self):
+        self.storage.compress_media_max_size = len(CONTENT) - 1
+        name = self.save('documents/a.css', CONTENT)
+        self.assertFalse(os.path.exists(self.storage.path(name) + '.gz'))
+
+    def test_save_existing(self):
+        # Existing files already have their variants.
+        self.save('documents/a.css', CONTENT)
+        with mock.patch.object(
+                self.storage, 'compress_media_file') as compress:
+            self.save('documents/b.css', CONTENT)
+        compress.assert_not_called()
+
+    def test_workers(self):
+        self.storage.compress_media_workers = 1
+        self.addCleanup(
+            setattr, storage_module, '_compress_media_executor', None)
+        name = self.save('documents/a.css', CONTENT)
+        storage_module._compress_media_executor.shutdown(wait=True)
+        self.assertTrue(os.path.exists(self.storage.path(name) + '.gz'))
+
+    def test_error(self):
+        # Errors are logged, because the file itself has been saved.
+        with mock.patch.object(
+                self.storage, 'compress_media_file', side_effect=IOError), \
+                self.assertLogs('ixc_whitenoise.storage', 'ERROR'):
+            name = self.save('documents/a.css', CONTENT)
+        self.assertEqual(self.read(name), CONTENT)
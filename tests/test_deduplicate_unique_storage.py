@@ -0,0 +1,55 @@
+import os
+
+from django.core.management import call_command
+
+from ixc_whitenoise.models import UniqueFile
+
+from tests.base import MediaTestCase
+from tests.models import Document
+
+
+class DeduplicateUniqueStorageTestCase(MediaTestCase):
+
+    def setUp(self):
+        super(DeduplicateUniqueStorageTestCase, self).setUp()
+        self.write('documents/a.txt', b'same')
+        self.write('documents/b.txt', b'same')
+        self.write('documents/c.txt', b'other')
+        self.documents = [
+            Document.objects.create(file=name)
+            for name in ('documents/a.txt', 'documents/b.txt', 'documents/c.txt')
+        ]
+        self.checkpoint = os.path.join(self.media_root, 'checkpoint.json')
+
+    def deduplicate(self, **options):
+        call_command(
+            'deduplicate_unique_storage', checkpoint=self.checkpoint,
+            **options)
+        for document in self.documents:
+            document.refresh_from_db()
+        return [document.file.name for document in self.documents]
+
+    def test_deduplicate(self):
+        a, b, c = self.deduplicate()
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, c)
+        self.assertTrue(a.startswith('dd/documents/'))
+        self.assertEqual(self.read(a), b'same')
+        self.assertEqual(self.read(c), b'other')
+        # Original files are removed once nothing refers to them.
+        self.assertFalse(self.storage.exists('documents/a.txt'))
+        self.assertFalse(self.storage.exists('documents/c.txt'))
+        self.assertEqual(
+            set(UniqueFile.objects.values_list('original_name', 'name')),
+            {('documents/a.txt', a), ('documents/b.txt', b),
+             ('documents/c.txt', c)})
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_workers(self):
+        a, b, c = self.deduplicate(workers=2, batch_size=1)
+        self.assertEqual(a, b)
+        self.assertEqual(self.read(c), b'other')
+
+    def test_idempotent(self):
+        names = self.deduplicate()
+        self.assertEqual(self.deduplicate(), names)
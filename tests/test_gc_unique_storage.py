@@ -0,0 +1,126 @@
+import datetime
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+from django.core.management import call_command
+from django.utils import timezone
+
+from ixc_whitenoise.management.commands import gc_unique_storage
+from ixc_whitenoise.models import UniqueFile
+
+from tests.base import MediaTestCase
+from tests.models import Document
+
+
+class GCUniqueStorageTestCase(MediaTestCase):
+
+    def setUp(self):
+        super(GCUniqueStorageTestCase, self).setUp()
+        self.live_name = self.save('documents/live.txt', b'live')
+        Document.objects.create(file=self.live_name)
+        self.dead_name = self.save('documents/dead.txt', b'dead')
+        # Outside the grace period. The inode change time of files cannot be
+        # set, so run the command 30 days in the future instead.
+        UniqueFile.objects.update(
+            created=timezone.now() - datetime.timedelta(days=30),
+            last_seen=timezone.now() - datetime.timedelta(days=30))
+        self.age(self.live_name, 30)
+        self.age(self.dead_name, 30)
+        future = time.time() + 30 * 24 * 60 * 60
+        patcher = mock.patch.object(
+            gc_unique_storage, 'time',
+            SimpleNamespace(time=lambda: future))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_delete_unreferenced(self):
+        call_command('gc_unique_storage', grace_days=7)
+        self.assertTrue(self.storage.exists(self.live_name))
+        self.assertFalse(self.storage.exists(self.dead_name))
+        self.assertFalse(UniqueFile.objects.filter(name=self.dead_name).exists())
+        self.assertTrue(UniqueFile.objects.filter(name=self.live_name).exists())
+
+    def test_keep_recently_changed(self):
+        call_command('gc_unique_storage', grace_days=31)
+        self.assertTrue(self.storage.exists(self.dead_name))
+
+    def test_keep_linked_with_old_mtime(self):
+        # Files saved from a path are linked into place and keep their old
+        # modification time.
+        path = self.write('import/new.txt', b'new')
+        os.utime(path, (0, 0))
+        new_name, content_hash, size = self.storage.save_unique_from_path(
+            'documents/new.txt', path)
+        self.assertEqual(os.stat(self.storage.path(new_name)).st_mtime, 0)
+        # Run the command now.
+        gc_unique_storage.time.time = time.time
+        call_command('gc_unique_storage', grace_days=7)
+        self.assertTrue(self.storage.exists(new_name))
+
+    def test_keep_referenced_after_live_names_read(self):
+        # An instance is saved with the existing dead file after live names
+        # were read.
+        iter_live_names = gc_unique_storage.Command.iter_live_names
+
+        def save_instance(command):
+            for name in iter_live_names(command):
+                yield name
+            Document.objects.create(file=self.dead_name)
+
+        with mock.patch.object(
+                gc_unique_storage.Command, 'iter_live_names', save_instance):
+            call_command('gc_unique_storage', grace_days=7)
+        self.assertTrue(self.storage.exists(self.dead_name))
+
+    def test_save_again_after_delete(self):
+        self.storage.exists_cache_size = 100
+        del self.storage._exists_cache
+        self.assertEqual(self.save('documents/dead.txt', b'dead'),
+                         self.dead_name)
+        self.assertIn(self.dead_name, self.storage.exists_cache)
+        UniqueFile.objects.update(
+            last_seen=timezone.now() - datetime.timedelta(days=30))
+        call_command('gc_unique_storage', grace_days=7)
+        self.assertFalse(self.storage.exists(self.dead_name))
+        # The collected name is no longer remembered as existing.
+        self.save('documents/dead.txt', b'dead')
+        self.assertEqual(self.read(self.dead_name), b'dead')
+
+    def test_keep_recently_recorded(self):
+        UniqueFile.objects.filter(name=self.dead_name).update(
+            last_seen=timezone.now())
+        call_command('gc_unique_storage', grace_days=7)
+        self.assertTrue(self.storage.exists(self.dead_name))
+
+    def test_keep_saved_again(self):
+        # The existing file is reused for the same names, so no object is
+        # created and the file is not written.
+        self.assertEqual(self.save('documents/dead.txt', b'dead'),
+                         self.dead_name)
+        self.assertEqual(
+            UniqueFile.objects.filter(name=self.dead_name).count(), 1)
+        call_command('gc_unique_storage', grace_days=7)
+        self.assertTrue(self.storage.exists(self.dead_name))
+
+    def test_touch_saved_again(self):
+        # Local files saved again are touched, so their inode change time is
+        # within the grace period.
+        with mock.patch('ixc_whitenoise.storage.os.utime') as utime:
+            self.save('documents/dead.txt', b'dead')
+        utime.assert_called_once_with(self.storage.path(self.dead_name))
+
+    def test_dry_run(self):
+        call_command('gc_unique_storage', grace_days=7, dry_run=True)
+        self.assertTrue(self.storage.exists(self.dead_name))
+        self.assertTrue(UniqueFile.objects.filter(name=self.dead_name).exists())
+
+    def test_quarantine(self):
+        quarantine_dir = tempfile.mkdtemp(dir=self.media_root)
+        call_command(
+            'gc_unique_storage', grace_days=7, quarantine=quarantine_dir)
+        self.assertFalse(self.storage.exists(self.dead_name))
+        with open(os.path.join(quarantine_dir, self.dead_name), 'rb') as f:
+            self.assertEqual(f.read(), b'dead')
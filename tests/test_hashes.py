@@ -0,0 +1,65 @@
+import hashlib
+import unittest
+
+from django.core.files.base import ContentFile
+
+from ixc_whitenoise.hashes import HASH_ALGORITHMS, new_hash
+from ixc_whitenoise.models import UniqueFile
+
+from tests.base import MediaTestCase
+
+
+class NewHashTestCase(unittest.TestCase):
+
+    def test_algorithms(self):
+        for algorithm, expected in (
+                ('md5', hashlib.md5(b'a')),
+                ('sha1', hashlib.sha1(b'a')),
+                ('sha256', hashlib.sha256(b'a')),
+                ('blake2b', hashlib.blake2b(b'a', digest_size=32)),
+                ('blake2s', hashlib.blake2s(b'a'))):
+            content_hash = new_hash(algorithm)
+            content_hash.update(b'a')
+            self.assertEqual(content_hash.hexdigest(), expected.hexdigest())
+
+    def test_new_instances(self):
+        for algorithm in HASH_ALGORITHMS:
+            new_hash(algorithm).update(b'a')
+            self.assertEqual(
+                new_hash(algorithm).hexdigest(),
+                HASH_ALGORITHMS[algorithm]().hexdigest())
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            new_hash('crc32')
+
+
+class HashAlgorithmTestCase(MediaTestCase):
+
+    def test_save(self):
+        self.storage.hash_algorithm = 'sha256'
+        name = self.save('documents/a.txt', b'a')
+        content_hash = hashlib.sha256(b'a').hexdigest()
+        self.assertEqual(
+            name, self.storage.get_unique_name('documents/a.txt', content_hash))
+        unique_file = UniqueFile.objects.get(name=name)
+        self.assertEqual(
+            (unique_file.content_hash, unique_file.hash_algorithm),
+            (content_hash, 'sha256'))
+
+    def test_get_content_hash(self):
+        name = self.save('documents/a.txt', b'a')
+        # Recorded with the default algorithm.
+        self.assertEqual(
+            self.storage.get_content_hash(name), hashlib.md5(b'a').hexdigest())
+        # Not recorded with other algorithms, so the file is read.
+        self.assertEqual(
+            self.storage.get_content_hash(name, 'sha1'),
+            hashlib.sha1(b'a').hexdigest())
+
+    def test_chunk_size(self):
+        self.storage.hash_chunk_size = 3
+        content = ContentFile(b'abcdefg')
+        self.assertEqual(
+            [len(chunk) for chunk in self.storage.iter_content_chunks(content)],
+            [3, 3, 1])
@@ -0,0 +1,208 @@
+import os
+import shutil
+import tempfile
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+from unittest import mock
+
+from ixc_whitenoise import fileindex
+from ixc_whitenoise.fileindex import build_file_index, get_index_path
+from ixc_whitenoise.middleware import WhiteNoiseMiddleware
+from ixc_whitenoise.storage import LocalCacheMixin, UniqueMixin
+
+from tests.base import MediaTestCase
+
+
+class RemoteError(Exception):
+    """
+    Like `botocore.exceptions.ClientError`, which is not an `IOError`.
+    """
+
+
+class RemoteFileSystemStorage(FileSystemStorage):
+    """
+    Remote storage, which raises its own error for missing files and counts
+    calls to `exists()`.
+    """
+
+    exists_count = 0
+
+    def is_local(self):
+        return False
+
+    def exists(self, name):
+        self.exists_count += 1
+        return super(RemoteFileSystemStorage, self).exists(name)
+
+    def _open(self, name, mode='rb'):
+        if not os.path.exists(self.path(name)):
+            raise RemoteError('Not Found: %s' % name)
+        return super(RemoteFileSystemStorage, self)._open(name, mode)
+
+
+class CachedRemoteStorage(
+        LocalCacheMixin, UniqueMixin, RemoteFileSystemStorage):
+    pass
+
+
+class BaseMiddlewareTestCase(MediaTestCase):
+
+    def setUp(self):
+        super(BaseMiddlewareTestCase, self).setUp()
+        self.static_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.static_root, True)
+        self.index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.index_dir, True)
+        settings_override = override_settings(STATIC_ROOT=self.static_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        index_patch = mock.patch.object(
+            fileindex, 'FILE_INDEX_DIR', self.index_dir)
+        index_patch.start()
+        self.addCleanup(index_patch.stop)
+
+    def get_middleware(self, **settings):
+        settings = dict(('WHITENOISE_%s' % key.upper(), value)
+                        for key, value in settings.items())
+        with override_settings(**settings):
+            return WhiteNoiseMiddleware(
+                lambda request: HttpResponse(status=404))
+
+    def get(self, middleware, url):
+        request = RequestFactory().get(url)
+        response = middleware.process_request(request)
+        if response is None:
+            response = middleware.process_response(
+                request, HttpResponse(status=404))
+        return response
+
+
+class MiddlewareTestCase(BaseMiddlewareTestCase):
+
+    def build_media_index(self):
+        build_file_index(self.media_root, get_index_path('media'))
+
+    def test_media_index(self):
+        name = self.save('documents/a.txt', b'a')
+        self.build_media_index()
+        middleware = self.get_middleware()
+        self.assertEqual(middleware.file_indexes[0][0],
+                         os.path.join(self.media_root, ''))
+        response = self.get(middleware, '/media/' + name)
+        self.assertEqual(response.status_code, 200)
+
+    def test_media_uploaded_after_index(self):
+        self.build_media_index()
+        middleware = self.get_middleware()
+        name = self.save('documents/a.txt', b'a')
+        response = self.get(middleware, '/media/' + name)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'a')
+
+    def test_redirect_original_name(self):
+        name = self.save('documents/a.txt', b'a')
+        middleware = self.get_middleware(lazy_media=True)
+        response = self.get(middleware, '/media/documents/a.txt')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Location'], '/media/' + name)
+
+
+class CachedMediaTestCase(BaseMiddlewareTestCase):
+
+    def setUp(self):
+        super(CachedMediaTestCase, self).setUp()
+        remote_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, remote_root, True)
+        self.storage = CachedRemoteStorage(location=remote_root)
+        self.storage.local_cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.storage.local_cache_dir, True)
+        default_storage._wrapped = self.storage
+
+    def test_cached_media(self):
+        name = self.save('documents/a.txt', b'a')
+        response = self.get(self.get_middleware(), '/media/' + name)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'a')
+        self.assertTrue(os.path.exists(self.storage.get_cache_path(name)))
+
+    def test_cached_media_missing(self):
+        middleware = self.get_middleware()
+        url = '/media/dd/documents/missing.txt'
+        self.assertEqual(self.get(middleware, url).status_code, 404)
+        exists_count = self.storage.exists_count
+        # Misses are cached.
+        self.assertEqual(self.get(middleware, url).status_code, 404)
+        self.assertEqual(self.storage.exists_count, exists_count)
+
+    def test_exists_deleted_from_remote(self):
+        name = self.save('documents/a.txt', b'a')
+        self.storage.cached_path(name)
+        # Deleted from remote storage by another process.
+        os.unlink(self.storage.path(name))
+        self.assertFalse(self.storage.exists(name))
+        self.storage.exists_cache.local.clear()
+        self.assertEqual(
+            self.storage.save('documents/a.txt', ContentFile(b'a')), name)
+        self.assertTrue(os.path.exists(self.storage.path(name)))
+
+
+class LazyMediaTestCase(BaseMiddlewareTestCase):
+
+    def test_not_scanned(self):
+        name = self.save('documents/a.txt', b'a')
+        self.assertIn('/media/' + name, self.get_middleware().files)
+        middleware = self.get_middleware(lazy_media=True)
+        self.assertNotIn('/media/' + name, middleware.files)
+        response = self.get(middleware, '/media/' + name)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'a')
+
+    def test_cached(self):
+        name = self.save('documents/a.txt', b'a')
+        middleware = self.get_middleware(lazy_media=True)
+        with mock.patch.object(
+                middleware, 'find_file_at_path',
+                side_effect=middleware.find_file_at_path) as find_file:
+            self.get(middleware, '/media/' + name)
+            self.get(middleware, '/media/' + name)
+        self.assertEqual(find_file.call_count, 1)
+
+    def test_not_unique(self):
+        # Files without a unique name may change, so they are not cached.
+        self.write('documents/a.txt', b'a')
+        middleware = self.get_middleware(lazy_media=True)
+        response = self.get(middleware, '/media/documents/a.txt')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('/media/documents/a.txt', middleware.media_files)
+
+    def test_missing(self):
+        middleware = self.get_middleware(lazy_media=True)
+        response = self.get(middleware, '/media/dd/documents/missing.txt')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(len(middleware.media_files), 0)
+
+    def test_outside_media_root(self):
+        os.makedirs(os.path.join(self.static_root, 'media'))
+        with open(os.path.join(self.static_root, 'secret.txt'), 'wb') as f:
+            f.write(b'secret')
+        with override_settings(MEDIA_ROOT=os.path.join(
+                self.static_root, 'media')):
+            middleware = self.get_middleware(lazy_media=True)
+        self.assertIsNone(middleware.find_media_file('/media/../secret.txt'))
+
+    def test_compression_pending(self):
+        # Recently saved files without compressed variants are not cached,
+        # because the variants may still be written in the background.
+        self.storage.compress_media = True
+        with mock.patch.object(self.storage, 'compress_media_file'):
+            name = self.save('documents/a.css', b'body { color: red; }' * 100)
+        middleware = self.get_middleware(lazy_media=True)
+        response = self.get(middleware, '/media/' + name)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('/media/' + name, middleware.media_files)
+        self.storage.compress_media_file(name)
+        self.get(middleware, '/media/' + name)
+        self.assertIn('/media/' + name, middleware.media_files)
@@ -0,0 +1,72 @@
+import importlib
+from types import SimpleNamespace
+from unittest import mock
+
+from django.apps import apps
+from django.core.files.base import ContentFile
+from django.db import connection, migrations
+from django.db.migrations.loader import MigrationLoader
+
+from ixc_whitenoise.models import UniqueFile, get_names_hash
+
+from tests.base import MediaTestCase
+
+migration = importlib.import_module(
+    'ixc_whitenoise.migrations.0004_unique_file_name_original_name')
+
+
+class UniqueFileTestCase(MediaTestCase):
+
+    def test_names_hash(self):
+        unique_file = UniqueFile.objects.create(name='dd/a', original_name='a')
+        self.assertEqual(unique_file.names_hash, get_names_hash('dd/a', 'a'))
+        self.assertNotEqual(
+            get_names_hash('dd/a', 'a'), get_names_hash('dd/', 'aa'))
+
+    def test_record_once(self):
+        self.save('documents/a.txt', b'a')
+        self.save('documents/a.txt', b'a')
+        self.storage.save_many([
+            ('documents/a.txt', ContentFile(b'a')),
+            ('documents/b.txt', ContentFile(b'a')),
+        ])
+        self.assertEqual(
+            sorted(UniqueFile.objects.values_list('original_name', flat=True)),
+            ['documents/a.txt', 'documents/b.txt'])
+
+    def test_migration(self):
+        # Objects created before the migration have no names hash, and may be
+        # duplicates.
+        UniqueFile.objects.bulk_create([
+            UniqueFile(name='dd/a', original_name='a'),
+            UniqueFile(
+                name='dd/a', original_name='a', content_hash='abc', size=1),
+            UniqueFile(name='dd/b', original_name='b'),
+        ])
+        schema_editor = SimpleNamespace(connection=connection)
+        migration.delete_duplicates(apps, schema_editor)
+        migration.set_names_hashes(apps, schema_editor)
+        self.assertEqual(
+            sorted(UniqueFile.objects.values_list(
+                'name', 'original_name', 'content_hash', 'size',
+                'names_hash')),
+            [
+                ('dd/a', 'a', 'abc', 1, get_names_hash('dd/a', 'a')),
+                ('dd/b', 'b', '', None, get_names_hash('dd/b', 'b')),
+            ])
+
+    def test_migration_rerun(self):
+        # Schema changes made by an earlier run that did not complete are not
+        # made again.
+        loader = MigrationLoader(connection)
+        key = ('ixc_whitenoise', '0004_unique_file_name_original_name')
+        from_state = loader.project_state(
+            ('ixc_whitenoise', '0003_unique_file_content_hash_size'))
+        to_state = loader.project_state(key)
+        schema_editor = mock.Mock(connection=connection)
+        for operation in loader.get_migration(*key).operations:
+            if not isinstance(operation, migrations.RunPython):
+                operation.database_forwards(
+                    'ixc_whitenoise', schema_editor, from_state, to_state)
+        self.assertFalse(schema_editor.add_field.called)
+        self.assertFalse(schema_editor.alter_field.called)
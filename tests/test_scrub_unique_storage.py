@@ -0,0 +1,28 @@
+import os
+import tempfile
+
+from django.core.management import call_command
+
+from tests.base import MediaTestCase
+
+
+class ScrubUniqueStorageTestCase(MediaTestCase):
+
+    def setUp(self):
+        super(ScrubUniqueStorageTestCase, self).setUp()
+        self.good_name = self.save('documents/good.txt', b'good')
+        self.corrupt_name = self.save('documents/corrupt.txt', b'corrupt')
+        self.write(self.corrupt_name, b'bit rot')
+        self.quarantine_dir = tempfile.mkdtemp(dir=self.media_root)
+
+    def test_quarantine_corrupt(self):
+        call_command('scrub_unique_storage', quarantine=self.quarantine_dir)
+        self.assertTrue(self.storage.exists(self.good_name))
+        self.assertFalse(self.storage.exists(self.corrupt_name))
+        path = os.path.join(self.quarantine_dir, self.corrupt_name)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'bit rot')
+
+    def test_report_only(self):
+        call_command('scrub_unique_storage')
+        self.assertTrue(self.storage.exists(self.corrupt_name))
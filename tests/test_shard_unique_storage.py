@@ -0,0 +1,69 @@
+from unittest import mock
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+
+from ixc_whitenoise.cache import resolution_cache
+from ixc_whitenoise.models import UniqueFile, get_names_hash
+
+from tests.base import MediaTestCase
+from tests.models import Document
+
+
+class ShardUniqueStorageTestCase(MediaTestCase):
+
+    def setUp(self):
+        super(ShardUniqueStorageTestCase, self).setUp()
+        self.name = self.save('documents/a.txt', b'a')
+        self.document = Document.objects.create(file=self.name)
+        self.storage.shard_depth = 1
+        self.new_name = self.storage.get_resharded_name(self.name)
+
+    def test_reshard(self):
+        self.assertNotEqual(self.new_name, self.name)
+        call_command('shard_unique_storage', from_depth=0)
+        self.assertEqual(self.read(self.new_name), b'a')
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.file.name, self.new_name)
+        unique_file = UniqueFile.objects.get(
+            name=self.new_name, original_name='documents/a.txt')
+        self.assertEqual(
+            unique_file.names_hash,
+            get_names_hash(self.new_name, 'documents/a.txt'))
+
+    def test_redirect_old_name(self):
+        # Resolve the old name before it is moved, to check that it is
+        # invalidated.
+        self.assertIsNone(resolution_cache.get(self.name))
+        call_command('shard_unique_storage', from_depth=0)
+        self.assertFalse(self.storage.exists(self.name))
+        self.assertEqual(resolution_cache.get(self.name), self.new_name)
+
+    def test_dry_run(self):
+        call_command('shard_unique_storage', from_depth=0, dry_run=True)
+        self.assertTrue(self.storage.exists(self.name))
+        self.assertFalse(self.storage.exists(self.new_name))
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.file.name, self.name)
+
+
+class ShardedNameTestCase(MediaTestCase):
+
+    def test_save_unique_name(self):
+        # Saving an existing unique name again does not nest shard
+        # directories.
+        self.storage.shard_depth = 2
+        name = self.save('documents/a.txt', b'a')
+        self.assertEqual(self.save(name, b'a'), name)
+
+    @mock.patch('ixc_whitenoise.storage.ORIGINAL_BASENAME', True)
+    def test_save_unique_name_original_basename(self):
+        self.storage.shard_depth = 3
+        name = self.save('documents/a.txt', b'a')
+        self.assertEqual(self.save(name, b'a'), name)
+
+    @mock.patch('ixc_whitenoise.storage.ORIGINAL_BASENAME', True)
+    def test_shards_longer_than_hash(self):
+        self.storage.shard_depth = 4
+        with self.assertRaises(ImproperlyConfigured):
+            self.save('documents/a.txt', b'a')
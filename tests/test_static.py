@@ -0,0 +1,303 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.storage import FileSystemStorage
+from django.test import override_settings
+
+from ixc_whitenoise.storage import \
+    CompressedManifestStaticFilesStorage, find_components
+
+CSS = b'body { background: url("img/a.png"); }\n'
+
+
+class StaticTestCase(unittest.TestCase):
+    """
+    Collect static files from a source directory into an empty
+    `STATIC_ROOT`, and post-process them like `collectstatic`.
+    """
+
+    storage_class = CompressedManifestStaticFilesStorage
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir, True)
+        self.static_root = os.path.join(self.temp_dir, 'static')
+        os.makedirs(self.static_root)
+        settings_override = override_settings(STATIC_ROOT=self.static_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.source = FileSystemStorage(
+            location=os.path.join(self.temp_dir, 'source'))
+
+    def write(self, name, content):
+        path = self.source.path(name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(content)
+
+    def collect(self, **attrs):
+        """
+        Copy all source files and post-process them. Return the storage and
+        the names that were post-processed.
+        """
+        storage = self.storage_class()
+        for attr, value in attrs.items():
+            setattr(storage, attr, value)
+        paths = {}
+        for root, dirs, files in os.walk(self.source.location):
+            for filename in files:
+                name = os.path.relpath(
+                    os.path.join(root, filename), self.source.location)
+                path = storage.path(name)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                shutil.copy2(self.source.path(name), path)
+                paths[name] = (self.source, name)
+        processed = []
+        for name, hashed_name, was_processed in storage.post_process(paths):
+            if isinstance(was_processed, Exception):
+                raise was_processed
+            processed.append(name)
+        return storage, processed
+
+    def read(self, name):
+        with open(os.path.join(self.static_root, name), 'rb') as f:
+            return f.read()
+
+    def read_manifest(self):
+        with open(os.path.join(self.static_root, 'staticfiles.json')) as f:
+            return json.load(f)['paths']
+
+
+class PostProcessTestCase(StaticTestCase):
+
+    def test_same_as_django(self):
+        # JavaScript is only rewritten where Django rewrites it, because
+        # rewriting reads files that may not be UTF-8.
+        self.write('css/a.css', (
+            b'@import "b.css";\n'
+            b'@import url("b.css");\n'
+            b'p { background: url(img/a.png); }\n'
+            b'q { background: url(\'img/a.png?v=1#top\'); }\n'
+            b'r { background: url("/static/css/img/a.png"); }\n'
+            b'a { background: url("data:image/png;base64,YQ=="); }\n'
+            b'b { background: url("//example.com/a.png"); }\n'
+            b'i { background: url("#mask"); }\n'
+        ))
+        self.write('css/b.css', CSS)
+        self.write('css/img/a.png', b'a')
+        self.write(
+            'js/a.js', b'var a = "a.js";\n//# sourceMappingURL=a.js.map\n')
+        self.write('js/a.js.map', b'{}')
+        self.collect()
+        manifest = self.read_manifest()
+        contents = dict(
+            (name, self.read(hashed_name))
+            for name, hashed_name in manifest.items())
+        shutil.rmtree(self.static_root)
+        os.makedirs(self.static_root)
+        self.storage_class = ManifestStaticFilesStorage
+        self.collect()
+        self.assertEqual(manifest, self.read_manifest())
+        for name, hashed_name in self.read_manifest().items():
+            self.assertEqual(contents[name], self.read(hashed_name), name)
+
+    def test_missing_reference(self):
+        # Other references in the same file are still rewritten.
+        self.write('css/a.css', (
+            b'@import "b.css";\n'
+            b'p { background: url("missing.png"); }\n'
+        ))
+        self.write('css/b.css', b'p { color: red; }\n')
+        for graph_post_process in (False, True):
+            with self.assertLogs('ixc_whitenoise.storage', 'WARNING') as logs:
+                self.collect(graph_post_process=graph_post_process)
+            self.assertIn("'css/missing.png' could not be found", logs.output[0])
+            manifest = self.read_manifest()
+            self.assertEqual(self.read(manifest['css/a.css']), (
+                '@import url("%s");\n'
+                'p { background: url("missing.png"); }\n' %
+                os.path.basename(manifest['css/b.css'])).encode())
+
+
+class IncrementalTestCase(StaticTestCase):
+
+    def setUp(self):
+        super(IncrementalTestCase, self).setUp()
+        self.fingerprints_path = os.path.join(
+            self.temp_dir, 'fingerprints.json')
+        self.write('css/a.css', b'@import "b.css";\n')
+        self.write('css/b.css', CSS)
+        self.write('css/img/a.png', b'a')
+        self.write('css/c.css', b'p { color: red; }\n')
+
+    def collect(self, **attrs):
+        attrs.setdefault('static_fingerprints_path', self.fingerprints_path)
+        return super(IncrementalTestCase, self).collect(**attrs)
+
+    def test_unchanged(self):
+        self.collect()
+        manifest = self.read_manifest()
+        storage, processed = self.collect()
+        self.assertEqual(processed, [])
+        self.assertEqual(self.read_manifest(), manifest)
+
+    def test_touched(self):
+        # Changed modification times alone are not changes.
+        self.collect()
+        path = self.source.path('css/c.css')
+        os.utime(path, (0, 0))
+        storage, processed = self.collect()
+        self.assertEqual(processed, [])
+
+    def test_changed(self):
+        # Files that reference a changed file, directly or indirectly, are
+        # processed again.
+        self.collect()
+        self.write('css/img/a.png', b'b')
+        storage, processed = self.collect()
+        self.assertEqual(
+            sorted(set(processed)),
+            ['css/a.css', 'css/b.css', 'css/img/a.png'])
+        manifest = self.read_manifest()
+        # The same as a full run.
+        shutil.rmtree(self.static_root)
+        os.makedirs(self.static_root)
+        self.collect(static_fingerprints_path=None)
+        self.assertEqual(self.read_manifest(), manifest)
+
+    def test_hashed_file_missing(self):
+        self.collect()
+        os.unlink(os.path.join(
+            self.static_root, self.read_manifest()['css/c.css']))
+        storage, processed = self.collect()
+        self.assertEqual(sorted(set(processed)), ['css/c.css'])
+        self.assertEqual(
+            self.read(self.read_manifest()['css/c.css']),
+            b'p { color: red; }\n')
+
+    def test_removed(self):
+        self.collect()
+        os.unlink(self.source.path('css/img/a.png'))
+        os.unlink(os.path.join(self.static_root, 'css/img/a.png'))
+        storage, processed = self.collect(manifest_strict=False)
+        self.assertIn('css/b.css', processed)
+        self.assertNotIn('css/img/a.png', self.read_manifest())
+
+    def test_settings_changed(self):
+        self.collect()
+        with override_settings(STATIC_URL='/assets/'):
+            storage, processed = self.collect()
+        self.assertEqual(
+            sorted(set(processed)),
+            ['css/a.css', 'css/b.css', 'css/c.css', 'css/img/a.png'])
+
+
+class FindComponentsTestCase(unittest.TestCase):
+
+    def test_order(self):
+        # Each component comes after the components it references.
+        self.assertEqual(find_components({
+            'a': {'b', 'x'},
+            'b': {'c'},
+            'c': {'b'},
+            'd': set(),
+        }), [['b', 'c'], ['x'], ['a'], ['d']])
+
+    def test_self_reference(self):
+        self.assertEqual(find_components({'a': {'a'}}), [['a']])
+
+    def test_deep(self):
+        graph = dict((i, {i + 1}) for i in range(10000))
+        components = find_components(graph)
+        self.assertEqual(components[0], [10000])
+        self.assertEqual(components[-1], [0])
+
+
+class GraphPostProcessTestCase(StaticTestCase):
+
+    def setUp(self):
+        super(GraphPostProcessTestCase, self).setUp()
+        self.write('css/a.css', b'@import "b.css";\n@import "c/c.css";\n')
+        self.write('css/b.css', b'@import "c/c.css";\n' + CSS)
+        self.write('css/c/c.css', b'p { background: url("../img/a.png"); }\n')
+        self.write('css/img/a.png', b'a')
+
+    def collect(self, **attrs):
+        attrs.setdefault('graph_post_process', True)
+        return super(GraphPostProcessTestCase, self).collect(**attrs)
+
+    def write_cycle(self):
+        self.write('css/c/c.css', b'@import "../a.css";\n')
+
+    def test_same_as_passes(self):
+        self.collect(graph_post_process=False)
+        manifest = self.read_manifest()
+        contents = dict(
+            (name, self.read(hashed_name))
+            for name, hashed_name in manifest.items())
+        shutil.rmtree(self.static_root)
+        os.makedirs(self.static_root)
+        storage, processed = self.collect()
+        self.assertEqual(self.read_manifest(), manifest)
+        for name, hashed_name in manifest.items():
+            self.assertEqual(self.read(hashed_name), contents[name], name)
+        # Each file is processed once.
+        self.assertEqual(sorted(processed), sorted(manifest))
+        self.assertEqual(storage.post_process_stats['adjustable_files'], 3)
+        self.assertEqual(storage.post_process_stats['edges'], 3)
+        self.assertEqual(storage.post_process_stats['cycles'], 0)
+
+    def test_cycle_error(self):
+        self.write_cycle()
+        with self.assertRaisesRegex(
+                RuntimeError,
+                'Files reference each other: '
+                'css/a.css -> css/b.css -> css/c/c.css -> css/a.css'):
+            self.collect()
+
+    def test_cycle_group(self):
+        self.write_cycle()
+        with self.assertLogs('ixc_whitenoise.storage', 'WARNING'):
+            storage, processed = self.collect(post_process_cycles='group')
+        self.assertEqual(storage.post_process_stats['cycles'], 1)
+        self.assertEqual(storage.post_process_stats['cycle_files'], 3)
+        manifest = self.read_manifest()
+        # References within the cycle are rewritten.
+        self.assertEqual(
+            self.read(manifest['css/c/c.css']),
+            ('@import url("../%s");\n' %
+             os.path.basename(manifest['css/a.css'])).encode())
+        self.assertIn(
+            os.path.basename(manifest['css/img/a.png']).encode(),
+            self.read(manifest['css/b.css']))
+        # Each name changes when a file outside the cycle changes.
+        self.write('css/img/a.png', b'b')
+        shutil.rmtree(self.static_root)
+        os.makedirs(self.static_root)
+        with self.assertLogs('ixc_whitenoise.storage', 'WARNING'):
+            self.collect(post_process_cycles='group')
+        changed = self.read_manifest()
+        for name in ('css/a.css', 'css/b.css', 'css/c/c.css'):
+            self.assertNotEqual(changed[name], manifest[name])
+
+    def test_cycle_group_same_names(self):
+        # Names do not depend on which file in the cycle is found first.
+        self.write_cycle()
+        with self.assertLogs('ixc_whitenoise.storage', 'WARNING'):
+            self.collect(post_process_cycles='group')
+        manifest = self.read_manifest()
+        shutil.rmtree(self.static_root)
+        os.makedirs(self.static_root)
+        with self.assertLogs('ixc_whitenoise.storage', 'WARNING'):
+            self.collect(post_process_cycles='group')
+        self.assertEqual(self.read_manifest(), manifest)
+
+    def test_unknown_cycles(self):
+        with self.assertRaisesRegex(ValueError, 'Unknown post-process cycle'):
+            self.collect(post_process_cycles='ignore')
@@ -0,0 +1,243 @@
+import asyncio
+import errno
+import hashlib
+import os
+import posixpath
+import unittest
+from unittest import mock
+
+import django
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+
+from ixc_whitenoise.models import UniqueFile
+from ixc_whitenoise.storage import \
+    CSS_URL_PATTERN, DEDUPE_PATH_PREFIX, STREAMING_SAVE_TEMP_DIR
+
+from tests.base import MediaTestCase
+
+
+def md5(content):
+    return hashlib.md5(content).hexdigest()
+
+
+class UniqueStorageTestCase(MediaTestCase):
+
+    def test_save(self):
+        name = self.save('documents/a.txt', b'a')
+        self.assertTrue(name.startswith('dd/documents/'))
+        self.assertEqual(self.read(name), b'a')
+        self.assertEqual(self.save('documents/b.txt', b'a'), name)
+        self.assertEqual(
+            set(UniqueFile.objects.values_list('original_name', flat=True)),
+            {'documents/a.txt', 'documents/b.txt'})
+
+    def test_text_size(self):
+        text = u'caf\xe9 ☃'
+        size = len(text.encode('utf-8'))
+        name = self.storage.save('documents/a.txt', ContentFile(text))
+        self.assertEqual(self.read(name), text.encode('utf-8'))
+        self.assertEqual(UniqueFile.objects.get(name=name).size, size)
+
+    def test_text_size_save_many(self):
+        text = u'caf\xe9 ☃'
+        name, = self.storage.save_many([('documents/a.txt', ContentFile(text))])
+        self.assertEqual(
+            UniqueFile.objects.get(name=name).size,
+            len(text.encode('utf-8')))
+
+    def test_text_size_streaming(self):
+        self.storage.streaming_save = True
+        text = u'caf\xe9 ☃'
+        name = self.storage.save('documents/a.txt', ContentFile(text))
+        self.assertEqual(
+            UniqueFile.objects.get(name=name).size,
+            len(text.encode('utf-8')))
+
+    def test_aexists(self):
+        name = self.save('documents/a.txt', b'a')
+        self.assertTrue(asyncio.run(self.storage.aexists(name)))
+        self.assertFalse(
+            asyncio.run(self.storage.aexists('documents/missing.txt')))
+
+
+class SaveManyTestCase(MediaTestCase):
+
+    def test_order(self):
+        names = self.storage.save_many([
+            ('documents/a.txt', ContentFile(b'a')),
+            ('documents/b.txt', ContentFile(b'b')),
+            ('documents/c.txt', ContentFile(b'a')),
+            ('images/a.txt', ContentFile(b'a')),
+        ])
+        self.assertEqual(names, [
+            self.storage.get_unique_name('documents/a.txt', md5(b'a')),
+            self.storage.get_unique_name('documents/b.txt', md5(b'b')),
+            self.storage.get_unique_name('documents/a.txt', md5(b'a')),
+            self.storage.get_unique_name('images/a.txt', md5(b'a')),
+        ])
+        self.assertEqual(names[0], names[2])
+        self.assertEqual([self.read(name) for name in names],
+                         [b'a', b'b', b'a', b'a'])
+        self.assertEqual(
+            sorted(UniqueFile.objects.values_list(
+                'name', 'original_name', 'size')),
+            sorted([
+                (names[0], 'documents/a.txt', 1),
+                (names[1], 'documents/b.txt', 1),
+                (names[0], 'documents/c.txt', 1),
+                (names[3], 'images/a.txt', 1),
+            ]))
+
+    def test_dedupe(self):
+        # Identical content is hashed once per file, and written once.
+        files = [
+            ('documents/a.txt', ContentFile(b'a')),
+            ('documents/b.txt', ContentFile(b'a')),
+        ]
+        with mock.patch.object(
+                self.storage, 'iter_content_chunks',
+                side_effect=self.storage.iter_content_chunks) as iter_chunks, \
+                mock.patch.object(
+                    FileSystemStorage, '_save',
+                    side_effect=FileSystemStorage._save,
+                    autospec=True) as save:
+            names = self.storage.save_many(files)
+        self.assertEqual(iter_chunks.call_count, 2)
+        self.assertEqual(save.call_count, 1)
+        self.assertEqual(names[0], names[1])
+
+    def test_save_existing(self):
+        name = self.save('documents/a.txt', b'a')
+        self.assertEqual(self.storage.save_many([
+            ('documents/a.txt', ContentFile(b'a')),
+        ]), [name])
+        self.assertEqual(UniqueFile.objects.count(), 1)
+
+    @mock.patch('django.VERSION', (2, 1, 0, 'final', 0))
+    def test_without_ignore_conflicts(self):
+        self.save('documents/a.txt', b'a')
+        names = self.storage.save_many([
+            ('documents/a.txt', ContentFile(b'a')),
+            ('documents/b.txt', ContentFile(b'a')),
+        ])
+        self.assertEqual(
+            sorted(UniqueFile.objects.values_list('name', 'original_name')),
+            [(names[0], 'documents/a.txt'), (names[0], 'documents/b.txt')])
+
+    def test_validate_file_name(self):
+        with mock.patch.object(
+                self.storage, 'get_unique_name', return_value='dd/../a.txt'), \
+                mock.patch.object(
+                    self.storage, 'save_unique',
+                    return_value=('dd/../a.txt', md5(b'a'), 1)):
+            with self.assertRaises(SuspiciousFileOperation):
+                self.storage.save_many([
+                    ('documents/a.txt', ContentFile(b'a')),
+                ])
+            with self.assertRaises(SuspiciousFileOperation):
+                asyncio.run(self.storage.asave(
+                    'documents/a.txt', ContentFile(b'a')))
+
+
+class StreamingSaveTestCase(MediaTestCase):
+
+    def setUp(self):
+        super(StreamingSaveTestCase, self).setUp()
+        self.storage.streaming_save = True
+        self.temp_dir = os.path.join(
+            self.media_root, DEDUPE_PATH_PREFIX, STREAMING_SAVE_TEMP_DIR)
+
+    def test_save(self):
+        name = self.save('documents/a.txt', b'a')
+        self.assertEqual(name, self.storage.get_unique_name(
+            'documents/a.txt', hashlib.md5(b'a').hexdigest()))
+        self.assertEqual(self.read(name), b'a')
+        self.assertEqual(UniqueFile.objects.get(name=name).size, 1)
+        # Temporary files are removed.
+        self.assertEqual(os.listdir(self.temp_dir), [])
+
+    def test_save_existing(self):
+        name = self.save('documents/a.txt', b'a')
+        inode = os.stat(self.storage.path(name)).st_ino
+        self.assertEqual(self.save('documents/b.txt', b'a'), name)
+        # The existing file is kept, and the new copy is dropped.
+        self.assertEqual(os.stat(self.storage.path(name)).st_ino, inode)
+        self.assertEqual(os.listdir(self.temp_dir), [])
+        self.assertEqual(UniqueFile.objects.filter(name=name).count(), 2)
+
+    def test_read_once(self):
+        content = ContentFile(b'a' * 100000)
+        with mock.patch.object(
+                content, 'chunks', wraps=content.chunks) as chunks:
+            self.storage.save('documents/a.txt', content)
+        self.assertEqual(chunks.call_count, 1)
+
+
+class SaveFromPathTestCase(MediaTestCase):
+
+    def setUp(self):
+        super(SaveFromPathTestCase, self).setUp()
+        self.path = self.write('import/a.txt', b'a')
+
+    def disable_links(self):
+        # Hard links are not supported across file systems.
+        patcher = mock.patch(
+            'ixc_whitenoise.storage.os.link',
+            side_effect=OSError(errno.EXDEV, 'Cross-device link'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_link(self):
+        name = self.storage.save_from_path('documents/a.txt', self.path)
+        self.assertEqual(self.read(name), b'a')
+        self.assertTrue(os.path.samefile(self.path, self.storage.path(name)))
+        unique_file = UniqueFile.objects.get(name=name)
+        self.assertEqual(unique_file.original_name, 'documents/a.txt')
+        self.assertEqual(unique_file.size, 1)
+
+    def test_move(self):
+        name = self.storage.save_from_path(
+            'documents/a.txt', self.path, move=True)
+        self.assertEqual(self.read(name), b'a')
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_move_without_link(self):
+        self.disable_links()
+        stat_result = os.stat(self.path)
+        name = self.storage.save_from_path(
+            'documents/a.txt', self.path, move=True)
+        self.assertEqual(os.stat(self.storage.path(name)).st_ino,
+                         stat_result.st_ino)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_copy_without_link(self):
+        self.disable_links()
+        name = self.storage.save_from_path('documents/a.txt', self.path)
+        self.assertEqual(self.read(name), b'a')
+        self.assertFalse(
+            os.path.samefile(self.path, self.storage.path(name)))
+        self.assertTrue(os.path.exists(self.path))
+        # No temporary files are left behind.
+        self.assertEqual(os.listdir(self.storage.path(posixpath.join(
+            DEDUPE_PATH_PREFIX, STREAMING_SAVE_TEMP_DIR))), [])
+
+    def test_existing(self):
+        name = self.save('documents/a.txt', b'a')
+        stat_result = os.stat(self.storage.path(name))
+        self.assertEqual(self.storage.save_from_path(
+            'documents/b.txt', self.path, move=True), name)
+        self.assertEqual(
+            os.stat(self.storage.path(name)).st_ino, stat_result.st_ino)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(
+            sorted(UniqueFile.objects.values_list('original_name', flat=True)),
+            ['documents/a.txt', 'documents/b.txt'])
+
+
+class RegexURLConverterMixinTestCase(unittest.TestCase):
+
+    def test_css_source_maps(self):
+        self.assertEqual(
+            '(?P<css_map>' in CSS_URL_PATTERN, django.VERSION[:2] >= (4, 0))
@@ -0,0 +1,61 @@
+import hashlib
+from unittest import mock
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory, override_settings
+
+from ixc_whitenoise.models import UniqueFile
+
+from tests.base import MediaTestCase
+
+HANDLERS = [
+    'ixc_whitenoise.uploadhandler.MemoryFileUploadHandler',
+    'ixc_whitenoise.uploadhandler.TemporaryFileUploadHandler',
+]
+
+
+@override_settings(FILE_UPLOAD_HANDLERS=HANDLERS)
+class UploadHandlerTestCase(MediaTestCase):
+
+    def upload(self, content):
+        request = RequestFactory().post('/', {
+            'file': SimpleUploadedFile('a.txt', content),
+        })
+        return request.FILES['file']
+
+    def test_memory(self):
+        uploaded_file = self.upload(b'a')
+        self.assertEqual(
+            type(uploaded_file).__name__, 'InMemoryUploadedFile')
+        self.assertEqual(
+            uploaded_file.content_hash, hashlib.md5(b'a').hexdigest())
+        self.assertEqual(uploaded_file.content_hash_algorithm, 'md5')
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=10)
+    def test_temporary(self):
+        content = b'a' * 100
+        uploaded_file = self.upload(content)
+        self.assertEqual(
+            type(uploaded_file).__name__, 'TemporaryUploadedFile')
+        self.assertEqual(
+            uploaded_file.content_hash, hashlib.md5(content).hexdigest())
+
+    def test_save_without_reading(self):
+        uploaded_file = self.upload(b'a')
+        with mock.patch.object(
+                self.storage, 'iter_content_chunks') as iter_content_chunks:
+            name = self.storage.save('documents/a.txt', uploaded_file)
+        iter_content_chunks.assert_not_called()
+        self.assertEqual(self.read(name), b'a')
+        self.assertEqual(
+            UniqueFile.objects.get(name=name).content_hash,
+            hashlib.md5(b'a').hexdigest())
+
+    def test_other_algorithm(self):
+        # Hashes generated with another algorithm are ignored.
+        uploaded_file = self.upload(b'a')
+        self.storage.hash_algorithm = 'sha256'
+        name = self.storage.save('documents/a.txt', uploaded_file)
+        self.assertEqual(
+            UniqueFile.objects.get(name=name).content_hash,
+            hashlib.sha256(b'a').hexdigest())